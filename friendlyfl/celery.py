@@ -1,12 +1,23 @@
-import json
 import os
-import requests
+import threading
+from contextlib import nullcontext
 from celery import Celery
+from celery.exceptions import MaxRetriesExceededError
+from celery.signals import beat_init, worker_ready, worker_shutdown
 from celery.utils.log import get_task_logger
 from kombu import Exchange, Queue
-from friendlyfl.controller import redis
+from friendlyfl.controller import router_client
+from friendlyfl.controller.affinity import node_queue
+from friendlyfl.controller.dispatch import affinity_queues, check_status_change, dispatch_runs, fetch, reset_cache, \
+    run_state, workers
+from friendlyfl.controller.file import file_utils
+from friendlyfl.controller.model_cache import ModelCache, is_terminal
+from friendlyfl.controller.run_lock import RunGuard, transition_key
 from friendlyfl.controller.site_status_task import report_alive
-from friendlyfl.controller.utils import load_class, camel_to_snake, format_status, epoch_time_in_sec
+from friendlyfl.controller.tasks.aggregation import sub_aggregators
+from friendlyfl.controller.utils import load_class, camel_to_snake, format_status
+from friendlyfl.settings import MODEL_CACHE_MAX_ENTRIES, MODEL_CACHE_TTL, MODEL_CACHE_MAX_BYTES, COMPUTE_BLAS_THREADS, \
+    AFFINITY_ROUTING_ENABLED, RUN_LOCK_TTL, RUN_LOCK_WAIT, RUN_LOCK_RETRY_DELAY, RUN_LOCK_MAX_RETRIES
 
 logger = get_task_logger(__name__)
 
@@ -16,23 +27,28 @@ app.config_from_object("django.conf:settings", namespace="CELERY")
 
 run_exchange = Exchange('friendlyfl.run', type='direct')
 task_exchange = Exchange('friendlyfl.processor', type='direct')
+compute_exchange = Exchange('friendlyfl.compute', type='direct')
 
 app.conf.task_queues = {
     Queue('friendlyfl.run', run_exchange, routing_key='friendlyfl.run'),
     Queue('friendlyfl.processor', task_exchange,
-          routing_key='friendlyfl.processor')
+          routing_key='friendlyfl.processor'),
+    Queue('friendlyfl.compute', compute_exchange,
+          routing_key='friendlyfl.compute')
 }
 
-router_url = os.getenv('ROUTER_URL')
-router_username = os.getenv('ROUTER_USERNAME')
-router_password = os.getenv('ROUTER_PASSWORD')
+# queues this worker node is registered for, stopped on shutdown
+affinity_stop = threading.Event()
+affinity_joined = []
+
 site_id = os.getenv('SITE_UID')
 
-run_key = 'friendlyfl:controller:run:list:'
+run_guard = RunGuard(lock_ttl=RUN_LOCK_TTL)
 
 # Keep singleton ml model instance
-ml_models = dict()
-ml_models_alive = dict()
+ml_models = ModelCache(max_entries=MODEL_CACHE_MAX_ENTRIES,
+                       ttl=MODEL_CACHE_TTL,
+                       max_bytes=MODEL_CACHE_MAX_BYTES)
 
 
 @app.task(bind=True, queue='friendlyfl.run', name='fetch_run')
@@ -44,62 +60,108 @@ def fetch_run(args):
     logger.debug("Received: {}".format(args))
 
     runs = check_status_change(site_id)
-    if runs:
-        for run in runs:
-            process_task.s(run, False).apply_async(
-                queue='friendlyfl.processor')
+    dispatch_runs(runs)
 
 
 @app.task(bind=True, queue='friendlyfl.run', name='monitor_run')
 def monitor_run(args):
     """
-    Monitor coordinator run in waiting status
+    Monitor coordinator run in waiting status, and sub-aggregator run waiting for the updates of its group
     :param args:
     :return:
     """
     run_list = fetch()
     if run_list:
+        waiting_runs = [r for r in run_list
+                        if r['site_uid'] == site_id and (r['role'] == 'coordinator' or is_sub_aggregator(r))]
+        snapshot = run_state.snapshot(waiting_runs)
         retry_run = []
-        for r in run_list:
-            if r['site_uid'] == site_id and r['role'] == 'coordinator':
-                exist_run = get_run_from_redis(r)
-                if exist_run:
-                    run = json.loads(exist_run)
-                    r_status = format_status(r['status'])
-                    if r_status == format_status(run['status']) and \
-                            r_status in ['preparing', 'preparing', 'pending_aggregating']:
-                        retry_run.append(r)
-
-        if retry_run:
-            for run in retry_run:
-                process_task.s(run, True).apply_async(
-                    queue='friendlyfl.processor')
+        for r in waiting_runs:
+            r_status = format_status(r['status'])
+            waiting_status = ['preparing', 'pending_aggregating'] if r['role'] == 'coordinator' \
+                else ['pending_success']
+            if r_status == snapshot[r['id']] and r_status in waiting_status:
+                retry_run.append(r)
+
+        dispatch_runs(retry_run, is_retry=True)
 
 
 @app.task(bind=True, queue='friendlyfl.run', name='site_heartbeat')
 def heartbeat(args):
     report_alive()
+    logger.debug("Router latency stats: {}".format(router_client.stats.snapshot()))
 
 
-def refresh_model(run_id):
-    now = epoch_time_in_sec()
-    ml_models_alive[run_id] = now
-    for i in ml_models_alive.keys():
-        v = ml_models_alive[i]
-        if v < now - 86400:
-            ml_models.pop(i)
-            ml_models_alive.pop(i)
+@app.task(bind=True, queue='friendlyfl.compute', name='cache_dataset')
+def cache_dataset(args, run_id):
+    """
+    Convert the uploaded csv dataset of a run into the binary cache loaded by tasks
+    :param run_id: run id
+    :return:
+    """
+    if file_utils.build_dataset_cache(run_id):
+        logger.debug("Dataset cache of run {} is built".format(run_id))
 
 
 @app.task(bind=True, queue='friendlyfl.processor', name='process_task')
 def process_task(args, run, is_retry):
     """
+    Handle a state transition of a run
+    :param args:
+    :param run: run model
+    :param is_retry: whether the task is triggered by retry
+    :return:
+    """
+    logger.debug("Received: {} options: {}".format(args, run))
+    guarded_run(args, run, is_retry)
+
+
+@app.task(bind=True, queue='friendlyfl.compute', name='compute_task')
+def compute_task(args, run, is_retry):
+    """
+    Handle a run in a compute status, i.e. training or aggregation, with BLAS threads limited
     :param args:
     :param run: run model
     :param is_retry: whether the task is triggered by retry
     :return:
     """
     logger.debug("Received: {} options: {}".format(args, run))
+    with blas_limits():
+        guarded_run(args, run, is_retry)
+
+
+def guarded_run(task, run, is_retry):
+    """
+    Handle a transition once cluster-wide: under the lock of the run, and only if it is not handled yet.
+    Retries of waiting statuses by monitor_run are meant to run again and skip the done check.
+    The lock is waited for briefly, as handlers push the next status of their run while holding it.
+    A transition finding the run still busy is retried later, a busy retry is dropped as monitor_run sends another one.
+    Once out of retries, the last seen status of the run is forgotten so the next fetch dispatches it again
+    """
+    key = transition_key(run)
+    with run_guard.locked(run['id'], RUN_LOCK_WAIT) as held:
+        if held:
+            if not is_retry and run_guard.is_done(run):
+                logger.debug("Transition {} is handled already, ignore it".format(key))
+            else:
+                handle_run(run, is_retry)
+                run_guard.mark_done(run)
+    if not held:
+        if is_retry:
+            logger.debug("Run {} is busy, skip retry of {}".format(run['id'], key))
+        else:
+            logger.debug("Run {} is busy, retry {} in {}s".format(run['id'], key, RUN_LOCK_RETRY_DELAY))
+            try:
+                raise task.retry(countdown=RUN_LOCK_RETRY_DELAY, max_retries=RUN_LOCK_MAX_RETRIES)
+            except MaxRetriesExceededError:
+                logger.warning("Run {} stayed busy, drop {} until the next fetch".format(run['id'], key))
+                run_state.remove(run['id'])
+
+
+def handle_run(run, is_retry):
+    """
+    Call the handler of the run status on the task instance of the run, kept in the model cache of this worker
+    """
     run_id = run['id']
     cur_seq = run['cur_seq']
     tasks = run['tasks']
@@ -110,76 +172,80 @@ def process_task(args, run, is_retry):
     try:
         klass = load_class('friendlyfl.controller.tasks.{}'.format(
             camel_to_snake(model)), model)
-        if model_id in ml_models:
-            instance = ml_models[model_id]
-        else:
+        instance = ml_models.get(model_id)
+        if instance is None:
+            # instance of the previous task in the run is no longer needed
+            ml_models.evict("{}_{}".format(run_id, cur_seq - 1))
             instance = klass(run)
-            ml_models[model_id] = instance
-        refresh_model(model_id)
+            ml_models.put(model_id, instance)
         instance.method_call(status, run, is_retry)
+        if is_terminal(status):
+            ml_models.evict_run(run_id)
+        else:
+            ml_models.refresh(model_id)
+        logger.debug("Model cache stats: {}".format(ml_models.stats()))
 
     except (ImportError, AttributeError) as e:
         logger.warn("{} not found with error: {}".format(model, e))
 
 
-def fetch():
-    headers = {'Content-type': 'application/json'}
-    data = dict()
-    response = requests.get('{0}/runs/active/'.format(router_url),
-                            headers=headers,
-                            auth=(router_username, router_password),
-                            data=json.dumps(data))
-    if response.ok:
-        return response.json()
-    else:
-        return None
-
-
-def check_status_change(site_uid) -> []:
+@worker_ready.connect
+def join_affinity(sender, **kwargs):
     """
-    Check run status to decide whether send message to task processor
-    :return:
+    Consume the node queue of every shared queue this worker serves and register the node, so runs get pinned to it
     """
-    run_list = fetch()
-    if run_list:
-        changed_run = []
-        for r in run_list:
-            if r['site_uid'] == site_uid:
-                exist_run = get_run_from_redis(r)
-                if exist_run:
-                    run = json.loads(exist_run)
-                    if format_status(r['status']) != format_status(run['status']):
-                        changed_run.append(r)
-                        add_to_redis(r)
-                else:
-                    changed_run.append(r)
-                    add_to_redis(r)
-        return changed_run
-    return None
-
-
-def get_run_from_redis(run):
-    r = redis.get_redis()
-    return r.get(run_key + str(run['id']))
+    if not AFFINITY_ROUTING_ENABLED:
+        return
+    consumed = {q.name for q in sender.task_consumer.queues}
+    queues = [q for q in affinity_queues if q in consumed]
+    if not queues:
+        return
+    for q in queues:
+        sender.add_task_queue(node_queue(q, sender.hostname))
+    affinity_joined.extend(queues)
+    threading.Thread(target=workers.keep_alive, args=(queues, sender.hostname, affinity_stop),
+                     daemon=True).start()
+    logger.info("Worker {} joined {}".format(sender.hostname, queues))
+
+
+@worker_shutdown.connect
+def leave_affinity(sender, **kwargs):
+    """
+    Deregister the node right away, its runs move to the remaining nodes
+    """
+    affinity_stop.set()
+    for q in affinity_joined:
+        try:
+            workers.deregister(q, sender.hostname)
+        except Exception as e:
+            logger.debug("Failed to deregister worker {}: {}".format(sender.hostname, e))
 
 
-def add_to_redis(run):
-    r = redis.get_redis()
-    k = run_key + str(run['id'])
-    r.set(k, json.dumps(run), ex=86400)
+def blas_limits():
+    """
+    Limit the threads of BLAS libraries to COMPUTE_BLAS_THREADS, so concurrent compute tasks do not oversubscribe cores
+    """
+    if not COMPUTE_BLAS_THREADS:
+        return nullcontext()
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        logger.warning('threadpoolctl is not installed, BLAS threads are not limited')
+        return nullcontext()
+    return threadpool_limits(limits=COMPUTE_BLAS_THREADS, user_api='blas')
 
 
-def remove_from_redis(run_id):
-    r = redis.get_redis()
-    k = run_key + str(run_id)
-    r.delete(k)
+def is_sub_aggregator(run) -> bool:
+    config = run['tasks'][run['cur_seq'] - 1].get('config') or dict()
+    return site_id in sub_aggregators(config)
 
 
-def reset_cache():
-    r = redis.get_redis()
-    for key in r.scan_iter(run_key+'*'):
-        r.delete(key)
+@beat_init.connect
+def reset_on_beat_start(sender, **kwargs):
+    """
+    The scheduler starting forgets the last seen status of runs, so the first fetch_run dispatches every active run
+    """
+    reset_cache()
 
 
-reset_cache()
 app.autodiscover_tasks()
@@ -0,0 +1,139 @@
+import bisect
+import hashlib
+import logging
+import re
+import threading
+import time
+
+from friendlyfl.controller import redis
+
+logger = logging.getLogger(__name__)
+
+worker_key = 'friendlyfl:controller:worker:'
+
+departed_key = 'friendlyfl:controller:worker:departed:'
+
+worker_ttl = 30
+
+
+def ring_hash(value) -> int:
+    return int.from_bytes(hashlib.md5(str(value).encode('utf-8')).digest()[:8], 'big')
+
+
+def node_queue(queue, node) -> str:
+    """
+    Queue only consumed by one worker node, e.g. friendlyfl.processor.celery-host-1
+    """
+    return '{}.{}'.format(queue, re.sub(r'[^A-Za-z0-9_.-]', '-', node))
+
+
+class HashRing:
+    """
+    Consistent hashing of keys onto nodes. Each node has replicas points on the ring and a key goes to the node
+    of the first point after its hash, so when a node joins or leaves only the keys of its share move.
+    """
+
+    def __init__(self, nodes=(), replicas=64):
+        self.replicas = replicas
+        self.nodes = frozenset(nodes)
+        points = sorted((ring_hash('{}#{}'.format(node, i)), node)
+                        for node in self.nodes for i in range(replicas))
+        self.hashes = [h for h, _ in points]
+        self.owners = [n for _, n in points]
+
+    def node(self, key):
+        """
+        :return: node of a key, None if the ring is empty
+        """
+        if not self.hashes:
+            return None
+        i = bisect.bisect(self.hashes, ring_hash(key)) % len(self.hashes)
+        return self.owners[i]
+
+
+class WorkerRegistry:
+    """
+    Live worker nodes per queue kept in redis, as a sorted set of node name to last heartbeat time.
+    A node missing heartbeats for ttl seconds is considered gone and its runs move to the other nodes.
+    Nodes which left are recorded until a dispatcher takes them, as messages may be left in their queues.
+    """
+
+    def __init__(self, prefix=worker_key, ttl=worker_ttl, departed_prefix=departed_key):
+        self.prefix = prefix
+        self.ttl = ttl
+        self.departed_prefix = departed_prefix
+        self.rings = dict()
+
+    def key(self, queue):
+        return self.prefix + queue
+
+    def departed_key(self, queue):
+        return self.departed_prefix + queue
+
+    def register(self, queue, node):
+        redis.get_redis().zadd(self.key(queue), {node: time.time()})
+
+    def deregister(self, queue, node):
+        r = redis.get_redis()
+        if r.zrem(self.key(queue), node):
+            r.sadd(self.departed_key(queue), node)
+
+    def workers(self, queue) -> list:
+        """
+        Nodes missing heartbeats are removed and recorded as departed by the first caller noticing them
+        :return: names of the nodes serving a queue which sent a heartbeat within ttl seconds
+        """
+        r = redis.get_redis()
+        deadline = time.time() - self.ttl
+        live = []
+        for value, score in r.zrangebyscore(self.key(queue), '-inf', '+inf', withscores=True):
+            node = value.decode('utf-8')
+            if score >= deadline:
+                live.append(node)
+            elif r.zrem(self.key(queue), node):
+                r.sadd(self.departed_key(queue), node)
+        return sorted(live)
+
+    def take_departed(self, queue) -> set:
+        """
+        Take the nodes which left a queue since the last call, the nodes back in the meantime are left out
+        :return: names of the departed nodes, each is returned to a single caller
+        """
+        live = set(self.workers(queue))
+        departed = {v.decode('utf-8') for v in redis.get_redis().spop(self.departed_key(queue), 1000) or []}
+        return departed - live
+
+    def ring(self, queue) -> HashRing:
+        """
+        Hash ring of the live nodes of a queue, rebuilt only when nodes join or leave
+        """
+        nodes = frozenset(self.workers(queue))
+        ring = self.rings.get(queue)
+        if ring is None or ring.nodes != nodes:
+            if ring is not None:
+                logger.info('Workers of {} changed from {} to {}'.format(
+                    queue, sorted(ring.nodes), sorted(nodes)))
+            ring = HashRing(nodes)
+            self.rings[queue] = ring
+        return ring
+
+    def route(self, queue, run_id, ring: HashRing = None) -> str:
+        """
+        :param ring: ring of the queue, fetched when absent. Pass it to route many runs with one lookup
+        :return: queue of the node a run is pinned to, the shared queue when no node is registered
+        """
+        node = (ring or self.ring(queue)).node(run_id)
+        return node_queue(queue, node) if node else queue
+
+    def keep_alive(self, queues, node, stop: threading.Event):
+        """
+        Renew the registration of a node until stop is set. Run in a daemon thread
+        """
+        while True:
+            try:
+                for queue in queues:
+                    self.register(queue, node)
+            except Exception as e:
+                logger.warning('Failed to register worker {}: {}'.format(node, e))
+            if stop.wait(self.ttl / 3):
+                return
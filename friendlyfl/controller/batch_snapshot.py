@@ -0,0 +1,51 @@
+import json
+import logging
+
+from friendlyfl.controller import redis
+
+logger = logging.getLogger(__name__)
+
+snapshot_key = 'friendlyfl:controller:batch:runs:'
+
+snapshot_ttl = 2
+
+
+class BatchSnapshotCache:
+    """
+    Runs of a batch with their status as fetched from the router, shared by all workers of the site for a few seconds.
+    The cache is an optimization only: redis errors fall back to the router.
+    """
+
+    def __init__(self, prefix=snapshot_key, ttl=snapshot_ttl):
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def key(self, project_id, batch_id):
+        return '{}{}:{}'.format(self.prefix, project_id, batch_id)
+
+    def get(self, project_id, batch_id):
+        """
+        :return: runs of the batch, None if not cached
+        """
+        if not self.ttl:
+            return None
+        try:
+            value = redis.get_redis().get(self.key(project_id, batch_id))
+        except Exception as e:
+            logger.debug('Failed to read runs of batch {}: {}'.format(batch_id, e))
+            return None
+        return json.loads(value) if value is not None else None
+
+    def put(self, project_id, batch_id, runs):
+        if not self.ttl:
+            return
+        try:
+            redis.get_redis().set(self.key(project_id, batch_id), json.dumps(runs), px=int(self.ttl * 1000))
+        except Exception as e:
+            logger.debug('Failed to cache runs of batch {}: {}'.format(batch_id, e))
+
+    def invalidate(self, project_id, batch_id):
+        try:
+            redis.get_redis().delete(self.key(project_id, batch_id))
+        except Exception as e:
+            logger.debug('Failed to invalidate runs of batch {}: {}'.format(batch_id, e))
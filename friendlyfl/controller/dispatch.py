@@ -0,0 +1,156 @@
+"""
+Dispatch of run state transitions to the processor and compute queues.
+Shared by the celery tasks and the run subscriber, importing it has no side effects.
+"""
+import json
+import logging
+
+from celery import current_app
+
+from friendlyfl.controller import router_client
+from friendlyfl.controller.affinity import HashRing, WorkerRegistry, node_queue
+from friendlyfl.controller.run_state import RunStateStore
+from friendlyfl.controller.tasks.aggregation import sub_aggregators
+from friendlyfl.controller.utils import format_status
+from friendlyfl.settings import AFFINITY_ROUTING_ENABLED, WORKER_REGISTRY_TTL
+
+logger = logging.getLogger(__name__)
+
+# statuses whose handlers train or aggregate. They run on the compute queue, so long fits do not hold up
+# the state transitions of other runs on the processor queue. Pending aggregating joins them when the coordinator
+# folds updates as they arrive
+compute_status = ['running', 'aggregating']
+
+# shared queues whose runs are pinned to one worker node, so the task instance cached by that node is reused
+affinity_queues = ['friendlyfl.processor', 'friendlyfl.compute']
+
+workers = WorkerRegistry(ttl=WORKER_REGISTRY_TTL)
+
+run_state = RunStateStore()
+
+
+def folds_on_arrival(run) -> bool:
+    """
+    Whether the coordinator folds updates as they arrive while pending aggregating, i.e. in async mode or with
+    incremental aggregation, in which case it loads, folds and publishes models in that status
+    """
+    if run.get('role') != 'coordinator':
+        return False
+    c = run['tasks'][run['cur_seq'] - 1].get('config') or dict()
+    return c.get('mode', 'sync') == 'async' or c.get('aggregation_mode', 'batch') == 'incremental' or \
+        bool(c.get('round_deadline')) or bool(sub_aggregators(c, run.get('site_uid')))
+
+
+def is_compute(run) -> bool:
+    status = format_status(run['status'])
+    return status in compute_status or (status == 'pending_aggregating' and folds_on_arrival(run))
+
+
+def fetch():
+    headers = {'Content-type': 'application/json'}
+    data = dict()
+    response = router_client.get('/runs/active/',
+                                 headers=headers,
+                                 data=json.dumps(data))
+    if response.ok:
+        return response.json()
+    else:
+        return None
+
+
+def affinity_rings() -> dict:
+    """
+    Hash rings of the affinity queues, looked up once per batch of runs to dispatch
+    :return: queue to ring, empty when affinity routing is off or the registry is unavailable
+    """
+    if not AFFINITY_ROUTING_ENABLED:
+        return dict()
+    try:
+        return {queue: workers.ring(queue) for queue in affinity_queues}
+    except Exception as e:
+        logger.warning("Failed to look up worker nodes, using shared queues: {}".format(e))
+        return dict()
+
+
+def affinity_queue(queue, run_id, rings) -> str:
+    """
+    Queue of the worker node a run is pinned to by consistent hashing of its id,
+    the shared queue when affinity routing is off or no node is registered
+    :param rings: queue to ring, see affinity_rings
+    """
+    ring = rings.get(queue)
+    return workers.route(queue, run_id, ring) if ring is not None else queue
+
+
+def dispatch_runs(runs, is_retry=False):
+    """
+    Send runs to the task processor, or to the compute queue when their status trains or aggregates.
+    Each run goes to the queue of the worker node it is pinned to
+    :param runs: run models
+    :param is_retry: whether the runs are dispatched by retry
+    :return:
+    """
+    if runs:
+        rings = affinity_rings()
+        for run in runs:
+            if is_compute(run):
+                current_app.send_task('compute_task', args=[run, is_retry],
+                                      queue=affinity_queue('friendlyfl.compute', run['id'], rings))
+            else:
+                current_app.send_task('process_task', args=[run, is_retry],
+                                      queue=affinity_queue('friendlyfl.processor', run['id'], rings))
+
+
+def delete_queue(name):
+    with current_app.connection_for_write() as conn:
+        conn.default_channel.queue_delete(name)
+
+
+def reroute_departed(runs):
+    """
+    Messages left in the queue of a worker node which left, e.g. a container restarted under a new hostname, are
+    never consumed. Such queues are deleted and the runs pinned to the node are forgotten, so they are dispatched
+    again to the node they move to
+    :param runs: active runs of current site
+    :return: runs forgotten
+    """
+    if not AFFINITY_ROUTING_ENABLED:
+        return []
+    stranded = dict()
+    for queue in affinity_queues:
+        try:
+            departed = workers.take_departed(queue)
+            if not departed:
+                continue
+            before = HashRing(workers.ring(queue).nodes | departed)
+            for node in departed:
+                logger.info("Worker {} left {}, deleting its queue".format(node, queue))
+                delete_queue(node_queue(queue, node))
+            stranded.update({r['id']: r for r in runs if before.node(r['id']) in departed})
+        except Exception as e:
+            logger.warning("Failed to reroute runs of departed workers of {}: {}".format(queue, e))
+    run_state.forget(list(stranded.values()))
+    return list(stranded.values())
+
+
+def check_status_change(site_uid, run_list=None) -> []:
+    """
+    Check run status to decide whether send message to task processor
+    :param site_uid: uid of current site
+    :param run_list: active runs pushed by router. Fetch from router if absent
+    :return:
+    """
+    if run_list is None:
+        run_list = fetch()
+    if run_list:
+        runs = [r for r in run_list if r['site_uid'] == site_uid]
+        reroute_departed(runs)
+        return run_state.diff(runs)
+    return None
+
+
+def reset_cache():
+    """
+    Forget the last seen status of runs, so every active run is dispatched again
+    """
+    run_state.reset()
@@ -0,0 +1,111 @@
+"""
+Binary artifact format for model tensors.
+
+Layout:
+    magic        6 bytes  b'FFLART'
+    version      uint16   little endian
+    header size  uint32   little endian
+    header       json     {"tensors": {name: {"dtype", "shape", "offset"}}, "metadata": {...}}
+    padding      up to an alignment of 64 bytes
+    data         raw little endian tensors, each aligned to 64 bytes, offsets relative to the data start
+
+Readers memory-map the file, tensors are zero-copy views into it.
+Artifacts written as a json object per line by earlier versions are still readable.
+"""
+import json
+import mmap
+import struct
+
+import numpy as np
+
+magic = b'FFLART'
+
+format_version = 1
+
+alignment = 64
+
+_prefix = struct.Struct('<6sHI')
+
+
+def _pad(n):
+    return (alignment - n % alignment) % alignment
+
+
+def save_artifact(url, tensors: dict, metadata: dict = None):
+    """
+    Write tensors and metadata to url
+    :param url: file path
+    :param tensors: name to array
+    :param metadata: json serializable dict
+    :return:
+    """
+    # asarray rather than ascontiguousarray, which turns scalars into 1-d arrays
+    arrays = {k: np.asarray(v, dtype=np.asarray(v).dtype.newbyteorder('<'), order='C')
+              for k, v in tensors.items()}
+    offset = 0
+    specs = dict()
+    for name, a in arrays.items():
+        specs[name] = {'dtype': a.dtype.str,
+                       'shape': list(a.shape), 'offset': offset}
+        offset += a.nbytes + _pad(a.nbytes)
+    header = json.dumps({'tensors': specs, 'metadata': metadata or dict()},
+                        separators=(',', ':')).encode('utf-8')
+    with open(url, 'wb') as f:
+        f.write(_prefix.pack(magic, format_version, len(header)))
+        f.write(header)
+        f.write(b'\0' * _pad(_prefix.size + len(header)))
+        for a in arrays.values():
+            f.write(a.tobytes())
+            f.write(b'\0' * _pad(a.nbytes))
+
+
+def is_binary_artifact(url) -> bool:
+    with open(url, 'rb') as f:
+        return f.read(len(magic)) == magic
+
+
+def load_artifact(url):
+    """
+    Read an artifact in binary or legacy json format
+    :param url: file path
+    :return: (tensors, metadata). Binary tensors are read-only views on a memory map
+    """
+    if not is_binary_artifact(url):
+        return load_json_artifact(url)
+    with open(url, 'rb') as f:
+        size = f.seek(0, 2)
+        buf = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    _, version, header_size = _prefix.unpack_from(buf, 0)
+    if version > format_version:
+        raise ValueError(
+            'Unsupported artifact version {} of {}'.format(version, url))
+    header = json.loads(bytes(buf[_prefix.size:_prefix.size + header_size]))
+    data_start = _prefix.size + header_size
+    data_start += _pad(data_start)
+    tensors = dict()
+    for name, spec in header['tensors'].items():
+        dtype = np.dtype(spec['dtype'])
+        count = int(np.prod(spec['shape'], dtype=np.int64))
+        tensors[name] = np.frombuffer(buf, dtype=dtype, count=count,
+                                      offset=data_start + spec['offset']).reshape(spec['shape'])
+    return tensors, header['metadata']
+
+
+def load_json_artifact(url):
+    """
+    Read an artifact written as json. List values are returned as tensors, the rest as metadata.
+    When the file has several lines, the last one wins.
+    """
+    tensors = dict()
+    metadata = dict()
+    with open(url, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            content = json.loads(line)
+            for k, v in content.items():
+                if isinstance(v, list):
+                    tensors[k] = np.asarray(v)
+                else:
+                    metadata[k] = v
+    return tensors, metadata
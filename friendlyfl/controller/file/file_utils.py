@@ -1,10 +1,17 @@
+import hashlib
+import json
 import logging
+import os
 import tempfile
+import time
 import zipfile
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 
+from friendlyfl.controller.file.multipart import decompress_to
+
 logger = logging.getLogger(__name__)
 
 base_folder = '/friendlyfl-controller/local'
@@ -15,10 +22,34 @@ mid_artifacts_name = 'mid-artifacts'
 
 mid_artifacts_dir = 'all-mid-artifacts'
 
+incremental_dir = 'incremental-mid-artifacts'
+
+server_state_dir = 'server-state'
+
+partial_dir = 'partial'
+
 artifacts_name = 'artifacts'
 
+manifest_name = '.manifest.json'
+
 dataset_name = 'dataset'
 
+dataset_cache_meta_name = 'dataset.cache.json'
+
+dataset_features_name = 'dataset.features.bin'
+
+dataset_labels_name = 'dataset.labels.bin'
+
+dataset_cache_version = 1
+
+dataset_chunk_size = 100000
+
+download_chunk_size = 1024 * 1024
+
+# seconds of mtime resolution assumed of the file system. A csv modified within this window of the cache being built
+# may have changed without its size or mtime changing, so its hash is checked
+mtime_resolution = 2
+
 
 def create_if_not_exist(url):
     if url:
@@ -65,44 +96,175 @@ def gen_all_mid_artifacts_url(project_id, batch):
     return f"{base_folder}/{mid_artifacts_dir}/{project_id}/{batch}/"
 
 
+def gen_run_mid_artifacts_url(project_id, batch, run_id):
+    if not project_id or not batch or not run_id:
+        return None
+    return f"{base_folder}/{incremental_dir}/{project_id}/{batch}/{run_id}/"
+
+
+def gen_running_aggregate_url(project_id, batch, task_seq, round_seq, name='aggregate'):
+    if not project_id or not batch or not task_seq or not round_seq:
+        return None
+    return f"{base_folder}/{incremental_dir}/{project_id}/{batch}/{name}-{task_seq}-{round_seq}"
+
+
+def gen_partial_mid_artifacts_url(run_id, task_seq, round_seq):
+    if not run_id or not task_seq or not round_seq:
+        return None
+    return f"{base_folder}/{partial_dir}/{run_id}/{task_seq}/{round_seq}/{mid_artifacts_name}"
+
+
+def gen_server_state_url(run_id, task_seq, round_seq, name):
+    if not run_id or not task_seq or not round_seq:
+        return None
+    return f"{base_folder}/{server_state_dir}/{run_id}/{task_seq}/{name}-{round_seq}"
+
+
 def downloaded_artifacts_url(run_id, task_seq, round_seq):
     if not run_id or not task_seq or not round_seq:
         return None
     return f"{base_folder}/{artifacts_name}/{run_id}/{task_seq}/{round_seq}/"
 
 
-def download_all_mid_artifacts(project_id, batch, content):
+def extract_member(zip_ref, info, file_path):
+    """
+    Extract a file of a zip archive to the directory file_path, decompressing it if it was uploaded compressed
+    """
+    target = (file_path / info.filename).resolve()
+    if file_path.resolve() not in target.parents:
+        raise ValueError('Refuse to extract {} outside of {}'.format(info.filename, file_path))
+    target.parent.mkdir(parents=True, exist_ok=True)
+    with zip_ref.open(info) as src, open(target, 'wb') as dst:
+        decompress_to(src, dst)
+
+
+def save_and_extract(dir_url, chunks):
+    """
+    Stream a zip archive to a temporary file chunk by chunk and extract it to dir_url.
+    Files uploaded with gzip or zstd compression are decompressed. The temporary file is removed afterwards.
+    :param dir_url: directory to extract to
+    :param chunks: iterable of bytes, or bytes
+    :return: absolute path of the directory
+    """
+    if isinstance(chunks, bytes):
+        chunks = [chunks]
+    file_path = Path(dir_url)
+    file_path.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=file_path.parent, suffix='.zip') as temp_file:
+        for chunk in chunks:
+            if chunk:
+                temp_file.write(chunk)
+        temp_file.flush()
+        with zipfile.ZipFile(temp_file.name, 'r') as zip_ref:
+            for info in zip_ref.infolist():
+                if not info.is_dir():
+                    extract_member(zip_ref, info, file_path)
+    return file_path.absolute()
+
+
+def load_manifest(dir_url) -> dict:
+    """
+    Manifest of a download directory: ETag of each download and CRC and size of each file extracted from them
+    :return: {'downloads': {key: {'etag', 'files'}}, 'files': {name: {'crc', 'size'}}}
+    """
+    try:
+        with open(os.path.join(dir_url, manifest_name)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {'downloads': dict(), 'files': dict()}
+
+
+def save_manifest(dir_url, manifest):
+    fd, temp_url = tempfile.mkstemp(dir=dir_url)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(temp_url, os.path.join(dir_url, manifest_name))
+    except Exception:
+        os.unlink(temp_url)
+        raise
+
+
+def cached_etag(dir_url, key):
+    """
+    :param dir_url: download directory
+    :param key: identity of the download, e.g. task seq and round
+    :return: ETag of the last download of key, None if it is unknown or any of its files is gone
+    """
+    if not dir_url or not os.path.isdir(dir_url):
+        return None
+    download = load_manifest(dir_url)['downloads'].get(key)
+    if not download or not download.get('etag'):
+        return None
+    if not all(os.path.exists(os.path.join(dir_url, name)) for name in download['files']):
+        return None
+    return download['etag']
+
+
+def save_and_extract_changed(dir_url, chunks, key, etag=None):
+    """
+    Like save_and_extract, but only extract files which are new or whose CRC or size changed since the manifest,
+    and record the ETag of the download under key
+    :return: (absolute path of the directory, number of files extracted)
+    """
+    if isinstance(chunks, bytes):
+        chunks = [chunks]
+    file_path = Path(dir_url)
+    file_path.mkdir(parents=True, exist_ok=True)
+    manifest = load_manifest(dir_url)
+    extracted = 0
+    with tempfile.NamedTemporaryFile(dir=file_path.parent, suffix='.zip') as temp_file:
+        for chunk in chunks:
+            if chunk:
+                temp_file.write(chunk)
+        temp_file.flush()
+        with zipfile.ZipFile(temp_file.name, 'r') as zip_ref:
+            names = []
+            for info in zip_ref.infolist():
+                if info.is_dir():
+                    continue
+                names.append(info.filename)
+                entry = {'crc': info.CRC, 'size': info.file_size}
+                if manifest['files'].get(info.filename) == entry and (file_path / info.filename).exists():
+                    continue
+                extract_member(zip_ref, info, file_path)
+                manifest['files'][info.filename] = entry
+                extracted += 1
+    manifest['downloads'][key] = {'etag': etag, 'files': names}
+    save_manifest(dir_url, manifest)
+    return file_path.absolute(), extracted
+
+
+def download_all_mid_artifacts(project_id, batch, chunks, key=None, etag=None):
+    """
+    :param key: identity of the download recorded in the manifest with its etag. Without it every file is extracted
+    """
     dir_url = gen_all_mid_artifacts_url(project_id, batch)
     if dir_url:
-        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-            temp_file.write(content)
-        file_path = Path(dir_url)
-        file_path.mkdir(parents=True, exist_ok=True)
+        if key is None:
+            return save_and_extract(dir_url, chunks)
+        return save_and_extract_changed(dir_url, chunks, key, etag)[0]
+    return None
 
-        with zipfile.ZipFile(temp_file.name, 'r') as zip_ref:
-            zip_ref.extractall(file_path)
-        return file_path.absolute()
+
+def download_run_mid_artifacts(project_id, batch, run_id, chunks):
+    dir_url = gen_run_mid_artifacts_url(project_id, batch, run_id)
+    if dir_url:
+        return save_and_extract(dir_url, chunks)
     return None
 
 
-def download_artifacts(run_id, task_seq, round_seq, content):
+def download_artifacts(run_id, task_seq, round_seq, chunks):
     dir_url = downloaded_artifacts_url(run_id, task_seq, round_seq)
     if dir_url:
-        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-            temp_file.write(content)
-        file_path = Path(dir_url)
-        file_path.mkdir(parents=True, exist_ok=True)
-
-        with zipfile.ZipFile(temp_file.name, 'r') as zip_ref:
-            zip_ref.extractall(file_path)
-        return file_path.absolute()
+        return save_and_extract(dir_url, chunks)
     return None
 
 
-def read_file_from_url(url):
+def read_file_from_url(url, mode='r'):
     if url:
         try:
-            file_obj = open(url, 'r')
+            file_obj = open(url, mode)
             return file_obj
         except FileNotFoundError:
             logger.warning("File not found at {}".format(url))
@@ -110,14 +272,161 @@ def read_file_from_url(url):
     return None
 
 
+def file_sha256(url, chunk_size=download_chunk_size):
+    sha = hashlib.sha256()
+    with open(url, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def build_dataset_cache(run_id, chunk_size=dataset_chunk_size) -> bool:
+    """
+    Convert the csv dataset of a run once into raw binary features and labels next to it,
+    so later loads memory-map them instead of parsing the csv.
+    The csv is parsed chunk by chunk. The cache is only valid once its metadata file is written.
+    :param run_id: run id
+    :param chunk_size: rows per chunk
+    :return: whether the cache is built
+    """
+    dir_url = gen_dataset_url(run_id)
+    csv_url = dir_url + dataset_name if dir_url else None
+    if not csv_url or not os.path.exists(csv_url):
+        return False
+    stat = os.stat(csv_url)
+    features_url = dir_url + dataset_features_name
+    labels_url = dir_url + dataset_labels_name
+    rows = 0
+    cols = None
+    label_dtype = None
+    try:
+        with open(features_url + '.tmp', 'wb') as xf, open(labels_url + '.tmp', 'wb') as yf:
+            for chunk in pd.read_csv(csv_url, header=None, chunksize=chunk_size):
+                X = chunk.iloc[:, :-1].to_numpy(dtype=np.float64)
+                y = chunk.iloc[:, -1].to_numpy()
+                if label_dtype is None:
+                    label_dtype = np.int64 if np.issubdtype(
+                        y.dtype, np.integer) else np.float64
+                    cols = X.shape[1]
+                if label_dtype == np.int64 and not np.issubdtype(y.dtype, np.integer):
+                    raise ValueError('labels are not consistently integer')
+                xf.write(np.ascontiguousarray(X).tobytes())
+                yf.write(y.astype(label_dtype).tobytes())
+                rows += len(chunk)
+        if not rows:
+            raise ValueError('dataset is empty')
+        os.replace(features_url + '.tmp', features_url)
+        os.replace(labels_url + '.tmp', labels_url)
+        meta = {
+            'version': dataset_cache_version,
+            'rows': rows,
+            'cols': cols,
+            'feature_dtype': np.dtype(np.float64).str,
+            'label_dtype': np.dtype(label_dtype).str,
+            'source_size': stat.st_size,
+            'source_mtime': stat.st_mtime,
+            'sha256': file_sha256(csv_url),
+            'built_at': time.time()
+        }
+        save_dataset_cache_meta(dir_url, meta)
+        return True
+    except Exception as e:
+        logger.warning(
+            "Failed to build dataset cache of run {} due to {}".format(run_id, e))
+        for url in [features_url + '.tmp', labels_url + '.tmp']:
+            if os.path.exists(url):
+                os.remove(url)
+        return False
+
+
+def save_dataset_cache_meta(dir_url, meta):
+    with open(dir_url + dataset_cache_meta_name + '.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(dir_url + dataset_cache_meta_name + '.tmp',
+               dir_url + dataset_cache_meta_name)
+
+
+def load_dataset_cache_meta(run_id):
+    """
+    The cache is valid when the size and mtime of the csv did not change since it was built. When the csv was
+    modified too close to the build for its mtime to tell, its sha256 is compared as well, until the mtime is old
+    enough to be trusted
+    :return: metadata of the dataset cache if it is valid for the current csv, otherwise None
+    """
+    dir_url = gen_dataset_url(run_id)
+    if not dir_url:
+        return None
+    try:
+        with open(dir_url + dataset_cache_meta_name, 'r') as f:
+            meta = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if meta.get('version') != dataset_cache_version:
+        return None
+    csv_url = dir_url + dataset_name
+    if os.path.exists(csv_url):
+        stat = os.stat(csv_url)
+        if stat.st_size != meta['source_size'] or stat.st_mtime != meta['source_mtime']:
+            return None
+        if stat.st_mtime + mtime_resolution >= meta.get('built_at', 0):
+            if file_sha256(csv_url) != meta['sha256']:
+                return None
+            now = time.time()
+            if stat.st_mtime + mtime_resolution < now:
+                meta['built_at'] = now
+                try:
+                    save_dataset_cache_meta(dir_url, meta)
+                except OSError as e:
+                    logger.debug('Failed to update dataset cache meta of run {}: {}'.format(run_id, e))
+    return meta
+
+
+def load_dataset_cache(run_id):
+    meta = load_dataset_cache_meta(run_id)
+    if not meta:
+        return None, None
+    dir_url = gen_dataset_url(run_id)
+    X = np.memmap(dir_url + dataset_features_name, dtype=np.dtype(meta['feature_dtype']), mode='r',
+                  shape=(meta['rows'], meta['cols']))
+    y = np.memmap(dir_url + dataset_labels_name, dtype=np.dtype(meta['label_dtype']), mode='r',
+                  shape=(meta['rows'],))
+    return X, y
+
+
 def load_dataset_by_run(run_id):
+    X, y = load_dataset_cache(run_id)
+    if X is not None:
+        return X, y
     combined_csv_file = read_file_from_url(gen_dataset_url(run_id) + 'dataset')
     if combined_csv_file:
         try:
-            combined_data = pd.read_csv(combined_csv_file, header=None)
+            with combined_csv_file:
+                combined_data = pd.read_csv(combined_csv_file, header=None)
             X = combined_data.iloc[:, :-1].values
             y = combined_data.iloc[:, -1].values
             return X, y
         except Exception as e:
             logger.warning("Failed to read data set due to {}".format(e))
     return None, None
+
+
+def iter_dataset_by_run(run_id, chunk_size=dataset_chunk_size):
+    """
+    Read the dataset of a run chunk by chunk, from the binary cache if valid, otherwise from the csv
+    :param run_id: run id
+    :param chunk_size: rows per chunk
+    :return: generator of (index of the first row, X, y)
+    """
+    X, y = load_dataset_cache(run_id)
+    if X is not None:
+        for start in range(0, len(y), chunk_size):
+            yield start, np.asarray(X[start:start + chunk_size]), np.asarray(y[start:start + chunk_size])
+        return
+    csv_url = gen_dataset_url(run_id) + dataset_name
+    if not os.path.exists(csv_url):
+        logger.warning("File not found at {}".format(csv_url))
+        return
+    start = 0
+    for chunk in pd.read_csv(csv_url, header=None, chunksize=chunk_size):
+        yield start, chunk.iloc[:, :-1].values, chunk.iloc[:, -1].values
+        start += len(chunk)
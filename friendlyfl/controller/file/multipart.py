@@ -0,0 +1,150 @@
+import gzip
+import logging
+import os
+import shutil
+import tempfile
+import uuid
+
+logger = logging.getLogger(__name__)
+
+copy_chunk_size = 1024 * 1024
+
+compression_suffix = {'gzip': '.gz', 'zstd': '.zst'}
+
+# leading bytes of compressed streams. The router names downloaded files after the run, so compressed uploads are
+# recognized by their content rather than their suffix
+compression_magic = {'gzip': b'\x1f\x8b\x08', 'zstd': b'\x28\xb5\x2f\xfd'}
+
+
+def compress(file_obj, codec):
+    """
+    Compress a binary file object chunk by chunk into a temporary file
+    :param file_obj: binary file object to compress
+    :param codec: gzip or zstd. zstd falls back to gzip when zstandard is not installed
+    :return: (codec actually used, temporary file positioned at the beginning)
+    """
+    if codec == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            logger.warning('zstandard is not installed, fall back to gzip')
+            codec = 'gzip'
+    temp_file = tempfile.TemporaryFile()
+    if codec == 'zstd':
+        zstandard.ZstdCompressor().copy_stream(
+            file_obj, temp_file, read_size=copy_chunk_size)
+    else:
+        with gzip.GzipFile(fileobj=temp_file, mode='wb') as gz:
+            shutil.copyfileobj(file_obj, gz, copy_chunk_size)
+    temp_file.seek(0)
+    return codec, temp_file
+
+
+def detect_compression(head: bytes):
+    """
+    :param head: first bytes of a file
+    :return: gzip or zstd, None if the content is not compressed
+    """
+    for codec, magic in compression_magic.items():
+        if head.startswith(magic):
+            return codec
+    return None
+
+
+def decompress_to(file_obj, target):
+    """
+    Copy a binary file object to another chunk by chunk, decompressing gzip or zstd content
+    :param file_obj: seekable binary file object to read
+    :param target: binary file object to write
+    :return: codec of the content, None if it was copied as is
+    """
+    codec = detect_compression(file_obj.read(4))
+    file_obj.seek(0)
+    if codec == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError('zstandard is not installed, can not decompress zstd content')
+        zstandard.ZstdDecompressor().copy_stream(
+            file_obj, target, read_size=copy_chunk_size)
+    elif codec == 'gzip':
+        with gzip.GzipFile(fileobj=file_obj, mode='rb') as gz:
+            shutil.copyfileobj(gz, target, copy_chunk_size)
+    else:
+        shutil.copyfileobj(file_obj, target, copy_chunk_size)
+    return codec
+
+
+def file_size(file_obj):
+    pos = file_obj.tell()
+    file_obj.seek(0, os.SEEK_END)
+    size = file_obj.tell() - pos
+    file_obj.seek(pos)
+    return size
+
+
+class MultipartStream:
+    """
+    multipart/form-data body read part by part, so files are streamed instead of loaded in memory.
+    The length is known upfront, so it is sent with Content-Length rather than chunked encoding.
+    """
+
+    def __init__(self, fields: dict, files: dict):
+        """
+        :param fields: form fields
+        :param files: field name to (file name, binary file object)
+        """
+        self.boundary = uuid.uuid4().hex
+        self.parts = []
+        for name, value in fields.items():
+            self.parts.append(self._header(name) +
+                              str(value).encode('utf-8') + b'\r\n')
+        for name, (filename, file_obj) in files.items():
+            self.parts.append(self._header(name, filename))
+            # size is fixed here, data appended later (e.g. logs still being written) is not sent
+            self.parts.append((file_obj, file_size(file_obj)))
+            self.parts.append(b'\r\n')
+        self.parts.append('--{}--\r\n'.format(self.boundary).encode('utf-8'))
+        self.length = sum(len(p) if isinstance(p, bytes)
+                          else p[1] for p in self.parts)
+        self.bytes_sent = 0
+        self.index = 0
+        self.offset = 0
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary={}'.format(self.boundary)
+
+    def _header(self, name, filename=None):
+        disposition = 'form-data; name="{}"'.format(name)
+        if filename:
+            disposition += '; filename="{}"'.format(filename)
+            return '--{}\r\nContent-Disposition: {}\r\nContent-Type: application/octet-stream\r\n\r\n'.format(
+                self.boundary, disposition).encode('utf-8')
+        return '--{}\r\nContent-Disposition: {}\r\n\r\n'.format(self.boundary, disposition).encode('utf-8')
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.length
+        chunks = []
+        remaining = size
+        while remaining > 0 and self.index < len(self.parts):
+            part = self.parts[self.index]
+            if isinstance(part, bytes):
+                chunk = part[self.offset:self.offset + remaining]
+                size = len(part)
+            else:
+                file_obj, size = part
+                chunk = file_obj.read(min(remaining, size - self.offset))
+            self.offset += len(chunk)
+            if self.offset >= size or not chunk:
+                self.index += 1
+                self.offset = 0
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        data = b''.join(chunks)
+        self.bytes_sent += len(data)
+        return data
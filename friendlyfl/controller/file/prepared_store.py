@@ -0,0 +1,95 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+from friendlyfl.controller.file import file_utils
+
+logger = logging.getLogger(__name__)
+
+prepared_dir = 'prepared'
+
+prepared_meta_name = 'prepared.json'
+
+
+def gen_prepared_url(run_id, fingerprint, variant):
+    if not run_id or not fingerprint:
+        return None
+    return f"{file_utils.base_folder}/{prepared_dir}/{run_id}/{fingerprint}/{variant}/"
+
+
+def dataset_fingerprint(run_id):
+    """
+    Hash of the dataset of a run. Taken from the dataset cache when valid, otherwise computed from the csv
+    :param run_id: run id
+    :return: sha256 hex digest, None if the dataset is absent
+    """
+    meta = file_utils.load_dataset_cache_meta(run_id)
+    if meta:
+        return meta['sha256']
+    csv_url = file_utils.gen_dataset_url(run_id) + file_utils.dataset_name
+    if os.path.exists(csv_url):
+        return file_utils.file_sha256(csv_url)
+    return None
+
+
+def save_prepared(run_id, fingerprint, variant, arrays: dict, params: dict) -> bool:
+    """
+    Persist prepared data of a run, e.g. split indices, scaler parameters and scaled matrices
+    :param run_id: run id
+    :param fingerprint: dataset hash
+    :param variant: kind of preparation, several variants of the same dataset are kept side by side
+    :param arrays: name to array, saved as .npy
+    :param params: json serializable parameters the data was prepared with
+    :return: whether it is saved
+    """
+    url = gen_prepared_url(run_id, fingerprint, variant)
+    if not url:
+        return False
+    target = Path(url)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    temp_dir = tempfile.mkdtemp(dir=target.parent)
+    try:
+        for name, a in arrays.items():
+            np.save(os.path.join(temp_dir, name + '.npy'),
+                    np.asarray(a), allow_pickle=False)
+        with open(os.path.join(temp_dir, prepared_meta_name), 'w') as f:
+            json.dump({'params': params, 'arrays': list(arrays.keys())}, f)
+        if target.exists():
+            shutil.rmtree(target)
+        os.replace(temp_dir, target)
+        return True
+    except Exception as e:
+        logger.warning(
+            "Failed to save prepared data of run {} due to {}".format(run_id, e))
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        return False
+
+
+def load_prepared(run_id, fingerprint, variant, params: dict):
+    """
+    Load prepared data of a run, memory-mapped
+    :param run_id: run id
+    :param fingerprint: dataset hash
+    :param variant: kind of preparation
+    :param params: parameters the data must have been prepared with
+    :return: name to read-only array, None if absent or prepared differently
+    """
+    url = gen_prepared_url(run_id, fingerprint, variant)
+    if not url:
+        return None
+    try:
+        with open(url + prepared_meta_name, 'r') as f:
+            meta = json.load(f)
+        if meta['params'] != params:
+            return None
+        return {name: np.load(url + name + '.npy', mmap_mode='r', allow_pickle=False)
+                for name in meta['arrays']}
+    except (FileNotFoundError, ValueError, KeyError) as e:
+        logger.debug(
+            "Prepared data of run {} is not available: {}".format(run_id, e))
+        return None
@@ -0,0 +1,141 @@
+import mmap
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+terminal_status = ['success', 'failed']
+
+
+def resident_bytes(v) -> int:
+    """
+    Bytes an array keeps in memory. Memory mapped arrays, including views on a mapped artifact, are backed by a file
+    and not counted.
+    :param v: any value
+    :return: size in bytes
+    """
+    if not isinstance(v, np.ndarray):
+        return 0
+    base = v
+    while base is not None:
+        if isinstance(base, (np.memmap, mmap.mmap)) or getattr(base, 'filename', None):
+            return 0
+        base = base.obj if isinstance(base, memoryview) else getattr(base, 'base', None)
+    return v.nbytes
+
+
+def instance_size(instance) -> int:
+    """
+    Estimate memory footprint of a task instance from the numpy arrays it holds
+    :param instance: task instance
+    :return: size in bytes
+    """
+    size = 0
+    for v in vars(instance).values():
+        if isinstance(v, (list, tuple)):
+            size += sum(resident_bytes(i) for i in v)
+        else:
+            size += resident_bytes(v)
+    return size
+
+
+class ModelCache:
+    """
+    Cache of task instances with LRU eviction, TTL expiry and a memory budget.
+    Keys are '{run_id}_{cur_seq}'.
+    """
+
+    def __init__(self, max_entries=32, ttl=86400, max_bytes=2 * 1024 ** 3, sizeof=instance_size):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry['expire_at'] < time.monotonic():
+                if entry is not None:
+                    self._evict(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            entry['expire_at'] = time.monotonic() + self.ttl
+            self.hits += 1
+            return entry['instance']
+
+    def put(self, key, instance):
+        with self.lock:
+            self.entries[key] = {'instance': instance,
+                                 'size': self.sizeof(instance),
+                                 'expire_at': time.monotonic() + self.ttl}
+            self.entries.move_to_end(key)
+            self._shrink(keep=key)
+
+    def refresh(self, key):
+        """
+        Re-measure an instance after it loaded or released data, then apply the budget
+        :param key: cache key
+        :return:
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                entry['size'] = self.sizeof(entry['instance'])
+                self._shrink(keep=key)
+
+    def evict(self, key):
+        with self.lock:
+            if key in self.entries:
+                self._evict(key)
+
+    def evict_run(self, run_id):
+        """
+        Evict all instances of a run, e.g. when it reaches a terminal status
+        :param run_id: run id
+        :return:
+        """
+        prefix = '{}_'.format(run_id)
+        with self.lock:
+            for key in [k for k in self.entries if k.startswith(prefix)]:
+                self._evict(key)
+
+    def size(self) -> int:
+        with self.lock:
+            return sum(e['size'] for e in self.entries.values())
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'entries': len(self.entries),
+                    'bytes': sum(e['size'] for e in self.entries.values()),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
+    def _evict(self, key):
+        self.entries.pop(key)
+        self.evictions += 1
+
+    def _shrink(self, keep=None):
+        now = time.monotonic()
+        for key in [k for k, e in self.entries.items() if e['expire_at'] < now and k != keep]:
+            self._evict(key)
+        total = sum(e['size'] for e in self.entries.values())
+        # evict least recently used first, but never the entry just used
+        for key in list(self.entries.keys()):
+            if len(self.entries) <= self.max_entries and total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= self.entries[key]['size']
+            self._evict(key)
+
+
+def is_terminal(status) -> bool:
+    return status in terminal_status
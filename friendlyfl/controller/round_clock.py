@@ -0,0 +1,36 @@
+import time
+
+from friendlyfl.controller import redis
+
+round_key = 'friendlyfl:controller:round:start:'
+
+round_ttl = 86400
+
+
+class RoundClock:
+    """
+    Start time of task rounds kept in redis, shared by all workers of the site.
+    The first worker marking a round wins, later marks of the same round are ignored.
+    """
+
+    def __init__(self, prefix=round_key, ttl=round_ttl):
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def key(self, run_id, task_seq, round_seq):
+        return '{}{}:{}:{}'.format(self.prefix, run_id, task_seq, round_seq)
+
+    def mark(self, run_id, task_seq, round_seq):
+        """
+        Record now as the start of a round unless it is already recorded
+        """
+        redis.get_redis().set(self.key(run_id, task_seq, round_seq),
+                              time.time(), nx=True, ex=self.ttl)
+
+    def elapsed(self, run_id, task_seq, round_seq) -> float:
+        """
+        :return: seconds since the start of a round. A round without a start starts now
+        """
+        self.mark(run_id, task_seq, round_seq)
+        start = redis.get_redis().get(self.key(run_id, task_seq, round_seq))
+        return time.time() - float(start) if start is not None else 0.0
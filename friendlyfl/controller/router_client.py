@@ -0,0 +1,135 @@
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from friendlyfl.settings import ROUTER_CONNECT_TIMEOUT, ROUTER_READ_TIMEOUT, ROUTER_MAX_RETRIES, \
+    ROUTER_RETRY_BACKOFF, ROUTER_POOL_SIZE
+
+# take environment variables from .env.
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# read vars from env
+router_url = os.getenv('ROUTER_URL')
+router_username = os.getenv('ROUTER_USERNAME')
+router_password = os.getenv('ROUTER_PASSWORD')
+
+# PUT is left out on purpose: status updates with increase_round are not idempotent.
+# Connection errors are still retried for every method as the request never reached the router.
+idempotent_methods = frozenset(['GET', 'HEAD', 'OPTIONS', 'DELETE'])
+
+# A timeout is raised to the status handler, which fails the run instead of retrying the transition:
+# a timed out status update may have been applied already. Hence the generous read timeout.
+default_timeout = (ROUTER_CONNECT_TIMEOUT, ROUTER_READ_TIMEOUT)
+
+
+class LatencyStats:
+    """
+    Count, errors, total and max latency of router calls per endpoint.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = dict()
+
+    def record(self, endpoint, elapsed, ok):
+        with self.lock:
+            s = self.endpoints.setdefault(
+                endpoint, {'count': 0, 'errors': 0, 'total': 0.0, 'max': 0.0})
+            s['count'] += 1
+            s['total'] += elapsed
+            s['max'] = max(s['max'], elapsed)
+            if not ok:
+                s['errors'] += 1
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {k: dict(v, avg=v['total'] / v['count']) for k, v in self.endpoints.items()}
+
+
+stats = LatencyStats()
+
+
+def new_session() -> requests.Session:
+    retry = Retry(total=ROUTER_MAX_RETRIES,
+                  backoff_factor=ROUTER_RETRY_BACKOFF,
+                  status_forcelist=(502, 503, 504),
+                  allowed_methods=idempotent_methods,
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=ROUTER_POOL_SIZE,
+                          pool_maxsize=ROUTER_POOL_SIZE,
+                          max_retries=retry)
+    s = requests.Session()
+    s.auth = (router_username, router_password)
+    s.mount('http://', adapter)
+    s.mount('https://', adapter)
+    return s
+
+
+session = new_session()
+
+# used to send independent calls concurrently
+executor = ThreadPoolExecutor(
+    max_workers=ROUTER_POOL_SIZE, thread_name_prefix='router-client')
+
+
+def endpoint_of(method, path):
+    """
+    Example: GET /runs/12/status/?a=1 -> GET /runs/{id}/status/
+    """
+    path = path.split('?', 1)[0]
+    return '{} {}'.format(method, re.sub(r'/\d+(?=/|$)', '/{id}', path))
+
+
+def request(method, path, **kwargs) -> requests.Response:
+    """
+    Send a request to router through the shared session
+    :param method: http method
+    :param path: path relative to ROUTER_URL, e.g. /runs/active/
+    :param kwargs: arguments of requests, timeout defaults to ROUTER_CONNECT_TIMEOUT and ROUTER_READ_TIMEOUT
+    :return: response
+    """
+    kwargs.setdefault('timeout', default_timeout)
+    endpoint = endpoint_of(method, path)
+    start = time.monotonic()
+    ok = False
+    try:
+        response = session.request(method, router_url + path, **kwargs)
+        ok = response.ok
+        return response
+    finally:
+        stats.record(endpoint, time.monotonic() - start, ok)
+
+
+def get(path, **kwargs) -> requests.Response:
+    return request('GET', path, **kwargs)
+
+
+def post(path, **kwargs) -> requests.Response:
+    return request('POST', path, **kwargs)
+
+
+def put(path, **kwargs) -> requests.Response:
+    return request('PUT', path, **kwargs)
+
+
+def delete(path, **kwargs) -> requests.Response:
+    return request('DELETE', path, **kwargs)
+
+
+def gather(*paths) -> list:
+    """
+    GET independent paths concurrently
+    :param paths: paths relative to ROUTER_URL
+    :return: responses in the same order as paths
+    """
+    futures = [executor.submit(get, path) for path in paths]
+    return [f.result() for f in futures]
@@ -0,0 +1,293 @@
+"""
+A local stand-in of friendlyfl-router for development and testing.
+It keeps runs in memory, serves the run endpoints used by the controller and pushes run change events.
+
+Usage: python -m friendlyfl.controller.router_stub --port 9000
+Then point ROUTER_URL of the controller to http://127.0.0.1:9000
+"""
+import argparse
+import copy
+import hashlib
+import io
+import json
+import threading
+import zipfile
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+status_names = {0: 'Failed', 1: 'Pending Failed', 2: 'Standby', 3: 'Preparing', 4: 'Running',
+                5: 'Pending Success', 6: 'Pending Aggregating', 7: 'Aggregating', 8: 'Success'}
+
+
+class RouterStub:
+    """
+    In-memory router holding runs. Start it in-process with start() or run it standalone.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, prefix='', heartbeat=15):
+        self.prefix = prefix.rstrip('/')
+        self.heartbeat = heartbeat
+        self.runs = dict()
+        # (run, task_seq, round_seq) to field name to (file name, content)
+        self.uploads = dict()
+        self.version = 0
+        self.changed = threading.Condition()
+        self.stopped = False
+        self.server = ThreadingHTTPServer((host, port), _handler(self))
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}{}'.format(host, port, self.prefix)
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        with self.changed:
+            self.stopped = True
+            self.changed.notify_all()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def add_run(self, run):
+        with self.changed:
+            self.runs[run['id']] = run
+            self._touch()
+
+    def set_status(self, run_id, status, update_all=False, increase_round=False):
+        """
+        :param update_all: also set the status of the other runs of the same batch, as coordinators do
+        :param increase_round: move the runs to the next round of their current task
+        """
+        with self.changed:
+            run = self.runs[run_id]
+            targets = self.batch_runs(run['project'], run['batch']) if update_all else [run]
+            for r in targets:
+                r = self.runs[r['id']]
+                r['status'] = status_names[status] if isinstance(
+                    status, int) else status
+                if increase_round:
+                    r['tasks'][r['cur_seq'] - 1]['config']['current_round'] += 1
+            self._touch()
+
+    def add_upload(self, run_id, task_seq, round_seq, files):
+        with self.changed:
+            self.uploads.setdefault(
+                (run_id, task_seq, round_seq), dict()).update(files)
+
+    def active_runs(self, site_uid=None):
+        with self.changed:
+            return [copy.deepcopy(r) for r in self.runs.values()
+                    if site_uid is None or r.get('site_uid') == site_uid]
+
+    def batch_runs(self, project, batch):
+        with self.changed:
+            return [copy.deepcopy(r) for r in self.runs.values()
+                    if str(r.get('project')) == str(project) and str(r.get('batch')) == str(batch)]
+
+    def download(self, run_id, task_seq, round_seq, all_runs, kind):
+        """
+        Zip the uploaded files of a kind, named <run>-<task_seq>-<round_seq>-<kind> like the router does.
+        Artifacts are uploaded by the coordinator and are shared by every run of the batch.
+        :return: (zip content, ETag of the zipped files), None if nothing is uploaded
+        """
+        run = self.runs.get(run_id)
+        if run is None:
+            return None
+        if all_runs or kind == 'artifacts':
+            run_ids = [r['id'] for r in self.batch_runs(run['project'], run['batch'])]
+        else:
+            run_ids = [run_id]
+        field = kind.replace('-', '_')
+        buffer = io.BytesIO()
+        digest = hashlib.sha256()
+        found = False
+        with self.changed, zipfile.ZipFile(buffer, 'w') as z:
+            for r in run_ids:
+                uploaded = self.uploads.get((r, task_seq, round_seq), dict())
+                if field in uploaded:
+                    name = '{}-{}-{}-{}'.format(r, task_seq, round_seq, kind.replace('_', '-'))
+                    z.writestr(name, uploaded[field][1])
+                    digest.update(name.encode('utf-8'))
+                    digest.update(hashlib.sha256(uploaded[field][1]).digest())
+                    found = True
+        return (buffer.getvalue(), '"{}"'.format(digest.hexdigest())) if found else None
+
+    def wait_change(self, version, timeout):
+        """
+        Block until runs change after version or timeout
+        :return: current version
+        """
+        with self.changed:
+            if self.version == version and not self.stopped:
+                self.changed.wait(timeout)
+            return self.version
+
+    def _touch(self):
+        self.version += 1
+        self.changed.notify_all()
+
+
+def _handler(stub):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def route(self):
+            parsed = urlparse(self.path)
+            path = parsed.path
+            if stub.prefix and path.startswith(stub.prefix):
+                path = path[len(stub.prefix):]
+            query = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+            return path.strip('/').split('/'), query
+
+        def read_body(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            return self.rfile.read(length) if length else b''
+
+        def send_json(self, obj, code=200):
+            body = json.dumps(obj).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_bytes(self, body, content_type='application/octet-stream', etag=None):
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            if etag:
+                self.send_header('ETag', etag)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_empty(self, code):
+            self.send_response(code)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def do_GET(self):
+            parts, query = self.route()
+            self.read_body()
+            if parts == ['runs', 'active']:
+                self.send_json(stub.active_runs())
+            elif parts == ['runs', 'events']:
+                self.stream_events(query.get('site_uid'))
+            elif parts == ['runs', 'detail']:
+                self.send_json({'runs': stub.batch_runs(query.get('project'), query.get('batch'))})
+            elif parts == ['runs-action', 'download']:
+                body = stub.download(int(query['run']), int(query['task_seq']), int(query['round_seq']),
+                                     query.get('all_runs') in ('1', 'true', 'True'), query.get('type', 'artifacts'))
+                if body is None:
+                    self.send_empty(404)
+                elif self.headers.get('If-None-Match') == body[1]:
+                    self.send_empty(304)
+                else:
+                    self.send_bytes(body[0], 'application/zip', etag=body[1])
+            else:
+                self.send_empty(404)
+
+        def do_PUT(self):
+            parts, query = self.route()
+            body = self.read_body()
+            if len(parts) == 3 and parts[0] == 'runs' and parts[2] == 'status':
+                run_id = int(parts[1])
+                if run_id not in stub.runs:
+                    self.send_empty(404)
+                    return
+                param = json.loads(body)
+                stub.set_status(run_id, param['status'], bool(param.get('update_all')),
+                                bool(param.get('increase_round')))
+                self.send_json({'id': run_id})
+            else:
+                self.send_empty(404)
+
+        def do_POST(self):
+            parts, query = self.route()
+            body = self.read_body()
+            if parts == ['sites', 'heartbeat']:
+                self.send_empty(200)
+            elif parts == ['runs-action', 'upload']:
+                fields, files = self.parse_multipart(body)
+                stub.add_upload(int(fields['run']), int(fields['task_seq']), int(fields['round_seq']), files)
+                self.send_json({'success': True})
+            else:
+                self.send_empty(404)
+
+        def parse_multipart(self, body):
+            message = BytesParser(policy=HTTP).parsebytes(
+                'Content-Type: {}\r\n\r\n'.format(self.headers['Content-Type']).encode('utf-8') + body)
+            fields = dict()
+            files = dict()
+            for part in message.iter_parts():
+                name = part.get_param('name', header='content-disposition')
+                filename = part.get_filename()
+                content = part.get_payload(decode=True)
+                if filename:
+                    files[name] = (filename, content)
+                else:
+                    fields[name] = content.decode('utf-8')
+            return fields, files
+
+        def write_chunk(self, body):
+            self.wfile.write('{:x}\r\n'.format(len(body)).encode('ascii') + body + b'\r\n')
+            self.wfile.flush()
+
+        def stream_events(self, site_uid):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Connection', 'close')
+            # chunked like a streaming response of the router, so each event is readable as soon as it is sent
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            self.close_connection = True
+            version = None
+            try:
+                while not stub.stopped:
+                    if version is None or version != stub.version:
+                        version = stub.version
+                        data = json.dumps(stub.active_runs(site_uid))
+                        self.write_chunk('id: {}\nevent: runs\ndata: {}\n\n'.format(
+                            version, data).encode('utf-8'))
+                    else:
+                        self.write_chunk(b': keep-alive\n\n')
+                    stub.wait_change(version, stub.heartbeat)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in of friendlyfl-router')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--prefix', default='')
+    parser.add_argument('--runs', help='json file with initial runs')
+    args = parser.parse_args()
+    stub = RouterStub(args.host, args.port, args.prefix)
+    if args.runs:
+        with open(args.runs) as f:
+            for run in json.load(f):
+                stub.add_run(run)
+    print('Router stub listening on {}'.format(stub.url))
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        stub.stop()
+
+
+if __name__ == '__main__':
+    main()
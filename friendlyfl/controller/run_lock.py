@@ -0,0 +1,83 @@
+import logging
+import threading
+from contextlib import contextmanager
+
+from redis.exceptions import LockError
+
+from friendlyfl.controller import redis
+from friendlyfl.controller.utils import format_status
+
+logger = logging.getLogger(__name__)
+
+lock_key = 'friendlyfl:controller:run:lock:'
+
+done_key = 'friendlyfl:controller:run:done:'
+
+lock_ttl = 60
+
+done_ttl = 86400
+
+
+def transition_key(run) -> str:
+    """
+    Identity of a state transition of a run: run id, task seq, round of the task and status
+    """
+    seq = run['cur_seq']
+    config = run['tasks'][seq - 1].get('config') or dict()
+    return '{}:{}:{}:{}'.format(run['id'], seq, config.get('current_round'), format_status(run['status']))
+
+
+class RunGuard:
+    """
+    Cluster-wide guard of state transitions kept in redis.
+    A lock per run lets a single worker handle the run at a time, it is renewed while the handler runs and expires
+    after lock_ttl seconds if the worker dies. A done key per transition lets each transition be handled once.
+    """
+
+    def __init__(self, lock_prefix=lock_key, done_prefix=done_key, lock_ttl=lock_ttl, done_ttl=done_ttl):
+        self.lock_prefix = lock_prefix
+        self.done_prefix = done_prefix
+        self.lock_ttl = lock_ttl
+        self.done_ttl = done_ttl
+
+    def is_done(self, run) -> bool:
+        return bool(redis.get_redis().exists(self.done_prefix + transition_key(run)))
+
+    def mark_done(self, run):
+        redis.get_redis().set(self.done_prefix + transition_key(run), 1, ex=self.done_ttl)
+
+    @contextmanager
+    def locked(self, run_id, wait=0):
+        """
+        Try to take the lock of a run
+        :param wait: seconds to wait for the lock, 0 to give up right away
+        :return: context manager yielding whether the lock is held
+        """
+        # the token is shared with the thread renewing the lock
+        lock = redis.get_redis().lock(self.lock_prefix + str(run_id), timeout=self.lock_ttl, thread_local=False)
+        if not lock.acquire(blocking=wait > 0, blocking_timeout=wait if wait > 0 else None):
+            yield False
+            return
+        stop = threading.Event()
+        keeper = threading.Thread(target=self.keep, args=(lock, stop), daemon=True)
+        keeper.start()
+        try:
+            yield True
+        finally:
+            stop.set()
+            keeper.join()
+            try:
+                lock.release()
+            except LockError:
+                logger.warning('Lock of run {} expired before it was released'.format(run_id))
+
+    def keep(self, lock, stop: threading.Event):
+        """
+        Reset the ttl of a held lock until stop is set
+        """
+        while not stop.wait(self.lock_ttl / 3):
+            try:
+                lock.reacquire()
+            except LockError as e:
+                logger.warning('Failed to renew lock {}: {}'.format(lock.name, e))
+                return
@@ -0,0 +1,87 @@
+from friendlyfl.controller import redis
+from friendlyfl.controller.utils import format_status
+
+run_key = 'friendlyfl:controller:run:list:'
+
+run_ttl = 86400
+
+
+class RunStateStore:
+    """
+    Last seen status of runs kept in redis.
+    Only the formatted status is stored per run. Reads and writes of a whole batch of runs
+    take one round-trip each, regardless of the number of runs.
+    """
+
+    def __init__(self, prefix=run_key, ttl=run_ttl):
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def key(self, run_id):
+        return self.prefix + str(run_id)
+
+    def snapshot(self, runs) -> dict:
+        """
+        Fetch last seen status of runs with a single MGET
+        :param runs: run models
+        :return: dict of run id to formatted status, None if never seen
+        """
+        if not runs:
+            return dict()
+        r = redis.get_redis()
+        values = r.mget([self.key(run['id']) for run in runs])
+        return {run['id']: v.decode('utf-8') if v is not None else None for run, v in zip(runs, values)}
+
+    def save(self, runs):
+        """
+        Store status of runs with a single pipeline
+        :param runs: run models
+        :return:
+        """
+        if not runs:
+            return
+        pipe = redis.get_redis().pipeline(transaction=False)
+        for run in runs:
+            pipe.set(self.key(run['id']), format_status(
+                run['status']) or '', ex=self.ttl)
+        pipe.execute()
+
+    def diff(self, runs) -> []:
+        """
+        Compare runs with last seen status and store the changed ones
+        :param runs: run models
+        :return: runs which are new or whose status changed
+        """
+        snapshot = self.snapshot(runs)
+        changed = [run for run in runs if snapshot[run['id']]
+                   != (format_status(run['status']) or '')]
+        self.save(changed)
+        return changed
+
+    def remove(self, run_id):
+        redis.get_redis().delete(self.key(run_id))
+
+    def forget(self, runs):
+        """
+        Remove stored status of runs with a single delete, so they are seen as changed next time
+        :param runs: run models
+        :return:
+        """
+        if runs:
+            redis.get_redis().delete(*[self.key(run['id']) for run in runs])
+
+    def reset(self, batch_size=500):
+        """
+        Remove all stored runs, deleting keys in bulk
+        :param batch_size: number of keys per delete
+        :return:
+        """
+        r = redis.get_redis()
+        keys = []
+        for key in r.scan_iter(match=self.prefix + '*', count=batch_size):
+            keys.append(key)
+            if len(keys) >= batch_size:
+                r.unlink(*keys)
+                keys = []
+        if keys:
+            r.unlink(*keys)
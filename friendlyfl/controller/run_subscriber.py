@@ -0,0 +1,99 @@
+import json
+import logging
+import os
+import time
+
+import requests
+from dotenv import load_dotenv
+
+from friendlyfl.controller import router_client
+from friendlyfl.settings import RUN_SUBSCRIPTION_ENABLED, RUN_SUBSCRIPTION_HEARTBEAT, ROUTER_CONNECT_TIMEOUT
+
+# take environment variables from .env.
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# read vars from env
+site_uid = os.getenv('SITE_UID')
+
+max_backoff = 60
+
+
+def parse_events(lines):
+    """
+    Parse a server-sent events stream into (event, data) pairs
+    :param lines: decoded lines of the stream
+    :return: generator of event name and data
+    """
+    event = None
+    data = []
+    for line in lines:
+        if line is None:
+            continue
+        if line == '':
+            if data:
+                yield event or 'message', '\n'.join(data)
+            event = None
+            data = []
+        elif line.startswith(':'):
+            # comment, used by router as keep-alive
+            continue
+        else:
+            field, _, value = line.partition(':')
+            if value.startswith(' '):
+                value = value[1:]
+            if field == 'event':
+                event = value
+            elif field == 'data':
+                data.append(value)
+
+
+def subscribe(on_runs, should_stop=None):
+    """
+    Subscribe to run change events of current site and call on_runs with active runs of every event.
+    Reconnect with exponential backoff when the stream is broken.
+    :param on_runs: callback receiving list of active runs
+    :param should_stop: optional callable, stop subscribing when it returns True
+    :return:
+    """
+    backoff = 1
+    while not (should_stop and should_stop()):
+        try:
+            with router_client.get('/runs/events/?site_uid={0}'.format(site_uid),
+                                   headers={'Accept': 'text/event-stream'},
+                                   stream=True,
+                                   timeout=(ROUTER_CONNECT_TIMEOUT, RUN_SUBSCRIPTION_HEARTBEAT * 3)) as response:
+                if not response.ok:
+                    logger.warning('Failed to subscribe run events due to {}'.format(
+                        response.status_code))
+                else:
+                    logger.debug('Subscribed to run events of site {}'.format(site_uid))
+                    backoff = 1
+                    for event, data in parse_events(response.iter_lines(decode_unicode=True)):
+                        if event == 'runs':
+                            runs = json.loads(data)
+                            on_runs(runs if isinstance(runs, list) else [runs])
+                        if should_stop and should_stop():
+                            return
+        except (requests.RequestException, ValueError) as e:
+            logger.warning('Run event stream broken due to {}'.format(e))
+        time.sleep(backoff)
+        backoff = min(backoff * 2, max_backoff)
+
+
+def main(should_stop=None):
+    if not RUN_SUBSCRIPTION_ENABLED:
+        logger.info('Run subscription is disabled. Runs are fetched by fetch_run only')
+        return
+
+    from friendlyfl.controller.dispatch import check_status_change, dispatch_runs
+
+    def on_runs(runs):
+        dispatch_runs(check_status_change(site_uid, runs))
+
+    subscribe(on_runs, should_stop)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    main()
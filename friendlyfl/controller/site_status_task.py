@@ -6,13 +6,12 @@ import os
 import requests
 from dotenv import load_dotenv
 
+from friendlyfl.controller import router_client
+
 load_dotenv()
 logger = logging.getLogger(__name__)
 
 site_uid = os.getenv('SITE_UID')
-router_url = os.getenv('ROUTER_URL')
-router_username = os.getenv('ROUTER_USERNAME')
-router_password = os.getenv('ROUTER_PASSWORD')
 
 
 def report_alive():
@@ -28,10 +27,13 @@ def send_status(status):
         data = dict()
         data['uid'] = site_uid
         data['status'] = status
-        response = requests.post('{0}/sites/heartbeat/'.format(router_url),
-                                 headers={'Content-Type': 'application/json'},
-                                 auth=(router_username, router_password),
-                                 data=json.dumps(data))
+        try:
+            response = router_client.post('/sites/heartbeat/',
+                                          headers={'Content-Type': 'application/json'},
+                                          data=json.dumps(data))
+        except requests.RequestException as e:
+            logger.debug('Failed to reach router due to {}'.format(e))
+            response = None
         if not response or not response.ok:
             logger.debug(
                 'Failed to report status {}  of site {}'.format(status, site_uid))
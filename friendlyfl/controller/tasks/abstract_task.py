@@ -1,26 +1,50 @@
 import inspect
 import json
 import logging
+import math
 import os
+import time
 import traceback
 from abc import ABC, abstractmethod
+from contextlib import ExitStack
+from pathlib import Path
 
-import requests
+import numpy as np
 from dotenv import load_dotenv
 
+from friendlyfl.controller import router_client
+from friendlyfl.controller.batch_snapshot import BatchSnapshotCache
+from friendlyfl.controller.round_clock import RoundClock
 from friendlyfl.controller.file import file_utils
+from friendlyfl.controller.file.artifact_format import save_artifact, load_artifact
 from friendlyfl.controller.file.file_utils import read_file_from_url, gen_logs_url, download_all_mid_artifacts, \
-    gen_mid_artifacts_url, create_if_not_exist, gen_artifacts_url, download_artifacts
+    gen_mid_artifacts_url, create_if_not_exist, gen_artifacts_url, download_artifacts, gen_all_mid_artifacts_url, \
+    download_run_mid_artifacts, gen_run_mid_artifacts_url, gen_running_aggregate_url, downloaded_artifacts_url, \
+    gen_server_state_url, gen_partial_mid_artifacts_url
+from friendlyfl.controller.file.multipart import MultipartStream, compress, compression_suffix
+from friendlyfl.controller.tasks.aggregation import RunningAggregate, ServerMomentum, FedBuff, parse_aggregator, \
+    linear_aggregators, reduce_updates, late_key, parse_late_key, sub_aggregators
+from friendlyfl.controller.tasks.local_training import LocalSchedule
+from friendlyfl.controller.tasks.update_codec import parse_encoding, encode_update, decode_update, is_encoded
 # take environment variables from .env.
 from friendlyfl.controller.utils import format_status
+from friendlyfl.settings import ROUTER_UPLOAD_COMPRESSION, BATCH_SNAPSHOT_TTL
 
 load_dotenv()
 
 # read vars from env
 site_uid = os.getenv('SITE_UID')
-router_url = os.getenv('ROUTER_URL')
-router_username = os.getenv('ROUTER_USERNAME')
-router_password = os.getenv('ROUTER_PASSWORD')
+
+round_clock = RoundClock()
+
+batch_snapshots = BatchSnapshotCache(ttl=BATCH_SNAPSHOT_TTL)
+
+
+def run_round(run):
+    """
+    :return: current round of the current task of a run
+    """
+    return run['tasks'][run['cur_seq'] - 1]['config']['current_round']
 
 
 class AbstractTask(ABC):
@@ -37,6 +61,15 @@ class AbstractTask(ABC):
     artifact = None
     status = None
     logger = None
+    model_version = None
+    schedule = None
+    prepared_round = None
+    trained_round = None
+    # runs of the batch fetched during the current event, None outside of events
+    event_runs = None
+    in_event = False
+    # whether the task can publish global model versions from buffered updates, i.e. run with mode: async
+    supports_async = True
 
     def __init__(self, run):
         self.project_id = run['project']
@@ -49,7 +82,14 @@ class AbstractTask(ABC):
     def method_call(self, name: str, *args, **kwargs):
         if hasattr(self, name) and callable(getattr(self, name)):
             func = getattr(self, name)
-            func(*args, **kwargs)
+            # the checks of an event share one snapshot of the runs of the batch
+            self.in_event = True
+            self.event_runs = None
+            try:
+                func(*args, **kwargs)
+            finally:
+                self.in_event = False
+                self.event_runs = None
         else:
             self.logger.warning("method {} not exists".format(name))
 
@@ -91,13 +131,15 @@ class AbstractTask(ABC):
             s = inspect.currentframe().f_code.co_name
             if self.role == 'coordinator':
                 self.status = s
-                if self.runs_in_fails() or not self.prepare_data():
+                if self.runs_in_fails() or not self.ensure_prepared():
                     self.notify(1, param={'update_all': True})
                     return
-                if self.runs_in_same_state('preparing'):
+                if self.is_async():
+                    self.notify(4)
+                elif self.runs_in_same_state('preparing'):
                     self.notify(4, param={'update_all': True})
             else:
-                if not self.prepare_data():
+                if not self.ensure_prepared():
                     self.notify(1, param={'update_all': False})
                     return
                 if self.status == s:
@@ -106,6 +148,9 @@ class AbstractTask(ABC):
                     return
                 else:
                     self.status = s
+                if self.is_async():
+                    # no barrier in async mode, training starts once the latest global model is loaded
+                    self.notify(4)
         except Exception as e:
             self.logger.warning("Exception in preparing status: {}".format(e))
             self.notify(1, param={'update_all': True})
@@ -116,18 +161,37 @@ class AbstractTask(ABC):
         Next Status: Pending Success,5;Pending Failed,1
         Called when all participants have prepared to run.
         In this event, input data files are used for training.
+        Local training runs under the schedule of local_schedule, within the round deadline if any.
+        It runs on a compute worker, which prepares the data of the round itself when preparing ran elsewhere.
         """
         try:
+            if args:
+                self.post_init(args[0])
             s = inspect.currentframe().f_code.co_name
-            if self.status == s:
+            # a compute worker only sees the compute statuses, so duplicates are told apart by round
+            key = (self.cur_seq, self.get_round())
+            if self.status == s and self.trained_round == key:
                 self.logger.warning(
                     "Already in status {}. Ignore message".format(s))
                 return
             else:
                 self.status = s
+                self.trained_round = key
+
+            if not self.ensure_prepared():
+                self.notify(1)
+                return
 
+            if self.role == 'coordinator':
+                round_clock.mark(self.run_id, self.cur_seq, self.get_round())
+            self.schedule = self.local_schedule().start(self.round_deadline())
             valid = self.training()
-            if valid:
+            if valid and (self.round_deadline() or self.is_async()) and self.is_superseded():
+                # the round went on without this run, its update is left for the next round
+                self.logger.info("Round {} has moved on, uploading the late update only".format(
+                    self.get_round()))
+                self.upload(False)
+            elif valid:
                 self.notify(5)
             else:
                 self.notify(1)
@@ -142,9 +206,13 @@ class AbstractTask(ABC):
         Next Status: Pending Aggregating,6; Standby,2
         Called when current participant successfully completes the task.
         In this event, output file and file will be uploaded to RS for forwarding to Coordinator.
+        A sub-aggregator waits for the updates of its group and uploads their partial aggregate instead.
         """
         try:
-            if self.upload(False):
+            if self.role != 'coordinator' and self.group_members():
+                if self.upload_partial_aggregate():
+                    self.notify(6)
+            elif self.upload(False):
                 self.notify(6)
         except Exception as e:
             self.logger.warning(
@@ -155,7 +223,9 @@ class AbstractTask(ABC):
         Status: Pending Aggregating, 6
         Next Status: Aggregating, 7; Failed, 0
         Participant: Do nothing
-        Coordinator: Waiting for all participants been changed to this status and download the artifacts
+        Coordinator: Waiting for all participants been changed to this status and download the artifacts.
+        In incremental aggregation mode, the update of each participant is folded as soon as it arrives.
+        In async mode, the coordinator stays in this status and publishes a new global model every buffer_size updates
         :return:
         """
         try:
@@ -164,7 +234,14 @@ class AbstractTask(ABC):
                 self.status = s
                 if self.runs_in_fails():
                     self.notify(0, param={'update_all': True})
-                if self.runs_in_same_state('pending_aggregating') and self.download_mid_artifacts():
+                if self.is_async():
+                    if args:
+                        self.post_init(args[0])
+                    self.buffer_updates()
+                elif self.is_incremental_aggregation():
+                    if self.fold_arrived_updates():
+                        self.notify(7, param={'update_all': True})
+                elif self.runs_in_same_state('pending_aggregating') and self.download_mid_artifacts():
                     self.notify(7, param={'update_all': True})
             else:
                 if self.status == s:
@@ -187,6 +264,8 @@ class AbstractTask(ABC):
         :return:
         """
         try:
+            if args:
+                self.post_init(args[0])
             s = inspect.currentframe().f_code.co_name
             if self.role == 'coordinator':
                 self.status = s
@@ -244,78 +323,535 @@ class AbstractTask(ABC):
 
     def download_mid_artifacts(self) -> bool:
         """
+        Download the mid-artifacts of all runs of the round. The request is conditional on the ETag of the last
+        download of the round, so retries transfer nothing while no update arrived, and unchanged files are
+        not extracted again
         :return:
         """
         task_round = self.get_round()
         if task_round:
             self.logger.debug("Downloading mid_artifacts")
-            response = requests.get(
-                '{0}/runs-action/download/?run={1}&task_seq={2}&round_seq={3}&all_runs={4}&type=mid_artifacts'.format(
-                    router_url,
-                    self.run_id,
-                    self.cur_seq,
-                    task_round,
-                    1),
-                auth=(router_username, router_password))
+            key = '{}-{}'.format(self.cur_seq, task_round)
+            etag = file_utils.cached_etag(gen_all_mid_artifacts_url(self.project_id, self.batch_id), key)
+            with router_client.get(
+                    '/runs-action/download/?run={0}&task_seq={1}&round_seq={2}&all_runs={3}&type=mid_artifacts'.format(
+                        self.run_id,
+                        self.cur_seq,
+                        task_round,
+                        1),
+                    headers={'If-None-Match': etag} if etag else None,
+                    stream=True) as response:
 
-            if response.status_code == 404:
-                self.logger.warning('No mid-artifacts found in router for project {} at batch {}'.format(
-                    self.project_id, self.batch_id))
-                return False
+                if response.status_code == 304:
+                    self.logger.debug('Mid-artifacts of project {} at batch {} are unchanged'.format(
+                        self.project_id, self.batch_id))
+                    return True
+
+                if response.status_code == 404:
+                    self.logger.warning('No mid-artifacts found in router for project {} at batch {}'.format(
+                        self.project_id, self.batch_id))
+                    return False
 
-            if response.status_code == 200:
-                content = response.content
-                self.logger.debug(
-                    'Saving all mid-artifacts to local for project {} at batch {}'.format(self.project_id,
-                                                                                          self.batch_id))
-                saved_url = download_all_mid_artifacts(
-                    self.project_id, self.batch_id, content)
-                if saved_url:
+                if response.status_code == 200:
                     self.logger.debug(
-                        'Successfully download and save all mid-artifacts to local for project {} at batch {} in {} dir'.format(
-                            self.project_id, self.batch_id, saved_url))
-                    return True
-                self.logger.warning('Failed to save mid-artifacts to local for project {} at batch {}'.format(
-                    self.project_id, self.batch_id))
+                        'Saving all mid-artifacts to local for project {} at batch {}'.format(self.project_id,
+                                                                                              self.batch_id))
+                    saved_url = download_all_mid_artifacts(
+                        self.project_id, self.batch_id, response.iter_content(file_utils.download_chunk_size),
+                        key, response.headers.get('ETag'))
+                    if saved_url:
+                        self.logger.debug(
+                            'Successfully download and save all mid-artifacts to local for project {} at batch {} in {} dir'.format(
+                                self.project_id, self.batch_id, saved_url))
+                        return True
+                    self.logger.warning('Failed to save mid-artifacts to local for project {} at batch {}'.format(
+                        self.project_id, self.batch_id))
         return False
 
     def download_artifact(self) -> bool:
-        """ Download artifact of the last run
+        """ Download artifact of the last run, or of the latest global model version in async mode
         :return:
         """
-        seq_no, round_no = self.get_previous_seq_and_round()
+        if self.is_async():
+            self.model_version = self.latest_global_version()
+        seq_no, round_no = self.previous_global_ref()
+        return self.download_global(seq_no, round_no)
+
+    def download_global(self, seq_no, round_no) -> bool:
+        """
+        Download the global model published at a round of a task of the run
+        :return: whether it is saved locally
+        """
         if seq_no and round_no:
             self.logger.debug("Downloading artifact")
-            response = requests.get(
-                '{0}/runs-action/download/?run={1}&task_seq={2}&round_seq={3}&all_runs={4}&type=artifacts'.format(
-                    router_url,
-                    self.run_id,
-                    seq_no,
-                    round_no,
-                    0),
-                auth=(router_username, router_password))
+            with router_client.get(
+                    '/runs-action/download/?run={0}&task_seq={1}&round_seq={2}&all_runs={3}&type=artifacts'.format(
+                        self.run_id,
+                        seq_no,
+                        round_no,
+                        0),
+                    stream=True) as response:
 
-            if response.status_code == 404:
-                self.logger.warning('No artifacts found in router for run {} at batch {}'.format(
-                    self.project_id, self.batch_id))
-                return False
+                if response.status_code == 404:
+                    self.logger.warning('No artifacts found in router for run {} at batch {}'.format(
+                        self.project_id, self.batch_id))
+                    return False
 
-            if response.status_code == 200:
-                content = response.content
-                self.logger.debug(
-                    'Saving artifacts to local for run {} at seq {} and round {}'.format(self.run_id,
-                                                                                         seq_no, round_no))
-                saved_url = download_artifacts(
-                    self.run_id, seq_no, round_no, content)
-                if saved_url:
+                if response.status_code == 200:
                     self.logger.debug(
-                        'Successfully download and save artifacts to local for run {} at seq {} and round {} in {} dir'.format(
-                            self.run_id, seq_no, round_no, saved_url))
-                    return True
-                self.logger.warning('Failed to save mid-artifacts to local for run {} at seq {} and round {}'.format(
-                    self.run_id, seq_no, round_no))
+                        'Saving artifacts to local for run {} at seq {} and round {}'.format(self.run_id,
+                                                                                             seq_no, round_no))
+                    saved_url = download_artifacts(
+                        self.run_id, seq_no, round_no, response.iter_content(file_utils.download_chunk_size))
+                    if saved_url:
+                        self.logger.debug(
+                            'Successfully download and save artifacts to local for run {} at seq {} and round {} in {} dir'.format(
+                                self.run_id, seq_no, round_no, saved_url))
+                        return True
+                    self.logger.warning(
+                        'Failed to save mid-artifacts to local for run {} at seq {} and round {}'.format(
+                            self.run_id, seq_no, round_no))
+        return False
+
+    def download_run_mid_artifact(self, run_id, round_seq=None):
+        """
+        Download the mid-artifact of a single participant run
+        :param run_id: participant run id
+        :param round_seq: round of the current task, the current round by default
+        :return: local path of the mid-artifact, None if it is not available
+        """
+        task_round = round_seq or self.get_round()
+        if run_id == self.run_id:
+            url = gen_mid_artifacts_url(self.run_id, self.cur_seq, task_round)
+            return url if url and os.path.exists(url) else None
+        pattern = "*-{}-{}-mid-artifacts".format(self.cur_seq, task_round)
+        directory = gen_run_mid_artifacts_url(self.project_id, self.batch_id, run_id)
+        found = next(Path(directory).rglob(pattern), None) if os.path.isdir(directory) else None
+        if found:
+            return str(found)
+        with router_client.get(
+                '/runs-action/download/?run={0}&task_seq={1}&round_seq={2}&all_runs={3}&type=mid_artifacts'.format(
+                    run_id,
+                    self.cur_seq,
+                    task_round,
+                    0),
+                stream=True) as response:
+            if response.status_code != 200:
+                self.logger.debug('No mid-artifacts found in router for run {} at seq {} and round {}'.format(
+                    run_id, self.cur_seq, task_round))
+                return None
+            download_run_mid_artifacts(self.project_id, self.batch_id, run_id,
+                                       response.iter_content(file_utils.download_chunk_size))
+        found = next(Path(directory).rglob(pattern), None)
+        return str(found) if found else None
+
+    def is_incremental_aggregation(self) -> bool:
+        """
+        With aggregation_mode: incremental in the task config, the coordinator folds the update of each participant
+        into a running weighted sum once it reaches pending aggregating, instead of downloading all of them at the end.
+        A round deadline or a hierarchy implies it, as the updates have to be known one by one.
+        """
+        c = self.get_config()
+        return c.get('aggregation_mode', 'batch') == 'incremental' or bool(c.get('round_deadline')) or \
+            bool(sub_aggregators(c, site_uid))
+
+    def ensure_prepared(self) -> bool:
+        """
+        Prepare data unless this instance has prepared it for the current round already.
+        Instances on the processor and compute workers are distinct, each prepares the rounds it handles
+        :return: whether data is prepared
+        """
+        key = (self.cur_seq, self.get_round())
+        if self.prepared_round == key:
+            return True
+        if self.prepare_data():
+            self.prepared_round = key
+            return True
+        return False
+
+    def local_schedule(self) -> LocalSchedule:
+        """
+        Local epochs, batch size, time budget and early stopping of a round, from the task config
+        """
+        return LocalSchedule.from_config(self.get_config())
+
+    def min_quorum(self, total) -> int:
+        """
+        Minimum number of updates to aggregate once the round deadline has passed, all runs by default.
+        Config min_quorum is either a number of runs or, when below 1, a fraction of them
+        :param total: number of runs
+        """
+        quorum = self.get_config().get('min_quorum')
+        if quorum is None:
+            return total
+        if quorum < 1:
+            quorum = math.ceil(quorum * total)
+        return max(1, min(int(quorum), total))
+
+    def round_deadline(self):
+        """
+        :return: seconds after the start of a round the coordinator stops waiting for every run, None to always wait
+        """
+        deadline = self.get_config().get('round_deadline')
+        return float(deadline) if deadline else None
+
+    def late_update_policy(self):
+        """
+        What happens to an update which misses the deadline of its round, config late_update_policy:
+        next_round (default) folds it into the next round of the task with its weight discounted by
+        late_update_discount, drop ignores it
+        :return: (policy, discount)
+        """
+        c = self.get_config()
+        return c.get('late_update_policy', 'next_round'), float(c.get('late_update_discount', 0.5))
+
+    def update_weight(self, metadata: dict):
+        """
+        Weight of a participant update in the aggregate
+        :param metadata: metadata of the mid-artifact
+        """
+        return metadata.get('sample_size', 1)
+
+    def running_aggregate(self, round_seq=None) -> RunningAggregate:
+        return RunningAggregate.load(gen_running_aggregate_url(
+            self.project_id, self.batch_id, self.cur_seq, round_seq or self.get_round()))
+
+    def fold_arrived_updates(self) -> bool:
+        """
+        Coordinator: fold the updates of participants in pending aggregating which are not folded yet.
+        Runs of a group with a sub-aggregator are folded through the partial aggregate of the sub-aggregator.
+        :return: whether the round can be aggregated, i.e. the updates of all participants are folded,
+        or the quorum is folded and the deadline has passed
+        """
+        runs = self.fetch_runs()
+        if not runs:
+            return False
+        grouped = self.grouped_run_ids(runs)
+        runs = [r for r in runs if r['id'] not in grouped]
+        aggregate = self.running_aggregate()
+        arrived = 0
+        for r in runs:
+            if aggregate.is_folded(r['id']):
+                arrived += 1
+                continue
+            if format_status(r['status']) != 'pending_aggregating':
+                continue
+            url = self.download_run_mid_artifact(r['id'])
+            if not url:
+                continue
+            self.fold_update(aggregate, r['id'], url)
+            arrived += 1
+            self.logger.debug('Folded update of run {}, {} of {} runs folded'.format(
+                r['id'], arrived, len(runs)))
+        self.fold_late_updates(runs, aggregate)
+        if arrived == len(runs):
+            return True
+        deadline = self.round_deadline()
+        if deadline is None:
+            return False
+        elapsed = round_clock.elapsed(self.run_id, self.cur_seq, self.get_round())
+        if elapsed >= deadline and arrived >= self.min_quorum(len(runs)):
+            self.logger.info('Deadline of {}s passed after {:.1f}s, aggregating {} of {} updates'.format(
+                deadline, elapsed, arrived, len(runs)))
+            return True
+        return False
+
+    def fold_update(self, aggregate: RunningAggregate, key, url, discount=1):
+        """
+        Fold a mid-artifact into an aggregate. Partial aggregates of sub-aggregators hold weighted sums and are merged
+        """
+        tensors, metadata = self.load_update(url)
+        weight = self.update_weight(metadata)
+        if metadata.get('partial'):
+            aggregate.merge(key, {k: np.multiply(v, discount) for k, v in tensors.items()}, weight * discount)
+        else:
+            aggregate.fold(key, tensors, weight * discount)
+
+    def group_members(self) -> list:
+        """
+        Site uids of the group this site pre-aggregates, None if it is not a sub-aggregator
+        """
+        return sub_aggregators(self.get_config()).get(site_uid)
+
+    def grouped_run_ids(self, runs) -> set:
+        """
+        Coordinator: runs of a group whose sub-aggregator takes part in the batch, the coordinator skips them
+        """
+        groups = sub_aggregators(self.get_config(), site_uid)
+        sites = {r.get('site_uid') for r in runs}
+        members = {m for k, v in groups.items() if k in sites for m in v if m not in groups}
+        return {r['id'] for r in runs if r.get('site_uid') in members}
+
+    def upload_partial_aggregate(self) -> bool:
+        """
+        Sub-aggregator: fold its own update and the updates of its group, then upload their weighted sums and
+        total weight as its mid-artifact. Retried until the updates of all members are available
+        :return: whether it is uploaded
+        """
+        members = set(self.group_members())
+        runs = self.fetch_runs()
+        if not runs:
+            return False
+        group = [r for r in runs if r['id'] == self.run_id or r.get('site_uid') in members]
+        aggregate = RunningAggregate.load(gen_running_aggregate_url(
+            self.project_id, self.batch_id, self.cur_seq, self.get_round(), 'partial'))
+        for r in group:
+            if aggregate.is_folded(r['id']):
+                continue
+            if r['id'] != self.run_id and format_status(r['status']) != 'pending_aggregating':
+                continue
+            url = self.download_run_mid_artifact(r['id'])
+            if url:
+                self.fold_update(aggregate, r['id'], url)
+        if len(aggregate.folded) < len(group):
+            self.logger.debug('Partial aggregate has {} of {} updates'.format(
+                len(aggregate.folded), len(group)))
+            return False
+        url = gen_partial_mid_artifacts_url(self.run_id, self.cur_seq, self.get_round())
+        metadata = {'partial': True, 'sample_size': aggregate.weight, 'members': list(aggregate.folded)}
+        metadata.update(self.version_metadata(False))
+        return self.save_model_artifacts(url, aggregate.sums, metadata) and self.upload(False, url)
+
+    def fold_late_updates(self, runs, aggregate: RunningAggregate):
+        """
+        Coordinator: fold the updates of the previous round which missed its deadline, with a discounted weight
+        """
+        policy, discount = self.late_update_policy()
+        round_seq = self.get_round()
+        if policy != 'next_round' or not round_seq or round_seq <= 1:
+            return
+        previous = self.running_aggregate(round_seq - 1)
+        if not previous.folded:
+            return
+        for r in runs:
+            key = late_key(r['id'], round_seq - 1)
+            if previous.is_folded(r['id']) or aggregate.is_folded(key):
+                continue
+            url = self.download_run_mid_artifact(r['id'], round_seq - 1)
+            if not url:
+                continue
+            self.fold_update(aggregate, key, url, discount)
+            self.logger.info('Folded late update of run {} from round {}'.format(
+                r['id'], round_seq - 1))
+
+    def aggregator(self):
+        """
+        Aggregator of the task config, weighted_mean by default
+        :return: (name, parameters)
+        """
+        return parse_aggregator(self.get_config())
+
+    def collect_updates(self) -> list:
+        """
+        Coordinator: updates of all participants of the current round
+        :return: list of (tensors, weight)
+        """
+        updates = []
+        if self.is_incremental_aggregation():
+            for key, weight in self.running_aggregate().folded.items():
+                run_id, round_seq = parse_late_key(key)
+                tensors, _ = self.load_update(self.download_run_mid_artifact(run_id, round_seq))
+                updates.append((tensors, weight))
+            return updates
+        directory = gen_all_mid_artifacts_url(self.project_id, self.batch_id)
+        for path in Path(directory).rglob("*-{}-{}-mid-artifacts".format(self.cur_seq, self.get_round())):
+            tensors, metadata = self.load_update(str(path))
+            self.logger.debug("Mid artifact {}: {}".format(path, metadata))
+            updates.append((tensors, self.update_weight(metadata)))
+        return updates
+
+    def aggregate_updates(self):
+        """
+        Coordinator: aggregate the updates of all participants of the current round with the aggregator of the config.
+        Sums are folded one update at a time, other aggregators reduce the stacked updates.
+        :return: (name to aggregated array, total weight), None for the tensors if there is no update
+        """
+        name, params = self.aggregator()
+        if name not in linear_aggregators and sub_aggregators(self.get_config(), site_uid):
+            raise ValueError('Aggregator {} can not combine partial aggregates of a hierarchy'.format(name))
+        if name in linear_aggregators:
+            if self.is_incremental_aggregation():
+                aggregate = self.running_aggregate()
+            else:
+                aggregate = RunningAggregate(None)
+                for i, (tensors, weight) in enumerate(self.collect_updates()):
+                    aggregate.fold(i, tensors, weight)
+            result, weight = aggregate.result(), aggregate.weight
+        else:
+            updates = self.collect_updates()
+            result = reduce_updates(updates, name, **params)
+            weight = sum(w for _, w in updates)
+        self.logger.debug("Aggregated updates with {} {}, total weight {}".format(
+            name, params, weight))
+        if result and name == 'server_momentum':
+            result = self.apply_server_momentum(result, params)
+        return result, weight
+
+    def is_async(self) -> bool:
+        """
+        With mode: async in the task config, rounds are not synchronised (FedBuff).
+        Participants train again from the latest global model as soon as their update is taken, and the coordinator
+        publishes a new global model version every buffer_size updates, weighting stale updates down.
+        Global model versions are the rounds of the coordinator run, total_round is the number of versions.
+        Tasks which do not support it always run in sync mode.
+        """
+        return self.supports_async and self.get_config().get('mode', 'sync') == 'async'
+
+    def previous_global_ref(self):
+        """
+        :return: (seq, round) of the global model training starts from, (None, None) if there is none
+        """
+        if self.is_async() and self.model_version:
+            return self.cur_seq, self.model_version
+        return self.get_previous_seq_and_round()
+
+    def version_metadata(self, is_global: bool) -> dict:
+        """
+        Model version tracked in artifact metadata. A global model has the version of the round it is published in,
+        a participant update the version of the global model it was trained from, 0 when trained from scratch
+        """
+        if is_global:
+            return {'task_seq': self.cur_seq, 'model_version': self.get_round()}
+        seq_no, round_no = self.previous_global_ref()
+        return {'task_seq': self.cur_seq, 'base_version': round_no if seq_no == self.cur_seq else 0}
+
+    def latest_global_version(self) -> int:
+        """
+        Async mode: latest published global model version, i.e. the round before the current round of the coordinator
+        """
+        runs = self.fetch_runs()
+        if runs:
+            for r in runs:
+                if r['role'] == 'coordinator' and r.get('cur_seq') == self.cur_seq:
+                    return run_round(r) - 1
+        return 0
+
+    def load_global_version(self, version):
+        """
+        Global model published at a version of the current task
+        :return: name to array, None if absent
+        """
+        return self.load_global(self.cur_seq, version)
+
+    def buffer_updates(self):
+        """
+        Coordinator in async mode: buffer the updates of runs in pending aggregating as deltas against the global model
+        they were trained from. Once buffer_size updates are buffered, a new global model version is published,
+        the buffered runs are sent back to standby for their next round and the coordinator moves to the next version.
+        """
+        runs = self.fetch_runs()
+        if not runs:
+            return
+        c = self.get_config()
+        fed_buff = FedBuff(c.get('staleness_exponent', 0.5), c.get('server_lr', 1.0))
+        version = self.get_round()
+        buffer = self.running_aggregate()
+        latest = self.load_global_version(version - 1)
+        for r in runs:
+            if format_status(r['status']) != 'pending_aggregating':
+                continue
+            key = late_key(r['id'], run_round(r))
+            if buffer.is_folded(key):
+                continue
+            url = self.download_run_mid_artifact(r['id'], run_round(r))
+            if not url:
+                continue
+            tensors, metadata = self.load_update(url)
+            base_version = metadata.get('base_version', version - 1)
+            staleness = max(0, version - 1 - base_version)
+            if latest is not None:
+                tensors = fed_buff.delta(tensors, self.load_global_version(base_version) or latest)
+            buffer.fold(key, tensors, self.update_weight(metadata) * fed_buff.discount(staleness))
+            self.logger.debug('Buffered update of run {} with staleness {}, {} buffered'.format(
+                r['id'], staleness, len(buffer.folded)))
+
+        if len(buffer.folded) < min(int(c.get('buffer_size', 3)), len(runs)):
+            return
+        if not self.publish_global(fed_buff.apply(latest, buffer.result()), buffer.weight):
+            self.notify(0, param={'update_all': True})
+            return
+        self.logger.info('Published global model version {} from {} updates'.format(
+            version, len(buffer.folded)))
+        for key in buffer.folded:
+            run_id, _ = parse_late_key(key)
+            if run_id != self.run_id:
+                self.notify_run(run_id, 2, param={'increase_round': True})
+        if self.is_last_round():
+            self.notify(8, param={'update_all': True})
+        else:
+            self.notify(6, param={'increase_round': True})
+
+    @abstractmethod
+    def publish_global(self, tensors: dict, weight) -> bool:
+        """
+        Coordinator: save and upload a new global model of the current round
+        :param tensors: name to array
+        :param weight: total weight of the updates, e.g. sample size
+        :return: whether it is published
+        """
         return False
 
+    def apply_server_momentum(self, average: dict, params: dict) -> dict:
+        """
+        Coordinator: move the previous global model along the momentum of the averaged updates.
+        The velocity is kept per round on local disk, a retried round starts from the same velocity.
+        Momentum restarts with each task as model shapes may differ.
+        """
+        seq_no, round_no = self.get_previous_seq_and_round()
+        if seq_no != self.cur_seq:
+            return average
+        previous = self.load_previous_global()
+        if not previous:
+            return average
+        velocity_url = gen_server_state_url(self.run_id, seq_no, round_no, 'velocity')
+        velocity = load_artifact(velocity_url)[0] if os.path.exists(velocity_url) else None
+        result, velocity = ServerMomentum(**params).apply(previous, average, velocity)
+        self.save_model_artifacts(gen_server_state_url(self.run_id, self.cur_seq, self.get_round(), 'velocity'),
+                                  velocity, dict())
+        return result
+
+    def load_previous_global(self):
+        """
+        Global model of the previous round, aggregated locally when this site is the coordinator, otherwise downloaded
+        :return: name to array, None in the first round or when it is absent
+        """
+        seq_no, round_no = self.previous_global_ref()
+        return self.load_global(seq_no, round_no)
+
+    def load_global_statistics(self):
+        """
+        Global feature statistics of the latest FederatedStatistics task before the current task,
+        downloaded when this site does not have them yet
+        :return: (seq of that task, name to array), (None, None) if there is none or it is not available
+        """
+        for seq_no in range(self.cur_seq - 1, 0, -1):
+            task = self.tasks[seq_no - 1]
+            if task.get('model') == 'FederatedStatistics':
+                round_no = (task.get('config') or dict()).get('total_round', 1)
+                tensors = self.load_global(seq_no, round_no)
+                if tensors is None and self.download_global(seq_no, round_no):
+                    tensors = self.load_global(seq_no, round_no)
+                if tensors is None:
+                    self.logger.warning('Global statistics of task {} are not available'.format(seq_no))
+                    return None, None
+                return seq_no, tensors
+        return None, None
+
+    def load_global(self, seq_no, round_no):
+        """
+        Global model published at a round, aggregated locally when this site is the coordinator, otherwise downloaded
+        :return: name to array, None if absent
+        """
+        if not seq_no or not round_no:
+            return None
+        url = gen_artifacts_url(self.run_id, seq_no, round_no)
+        if url and os.path.exists(url) and os.path.getsize(url):
+            return load_artifact(url)[0]
+        directory = downloaded_artifacts_url(self.run_id, seq_no, round_no)
+        for path in Path(directory).rglob("*-{}-{}-artifacts".format(seq_no, round_no)):
+            return load_artifact(str(path))[0]
+        return None
+
     @abstractmethod
     def do_aggregate(self) -> bool:
         """
@@ -323,66 +859,105 @@ class AbstractTask(ABC):
         """
         return True
 
-    def upload(self, is_artifact: bool) -> bool:
+    def upload(self, is_artifact: bool, mid_artifacts_url=None) -> bool:
         # Here assume when round of task success, it should upload both mid-artifacts and logs to router
         task_round = self.get_round()
         if task_round:
             self.logger.debug('will upload logs and mid-artifacts')
-            files_data = dict()
+            urls = dict()
             data = dict()
             if is_artifact:
-                artifact_url = gen_artifacts_url(
+                urls['artifacts'] = gen_artifacts_url(
                     self.run_id, self.cur_seq, task_round)
-                if artifact_url:
-                    files_data['artifacts'] = read_file_from_url(artifact_url)
             else:
-                mid_artifacts_url = gen_mid_artifacts_url(
+                urls['mid_artifacts'] = mid_artifacts_url or gen_mid_artifacts_url(
+                    self.run_id, self.cur_seq, task_round)
+                urls['logs'] = gen_logs_url(
                     self.run_id, self.cur_seq, task_round)
-                logs_url = gen_logs_url(self.run_id, self.cur_seq, task_round)
-
-                if mid_artifacts_url:
-                    files_data['mid_artifacts'] = read_file_from_url(
-                        mid_artifacts_url)
-                if logs_url:
-                    files_data['logs'] = read_file_from_url(logs_url)
 
             data['run'] = self.run_id
             data['task_seq'] = self.cur_seq
             data['round_seq'] = task_round
-            if any(files_data.values()):
+            with ExitStack() as stack:
+                files_data = dict()
+                for name, url in urls.items():
+                    file_obj = read_file_from_url(url, 'rb')
+                    if not file_obj:
+                        continue
+                    stack.enter_context(file_obj)
+                    filename = os.path.basename(url)
+                    if ROUTER_UPLOAD_COMPRESSION in compression_suffix:
+                        codec, file_obj = compress(
+                            file_obj, ROUTER_UPLOAD_COMPRESSION)
+                        stack.enter_context(file_obj)
+                        # each file carries its codec in its suffix and magic bytes, downloads are
+                        # decompressed by content
+                        filename += compression_suffix[codec]
+                    files_data[name] = (filename, file_obj)
 
-                response = requests.post('{0}/runs-action/upload/'.format(router_url, self.run_id),
-                                         auth=(router_username,
-                                               router_password),
-                                         data=data,
-                                         files=files_data)
-                if response.status_code == 200:
-                    self.logger.debug(
-                        'Successfully upload logs and artifacts of run {} - task {} - round {}'.format(self.run_id,
-                                                                                                       self.cur_seq,
-                                                                                                       task_round))
+                if files_data:
+                    body = MultipartStream(data, files_data)
+                    start = time.monotonic()
+                    response = router_client.post('/runs-action/upload/',
+                                                  headers={
+                                                      'Content-Type': body.content_type},
+                                                  data=body)
+                    self.logger.debug('Sent {} bytes of {} in {:.3f}s'.format(
+                        body.bytes_sent, list(files_data.keys()), time.monotonic() - start))
+                    if response.status_code == 200:
+                        self.logger.debug(
+                            'Successfully upload logs and artifacts of run {} - task {} - round {}'.format(
+                                self.run_id, self.cur_seq, task_round))
+                        return True
+                else:
+                    self.logger.debug("Files data is empty. Ignore upload")
                     return True
-            else:
-                self.logger.debug("Files data is empty. Ignore upload")
-                return True
 
         return False
 
     def notify(self, next_state, param: dict = None):
+        self.notify_run(self.run_id, next_state, param)
+
+    def notify_run(self, run_id, next_state, param: dict = None):
+        """
+        Update the status of a run, the coordinator updates participant runs in async mode
+        """
         if param is None:
             param = dict()
         headers = {'Content-type': 'application/json'}
         param['status'] = next_state
-        requests.put('{0}/runs/{1}/status/'.format(router_url, self.run_id),
-                     headers=headers,
-                     auth=(router_username, router_password),
-                     data=json.dumps(param))
-
-    def fetch_runs(self):
-        runs_response = requests.get(
-            '{0}/runs/detail/?batch={1}&project={2}&site_uid={3}'.format(
-                router_url, self.batch_id, self.project_id, site_uid),
-            auth=(router_username, router_password))
+        router_client.put('/runs/{0}/status/'.format(run_id),
+                          headers=headers,
+                          data=json.dumps(param))
+        # the snapshot no longer reflects the batch
+        self.event_runs = None
+        batch_snapshots.invalidate(self.project_id, self.batch_id)
+
+    def fetch_runs(self, live=False):
+        """
+        Runs of the batch with their status. They are fetched from the router once per event,
+        and shared with the other workers of the site for BATCH_SNAPSHOT_TTL seconds
+        :param live: fetch them from the router whatever is cached, for checks deciding a status change,
+        as the snapshot misses changes made by other sites in the meantime. The snapshot is refreshed with them
+        :return: run models, None if the router fails
+        """
+        runs = None
+        if not live:
+            if self.in_event and self.event_runs is not None:
+                return self.event_runs
+            runs = batch_snapshots.get(self.project_id, self.batch_id)
+        if runs is None:
+            runs = self.fetch_router_runs()
+            if runs is not None:
+                batch_snapshots.put(self.project_id, self.batch_id, runs)
+        if self.in_event:
+            self.event_runs = runs
+        return runs
+
+    def fetch_router_runs(self):
+        runs_response = router_client.get(
+            '/runs/detail/?batch={0}&project={1}&site_uid={2}'.format(
+                self.batch_id, self.project_id, site_uid))
         if runs_response.ok:
             dic = runs_response.json()
             runs = dic['runs']
@@ -453,7 +1028,7 @@ class AbstractTask(ABC):
         :return:
         """
         self.logger.debug("Checking whether all runs are in the same status")
-        runs = self.fetch_runs()
+        runs = self.fetch_runs(live=True)
         self.logger.debug("expected state: {}. All runs: {}".format(
             expected_state, runs))
         if runs:
@@ -464,6 +1039,17 @@ class AbstractTask(ABC):
         else:
             return False
 
+    def is_superseded(self) -> bool:
+        """
+        Whether the router has moved this run out of running, e.g. the coordinator aggregated without it
+        """
+        runs = self.fetch_runs(live=True)
+        if runs:
+            for r in runs:
+                if r['id'] == self.run_id:
+                    return format_status(r['status']) != 'running'
+        return False
+
     def runs_in_fails(self) -> bool:
         runs = self.fetch_runs()
         if runs:
@@ -472,6 +1058,14 @@ class AbstractTask(ABC):
                     return True
         return False
 
+    def get_config(self) -> dict:
+        """
+        :return: config of current task
+        """
+        if self.tasks and self.cur_seq:
+            return self.tasks[self.cur_seq - 1].get('config') or dict()
+        return dict()
+
     # This method can be used to get current round of current task
 
     def get_round(self):
@@ -494,6 +1088,64 @@ class AbstractTask(ABC):
                     'Error while saving mid_artifacts. due to {}'.format(e))
                 return False
 
+    def save_update(self, url, tensors: dict, metadata: dict) -> bool:
+        """
+        Save the update of a participant, encoded with the update_encoding of the task config if any.
+        Deltas are taken against the global model of the previous round of the same task. With error feedback,
+        what the encoding drops is kept per round on local disk and added to the next update
+        :param url: file path
+        :param tensors: name to array of the trained model
+        :param metadata: json serializable dict, e.g. sample size and metrics
+        :return:
+        """
+        spec = parse_encoding(self.get_config())
+        if spec is None:
+            return self.save_model_artifacts(url, tensors, metadata)
+        seq_no, round_no = self.previous_global_ref()
+        base = self.load_global(seq_no, round_no) if seq_no == self.cur_seq else None
+        residual = None
+        if spec['error_feedback'] and base is not None:
+            residual_url = gen_server_state_url(self.run_id, seq_no, round_no, 'residual')
+            if os.path.exists(residual_url):
+                residual = load_artifact(residual_url)[0]
+        encoded, encoding, residual = encode_update(tensors, spec, base, residual)
+        if encoding['delta']:
+            encoding['base_version'] = round_no
+        if residual is not None:
+            self.save_model_artifacts(gen_server_state_url(self.run_id, self.cur_seq, self.get_round(), 'residual'),
+                                      residual, dict())
+        return self.save_model_artifacts(url, encoded, dict(metadata, encoding=encoding))
+
+    def load_update(self, url):
+        """
+        Load the update of a participant, decoded if it was encoded
+        :param url: file path
+        :return: (tensors, metadata)
+        """
+        tensors, metadata = load_artifact(url)
+        if is_encoded(metadata):
+            encoding = metadata['encoding']
+            base = self.load_global_version(encoding['base_version']) if encoding['delta'] else None
+            tensors = decode_update(tensors, encoding, base)
+        return tensors, metadata
+
+    def save_model_artifacts(self, url, tensors: dict, metadata: dict) -> bool:
+        """
+        Save model tensors and metadata in the binary artifact format
+        :param url: file path
+        :param tensors: name to array
+        :param metadata: json serializable dict, e.g. sample size and metrics
+        :return:
+        """
+        create_if_not_exist(url)
+        try:
+            save_artifact(url, tensors, metadata)
+            return True
+        except Exception as e:
+            self.logger.error(
+                'Error while saving model artifacts. due to {}'.format(e))
+            return False
+
     def post_init(self, run):
         self.cur_seq = run['cur_seq']
         self.tasks = run['tasks']
@@ -0,0 +1,272 @@
+import logging
+import os
+import tempfile
+
+import numpy as np
+
+from friendlyfl.controller.file.artifact_format import load_artifact, save_artifact
+
+logger = logging.getLogger(__name__)
+
+
+def late_key(run_id, round_seq):
+    """
+    Key of an update folded after the deadline of its round
+    """
+    return '{}@{}'.format(run_id, round_seq)
+
+
+def parse_late_key(key):
+    """
+    :return: (run id, round of the update, None for the current round)
+    """
+    run_id, _, round_seq = str(key).partition('@')
+    return int(run_id), int(round_seq) if round_seq else None
+
+
+def sub_aggregators(config, coordinator_site_uid=None) -> dict:
+    """
+    Groups of a hierarchical aggregation, config hierarchy maps a sub-aggregator site uid to the site uids of its members
+    :param config: task config
+    :param coordinator_site_uid: members listed under the coordinator site are aggregated by the coordinator directly
+    :return: sub-aggregator site uid to member site uids
+    """
+    hierarchy = config.get('hierarchy') or dict()
+    return {k: list(v) for k, v in hierarchy.items() if k != coordinator_site_uid}
+
+
+class RunningAggregate:
+    """
+    Weighted sum of model updates folded one at a time, so memory stays at the size of a single model
+    whatever the number of participants.
+    When it has a url the state is saved after every fold, so a restarted worker carries on where the last one stopped.
+    """
+
+    def __init__(self, url):
+        """
+        :param url: file the state is persisted to, None to keep it in memory only
+        """
+        self.url = url
+        self.sums = dict()
+        self.weight = 0
+        # key of each update, e.g. run id, to the weight it was folded with
+        self.folded = dict()
+
+    @classmethod
+    def load(cls, url):
+        """
+        :param url: file the state is persisted to
+        :return: aggregate restored from url, empty if there is none yet
+        """
+        aggregate = cls(url)
+        if url and os.path.exists(url):
+            tensors, metadata = load_artifact(url)
+            aggregate.sums = {k: np.array(v, dtype=np.float64)
+                              for k, v in tensors.items()}
+            aggregate.weight = metadata['weight']
+            aggregate.folded = metadata['folded']
+        return aggregate
+
+    def is_folded(self, key) -> bool:
+        return str(key) in self.folded
+
+    def fold(self, key, tensors: dict, weight) -> bool:
+        """
+        Add weight * tensors to the sums and persist the state
+        :param key: where the update comes from, e.g. run id. An update is folded once
+        :param tensors: name to array
+        :param weight: e.g. sample size of the update
+        :return: whether it is folded
+        """
+        if self.is_folded(key):
+            return False
+        if self.sums and set(tensors.keys()) != set(self.sums.keys()):
+            raise ValueError('Update {} has tensors {}, expected {}'.format(
+                key, sorted(tensors.keys()), sorted(self.sums.keys())))
+        for name, t in tensors.items():
+            weighted = np.multiply(t, weight, dtype=np.float64)
+            if name in self.sums:
+                self.sums[name] += weighted
+            else:
+                self.sums[name] = weighted
+        self.weight += weight
+        self.folded[str(key)] = weight
+        if self.url:
+            self.save()
+        return True
+
+    def merge(self, key, sums: dict, weight) -> bool:
+        """
+        Add weighted sums of another aggregate, e.g. the partial aggregate of a group of runs
+        :param key: where the sums come from, they are merged once
+        :param sums: name to weighted sum
+        :param weight: total weight of the sums
+        :return: whether it is merged
+        """
+        return self.fold(key, {name: np.divide(t, weight, dtype=np.float64) for name, t in sums.items()}, weight)
+
+    def result(self) -> dict:
+        """
+        :return: name to weighted mean, None if nothing is folded
+        """
+        if not self.folded or not self.weight:
+            return None
+        return {name: s / self.weight for name, s in self.sums.items()}
+
+    def save(self):
+        directory = os.path.dirname(self.url)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_url = tempfile.mkstemp(dir=directory)
+        os.close(fd)
+        try:
+            save_artifact(temp_url, self.sums, {
+                'weight': self.weight, 'folded': self.folded})
+            os.replace(temp_url, self.url)
+        except Exception:
+            os.unlink(temp_url)
+            raise
+
+
+def stack(updates: list):
+    """
+    Stack the tensors of several updates along a new first axis
+    :param updates: list of (tensors, weight)
+    :return: (name to array of shape (n, ...), weights of shape (n,))
+    """
+    names = set(updates[0][0].keys())
+    for tensors, _ in updates:
+        if set(tensors.keys()) != names:
+            raise ValueError('Updates have different tensors: {} and {}'.format(
+                sorted(names), sorted(tensors.keys())))
+    stacked = {name: np.stack([np.asarray(tensors[name], dtype=np.float64) for tensors, _ in updates])
+               for name in names}
+    weights = np.asarray([w for _, w in updates], dtype=np.float64)
+    return stacked, weights
+
+
+def weighted_mean(stacked, weights):
+    return np.tensordot(weights, stacked, axes=1) / weights.sum()
+
+
+def median(stacked, weights):
+    """
+    Coordinate-wise median, weights are ignored
+    """
+    return np.median(stacked, axis=0)
+
+
+def trimmed_mean(stacked, weights, trim_ratio=0.1):
+    """
+    Coordinate-wise mean after dropping the trim_ratio largest and smallest values, weights are ignored
+    """
+    n = stacked.shape[0]
+    k = int(n * trim_ratio)
+    if n - 2 * k <= 0:
+        raise ValueError(
+            'trim_ratio {} leaves no update out of {}'.format(trim_ratio, n))
+    if k == 0:
+        return stacked.mean(axis=0)
+    return np.sort(stacked, axis=0)[k:n - k].mean(axis=0)
+
+
+# name to reduction over stacked updates, called as f(stacked, weights, **params)
+aggregators = {
+    'weighted_mean': weighted_mean,
+    'median': median,
+    'trimmed_mean': trimmed_mean,
+}
+
+# aggregators which are sums of the updates, these can be folded one update at a time
+linear_aggregators = frozenset(['weighted_mean', 'server_momentum'])
+
+
+def parse_aggregator(config):
+    """
+    Read the aggregator of a task config, either a name or a dict with a name and its parameters.
+    Example: {"aggregator": {"name": "trimmed_mean", "trim_ratio": 0.2}}
+    :param config: task config
+    :return: (name, parameters)
+    """
+    aggregator = config.get('aggregator') or 'weighted_mean'
+    if isinstance(aggregator, dict):
+        params = dict(aggregator)
+        name = params.pop('name', 'weighted_mean')
+    else:
+        name = aggregator
+        params = dict()
+    if name not in aggregators and name != 'server_momentum':
+        raise ValueError('Unknown aggregator {}'.format(name))
+    return name, params
+
+
+def reduce_updates(updates: list, name='weighted_mean', **params) -> dict:
+    """
+    Aggregate updates with a reduction of aggregators over the stacked tensors
+    :param updates: list of (tensors, weight)
+    :param name: key of aggregators
+    :param params: parameters of the aggregator, e.g. trim_ratio
+    :return: name to aggregated array
+    """
+    if not updates:
+        return None
+    stacked, weights = stack(updates)
+    reduction = aggregators[name]
+    return {k: reduction(v, weights, **params) for k, v in stacked.items()}
+
+
+class ServerMomentum:
+    """
+    Server side momentum (FedAvgM). The averaged update is treated as a pseudo gradient of the previous global model:
+        velocity = momentum * velocity + (previous - average)
+        global = previous - server_lr * velocity
+    """
+
+    def __init__(self, server_lr=1.0, momentum=0.9):
+        self.server_lr = server_lr
+        self.momentum = momentum
+
+    def apply(self, previous: dict, average: dict, velocity: dict = None):
+        """
+        :param previous: global model of the previous round
+        :param average: aggregate of the updates of this round
+        :param velocity: velocity of the previous round, None at the start
+        :return: (new global model, new velocity)
+        """
+        new_velocity = dict()
+        result = dict()
+        for name, avg in average.items():
+            delta = np.asarray(previous[name], dtype=np.float64) - avg
+            if velocity and name in velocity:
+                delta = self.momentum * np.asarray(velocity[name]) + delta
+            new_velocity[name] = delta
+            result[name] = previous[name] - self.server_lr * delta
+        return result, new_velocity
+
+
+class FedBuff:
+    """
+    Buffered asynchronous aggregation. Updates are deltas against the global model they were trained from,
+    weighted down by (1 + staleness) ** -staleness_exponent, where staleness is the number of versions published since.
+        global = latest + server_lr * weighted mean of the buffered deltas
+    """
+
+    def __init__(self, staleness_exponent=0.5, server_lr=1.0):
+        self.staleness_exponent = staleness_exponent
+        self.server_lr = server_lr
+
+    def discount(self, staleness) -> float:
+        return float((1 + staleness) ** -self.staleness_exponent)
+
+    @staticmethod
+    def delta(tensors: dict, base: dict) -> dict:
+        return {name: np.asarray(t, dtype=np.float64) - base[name] for name, t in tensors.items()}
+
+    def apply(self, latest: dict, average: dict) -> dict:
+        """
+        :param latest: latest global model, None before the first version
+        :param average: weighted mean of the buffered deltas, or of the models before the first version
+        :return: next global model
+        """
+        if latest is None:
+            return average
+        return {name: latest[name] + self.server_lr * avg for name, avg in average.items()}
@@ -0,0 +1,216 @@
+import os
+
+import numpy as np
+
+from friendlyfl.controller.file.file_utils import gen_mid_artifacts_url, gen_artifacts_url, dataset_chunk_size, \
+    iter_dataset_by_run, load_dataset_cache_meta, gen_dataset_url, dataset_name
+from friendlyfl.controller.tasks.abstract_task import AbstractTask
+
+histogram_tensors = ('hist_feature', 'hist_bin', 'hist_count')
+
+# upper bound of histogram_bins, so a histogram can not describe the rows of a site one by one
+max_histogram_bins = 1000
+
+
+def chunk_statistics(X) -> dict:
+    """
+    Sufficient statistics of the features of a chunk. Missing values are left out, so counts differ per feature.
+    A feature without any value has a mean and M2 of 0, a min of inf and a max of -inf, which merge as no rows
+    :return: per feature count, mean, M2 (sum of squared deviations), min and max
+    """
+    X = np.asarray(X, dtype=np.float64)
+    count = np.sum(~np.isnan(X), axis=0).astype(np.float64)
+    mean = np.divide(np.nansum(X, axis=0), count, out=np.zeros_like(count), where=count > 0)
+    return {
+        'count': count,
+        'mean': mean,
+        'm2': np.nansum((X - mean) ** 2, axis=0),
+        'min': np.fmin.reduce(X, axis=0, initial=np.inf),
+        'max': np.fmax.reduce(X, axis=0, initial=-np.inf)
+    }
+
+
+def merge_statistics(a: dict, b: dict) -> dict:
+    """
+    Combine the statistics of two disjoint sets of rows (Chan et al.)
+    """
+    if a is None:
+        return b
+    count = a['count'] + b['count']
+    delta = b['mean'] - a['mean']
+    ratio = np.divide(b['count'], count, out=np.zeros_like(count), where=count > 0)
+    return {
+        'count': count,
+        'mean': a['mean'] + delta * ratio,
+        'm2': a['m2'] + b['m2'] + delta ** 2 * a['count'] * ratio,
+        'min': np.minimum(a['min'], b['min']),
+        'max': np.maximum(a['max'], b['max'])
+    }
+
+
+def chunk_histogram(X, ranges, bins):
+    """
+    Sparse histogram of each feature on bins equal-width bins between the low and high bounds of the feature,
+    shared by all sites so histograms merge by adding counts. Values out of bounds are counted in the first or last
+    bin, so the histogram never tells more than the bounds about extreme values. Missing values are not counted
+    :param ranges: array of shape (n features, 2) of low and high bounds
+    :param bins: number of bins per feature
+    :return: (feature index, bin index, count) of the non-empty bins
+    """
+    X = np.asarray(X, dtype=np.float64)
+    low, high = ranges[:, 0], ranges[:, 1]
+    present = ~np.isnan(X)
+    index = np.clip(np.floor((X[present] - np.broadcast_to(low, X.shape)[present]) /
+                             np.broadcast_to(high - low, X.shape)[present] * bins), 0, bins - 1).astype(np.int64)
+    features = np.broadcast_to(np.arange(X.shape[1], dtype=np.int64), X.shape)[present]
+    return merge_histograms([(features, index, np.ones(len(index), dtype=np.int64))])
+
+
+def empty_histogram():
+    return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+
+def merge_histograms(histograms: list):
+    """
+    :param histograms: list of (feature index, bin index, count)
+    :return: (feature index, bin index, count) with one entry per non-empty bin, sorted by feature and bin
+    """
+    features = np.concatenate([np.asarray(h[0], dtype=np.int64) for h in histograms])
+    bins = np.concatenate([np.asarray(h[1], dtype=np.int64) for h in histograms])
+    counts = np.concatenate([np.asarray(h[2], dtype=np.int64) for h in histograms])
+    keys, inverse = np.unique(np.stack([features, bins], axis=1), axis=0, return_inverse=True)
+    return keys[:, 0], keys[:, 1], np.bincount(inverse.ravel(), weights=counts, minlength=len(keys)).astype(np.int64)
+
+
+def finalize_statistics(stats: dict) -> dict:
+    """
+    Add population variance and standard deviation to merged statistics
+    """
+    var = np.divide(stats['m2'], stats['count'], out=np.zeros_like(stats['m2']), where=stats['count'] > 0)
+    return dict(stats, var=var, std=np.sqrt(var))
+
+
+class FederatedStatistics(AbstractTask):
+    """
+    One round task computing global per-feature count, mean, variance, min, max and, when requested, histograms.
+    Each site sends mergeable sufficient statistics of its dataset, read in one chunked pass, and the coordinator
+    combines them. The global statistics are kept as the artifact of the task, later tasks of the run use them to
+    scale features the same way on every site.
+    """
+    # statistics are merged once over all sites, there are no model versions to buffer updates against
+    supports_async = False
+
+    def __init__(self, run):
+        super().__init__(run)
+        self.sample_size = None
+        self.sites = None
+
+    def histogram_bins(self) -> int:
+        """
+        Number of bins of the histograms, histogram_bins in the task config. Histograms are only computed when both
+        histogram_bins and histogram_range are set
+        :return: number of bins, at most max_histogram_bins, 0 when histograms are not requested
+        """
+        c = self.get_config()
+        if not c.get('histogram_range') or not c.get('histogram_bins'):
+            return 0
+        return max(1, min(int(c['histogram_bins']), max_histogram_bins))
+
+    def histogram_ranges(self, n_features):
+        """
+        Bounds of the histograms, histogram_range in the task config: [low, high] for all features,
+        or one [low, high] per feature
+        :return: array of shape (n_features, 2)
+        """
+        ranges = np.asarray(self.get_config()['histogram_range'], dtype=np.float64).reshape(-1, 2)
+        if not np.all(ranges[:, 1] > ranges[:, 0]):
+            raise ValueError('histogram_range bounds must be increasing')
+        if len(ranges) not in (1, n_features):
+            raise ValueError('histogram_range has {} bounds for {} features'.format(len(ranges), n_features))
+        return np.broadcast_to(ranges, (n_features, 2))
+
+    def histogram_metadata(self) -> dict:
+        bins = self.histogram_bins()
+        return {'histogram_bins': bins, 'histogram_range': self.get_config()['histogram_range'] if bins else None}
+
+    def chunk_size(self) -> int:
+        return int(self.get_config().get('chunk_size', dataset_chunk_size))
+
+    def is_incremental_aggregation(self) -> bool:
+        # statistics are merged, not averaged, so they are always collected as a whole
+        return False
+
+    def group_members(self) -> list:
+        return None
+
+    def grouped_run_ids(self, runs) -> set:
+        return set()
+
+    def validate(self) -> bool:
+        return True
+
+    def prepare_data(self) -> bool:
+        if load_dataset_cache_meta(self.run_id) or os.path.exists(gen_dataset_url(self.run_id) + dataset_name):
+            return True
+        self.logger.warning("Data set is not ready")
+        return False
+
+    def training(self) -> bool:
+        self.logger.info('Computing statistics...')
+        stats = None
+        bins = self.histogram_bins()
+        ranges = None
+        histograms = [empty_histogram()]
+        rows = 0
+        for _, X, _ in iter_dataset_by_run(self.run_id, self.chunk_size()):
+            if len(X) == 0:
+                continue
+            rows += len(X)
+            stats = merge_statistics(stats, chunk_statistics(X))
+            if bins:
+                if ranges is None:
+                    try:
+                        ranges = self.histogram_ranges(X.shape[1])
+                    except ValueError as e:
+                        self.logger.warning('Invalid histogram_range: {}'.format(e))
+                        return False
+                histograms.append(chunk_histogram(X, ranges, bins))
+        if stats is None:
+            self.logger.warning("Data set is empty")
+            return False
+        self.sample_size = rows
+        tensors = dict(stats)
+        tensors.update(zip(histogram_tensors, merge_histograms(histograms)))
+        metadata = {'sample_size': self.sample_size}
+        metadata.update(self.histogram_metadata())
+        metadata.update(self.version_metadata(False))
+        url = gen_mid_artifacts_url(self.run_id, self.cur_seq, self.get_round())
+        self.logger.info("Upload statistics of {} rows to: {}".format(self.sample_size, url))
+        return self.save_model_artifacts(url, tensors, metadata)
+
+    def do_aggregate(self) -> bool:
+        updates = self.collect_updates()
+        if not updates:
+            self.logger.warning("No statistics to aggregate")
+            return False
+        stats = None
+        for tensors, _ in updates:
+            stats = merge_statistics(stats, {k: np.asarray(tensors[k]) for k in ('count', 'mean', 'm2', 'min', 'max')})
+        tensors = finalize_statistics(stats)
+        tensors.update(zip(histogram_tensors, merge_histograms(
+            [tuple(t[k] for k in histogram_tensors) for t, _ in updates])))
+        self.sites = len(updates)
+        return self.publish_global(tensors, sum(w for _, w in updates))
+
+    def publish_global(self, tensors: dict, weight) -> bool:
+        self.sample_size = weight
+        metadata = {'statistics': True, 'sample_size': self.sample_size, 'sites': self.sites}
+        metadata.update(self.histogram_metadata())
+        metadata.update(self.version_metadata(True))
+        url = gen_artifacts_url(self.run_id, self.cur_seq, self.get_round())
+        self.logger.info("Global statistics of {} rows from {} sites to: {}".format(
+            self.sample_size, self.sites, url))
+        if self.save_model_artifacts(url, tensors, metadata):
+            self.upload(True)
+            return True
+        return False
@@ -0,0 +1,101 @@
+import time
+
+import numpy as np
+
+
+def parse_local_training(config) -> dict:
+    """
+    Read how much local training a site does per round from a task config.
+    Example: {"local_epochs": 5, "batch_size": 64, "time_budget": 30, "early_stopping": {"patience": 2, "tol": 1e-4}}
+    batch_size None trains on the whole training set at once, time_budget is in seconds,
+    early_stopping true uses the default patience and tolerance
+    :param config: task config
+    :return: keyword arguments of LocalSchedule
+    """
+    early_stopping = config.get('early_stopping')
+    if early_stopping is True:
+        early_stopping = dict()
+    early_stopping = early_stopping or dict()
+    batch_size = config.get('batch_size')
+    time_budget = config.get('time_budget')
+    return {'epochs': max(1, int(config.get('local_epochs', 1))),
+            'batch_size': int(batch_size) if batch_size else None,
+            'time_budget': float(time_budget) if time_budget else None,
+            'patience': int(early_stopping.get('patience', 2)) if config.get('early_stopping') else None,
+            'tol': float(early_stopping.get('tol', 1e-4))}
+
+
+class LocalSchedule:
+    """
+    Local epochs of a round. Training stops after the configured epochs, once the time budget is spent,
+    or when the loss has not improved by tol for patience epochs. The first batch always runs,
+    so every round yields an update.
+    """
+
+    def __init__(self, epochs=1, batch_size=None, time_budget=None, patience=None, tol=1e-4):
+        self.epochs = epochs
+        self.batch_size = batch_size
+        self.time_budget = time_budget
+        self.patience = patience
+        self.tol = tol
+        self.deadline = None
+        self.completed = 0
+        self.best = None
+        self.stale = 0
+        self.stopped = False
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(**parse_local_training(config))
+
+    def start(self, limit=None):
+        """
+        Start the clock of the round
+        :param limit: seconds the round may take at most whatever the time budget, e.g. the round deadline
+        :return: self
+        """
+        budgets = [b for b in (self.time_budget, limit) if b]
+        self.deadline = time.monotonic() + min(budgets) if budgets else None
+        return self
+
+    def expired(self) -> bool:
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def iter_epochs(self):
+        """
+        :return: generator of epoch numbers, stopping early on time budget or early stopping
+        """
+        for epoch in range(self.epochs):
+            if epoch and (self.stopped or self.expired()):
+                break
+            yield epoch
+            self.completed = epoch + 1
+
+    def iter_batches(self, n, seed=0):
+        """
+        Indices of the mini-batches of an epoch over n rows, shuffled with seed. Stops once the time budget is spent
+        :return: generator of index arrays
+        """
+        if not self.batch_size or self.batch_size >= n:
+            yield np.arange(n)
+            return
+        order = np.random.default_rng(seed).permutation(n)
+        for start in range(0, n, self.batch_size):
+            if start and self.expired():
+                return
+            yield order[start:start + self.batch_size]
+
+    def record(self, loss) -> bool:
+        """
+        Record the loss of an epoch
+        :return: whether training should stop
+        """
+        if self.patience is None or loss is None:
+            return False
+        if self.best is None or loss < self.best - self.tol:
+            self.best = loss
+            self.stale = 0
+        else:
+            self.stale += 1
+            self.stopped = self.stale >= self.patience
+        return self.stopped
@@ -1,20 +1,19 @@
-import json
-from pathlib import Path
-
-import numpy
 import numpy as np
 
-from friendlyfl.controller.file.file_utils import gen_mid_artifacts_url, gen_all_mid_artifacts_url, gen_artifacts_url, \
-    downloaded_artifacts_url
+from friendlyfl.controller.file.file_utils import gen_mid_artifacts_url, gen_artifacts_url, dataset_chunk_size
+from friendlyfl.controller.file.prepared_store import dataset_fingerprint, load_prepared, save_prepared
 from friendlyfl.controller.tasks.abstract_task import AbstractTask
+from friendlyfl.controller.tasks.metrics import classification_metrics, log_loss
+from friendlyfl.controller.tasks.streaming import iter_split, scan_dataset
 import sklearn.linear_model
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import StandardScaler
-from sklearn.metrics import accuracy_score, classification_report, confusion_matrix, roc_auc_score
 import warnings
 
 warnings.filterwarnings('ignore')
 
+test_size = 0.2
+
 
 class LogisticRegression(AbstractTask):
 
@@ -26,50 +25,210 @@ class LogisticRegression(AbstractTask):
         self.y_train = None
         self.X_test_scaled = None
         self.y_test = None
+        self.scaler = None
+        self.classes = None
+        self.dataset_hash = None
+        self.statistics = None
 
-    def prepare_data(self) -> bool:
-        # load dataset
-        self.logger.debug('Loading dataset for run {} ...'.format(self.run_id))
-        X, y = self.read_dataset(self.run_id)
-        if X is not None and len(X) > 0 and y is not None and len(y) > 0:
-            self.sample_size = len(y)
-            # Split the data into training and testing sets
-            X_train, X_test, self.y_train, self.y_test = train_test_split(
-                X, y, test_size=0.2, random_state=42)
+    def is_streaming(self) -> bool:
+        """
+        In streaming mode the dataset is never loaded as a whole. It is read in chunks of config chunk_size,
+        scaled with incrementally fitted statistics and trained with SGD updates per chunk.
+        """
+        return bool(self.get_config().get('streaming', False))
 
-            # Standardize the numerical features
-            scaler = StandardScaler()
-            self.X_train_scaled = scaler.fit_transform(X_train)
-            self.X_test_scaled = scaler.transform(X_test)
+    def chunk_size(self) -> int:
+        return int(self.get_config().get('chunk_size', dataset_chunk_size))
+
+    def prepare_data(self) -> bool:
+        if self.is_streaming():
+            return self.prepare_streaming_data()
+        if self.load_prepared_data() or self.split_and_scale():
             self.logger.debug(
                 f'Training data shape: {self.X_train_scaled.shape}')
             self.logger.debug(f'Training label shape: {self.y_train.shape}')
             self.logger.debug(f'Test data shape: {self.X_test_scaled.shape}')
             self.logger.debug(f'Test label shape: {self.y_test.shape}')
 
-            # Initialize Logistic regression model
-            self.logisticRegr = sklearn.linear_model.LogisticRegression(
-                penalty="l2",
-                max_iter=1,  # local epoch
-                warm_start=True,  # prevent refreshing weights when fitting
-            )
-            if not self.is_first_round():
-                seq_no, round_no = self.get_previous_seq_and_round()
-                directory = downloaded_artifacts_url(
-                    self.run_id, seq_no, round_no)
-                for path in Path(directory).rglob("*-{}-{}-artifacts".format(seq_no, round_no)):
-                    with open(str(path), 'r') as f:
-                        for line in f:
-                            model = json.loads(line)
-                            self.logisticRegr.coef_ = np.asarray(
-                                model['coef_'])
-                            self.logisticRegr.intercept_ = np.asarray(
-                                model['intercept_'])
+            # Initialize Logistic regression model, trained by mini-batch SGD when the task has a batch size
+            if self.local_schedule().batch_size:
+                self.logisticRegr = self.sgd_model()
+            else:
+                self.logisticRegr = sklearn.linear_model.LogisticRegression(
+                    penalty="l2",
+                    max_iter=1,  # local epoch
+                    warm_start=True,  # prevent refreshing weights when fitting
+                )
+            self.load_global_model()
             return True
         else:
             self.logger.warning("Data set is not ready")
         return False
 
+    def prepared_variant(self) -> str:
+        return 'streaming' if self.is_streaming() else 'in_memory'
+
+    def prepared_params(self) -> dict:
+        """
+        Parameters the prepared data depends on. Prepared data stored with other parameters is rebuilt
+        """
+        seq_no, _ = self.global_statistics()
+        return {'test_size': test_size, 'random_state': 42, 'statistics_seq': seq_no}
+
+    def global_statistics(self):
+        """
+        Global feature statistics of an earlier FederatedStatistics task of the run, kept once loaded.
+        A miss is looked up again next time, the statistics may become available later
+        :return: (seq of that task, name to array), (None, None) if there is none
+        """
+        if self.statistics is None:
+            seq_no, stats = self.load_global_statistics()
+            if stats is None:
+                return None, None
+            self.statistics = seq_no, stats
+        return self.statistics
+
+    def fit_scaler(self, scaler, n_features) -> bool:
+        """
+        Set the scaler to the global statistics so every site scales features the same way
+        :return: whether global statistics are used
+        """
+        seq_no, stats = self.global_statistics()
+        if stats is None:
+            return False
+        if len(stats['mean']) != n_features:
+            self.logger.warning('Global statistics of task {} have {} features, the dataset has {}'.format(
+                seq_no, len(stats['mean']), n_features))
+            return False
+        std = np.asarray(stats['std'], dtype=np.float64)
+        scaler.mean_ = np.array(stats['mean'], dtype=np.float64)
+        scaler.var_ = np.array(stats['var'], dtype=np.float64)
+        scaler.scale_ = np.where(std > 10 * np.finfo(np.float64).eps, std, 1.0)
+        # counts differ per feature when values are missing
+        scaler.n_samples_seen_ = int(np.max(stats['count']))
+        scaler.n_features_in_ = n_features
+        self.logger.debug('Scaling with global statistics of task {}'.format(seq_no))
+        return True
+
+    def load_prepared_data(self) -> bool:
+        """
+        Reuse the split, scaler and scaled matrices prepared by an earlier round or task of the run
+        """
+        if self.dataset_hash is None:
+            self.dataset_hash = dataset_fingerprint(self.run_id)
+        arrays = load_prepared(
+            self.run_id, self.dataset_hash, self.prepared_variant(), self.prepared_params())
+        if not arrays:
+            return False
+        self.scaler = StandardScaler()
+        self.scaler.mean_ = np.array(arrays['scaler_mean'])
+        self.scaler.var_ = np.array(arrays['scaler_var'])
+        self.scaler.scale_ = np.array(arrays['scaler_scale'])
+        self.scaler.n_samples_seen_ = int(arrays['n_samples_seen'])
+        self.scaler.n_features_in_ = len(self.scaler.mean_)
+        if self.is_streaming():
+            self.classes = np.array(arrays['classes'])
+            self.sample_size = int(arrays['sample_size'])
+        else:
+            self.X_train_scaled = arrays['X_train_scaled']
+            self.X_test_scaled = arrays['X_test_scaled']
+            self.y_train = arrays['y_train']
+            self.y_test = arrays['y_test']
+            self.sample_size = len(arrays['train_idx']) + \
+                len(arrays['test_idx'])
+        self.logger.debug('Loaded prepared data of run {} for dataset {}'.format(
+            self.run_id, self.dataset_hash))
+        return True
+
+    def save_prepared_data(self, arrays: dict):
+        arrays.update({
+            'scaler_mean': self.scaler.mean_,
+            'scaler_var': self.scaler.var_,
+            'scaler_scale': self.scaler.scale_,
+            'n_samples_seen': np.asarray(self.scaler.n_samples_seen_)
+        })
+        if self.dataset_hash and save_prepared(self.run_id, self.dataset_hash, self.prepared_variant(), arrays,
+                                               self.prepared_params()):
+            self.logger.debug('Saved prepared data of run {} for dataset {}'.format(
+                self.run_id, self.dataset_hash))
+
+    def split_and_scale(self) -> bool:
+        # load dataset
+        self.logger.debug('Loading dataset for run {} ...'.format(self.run_id))
+        X, y = self.read_dataset(self.run_id)
+        if X is not None and len(X) > 0 and y is not None and len(y) > 0:
+            self.sample_size = len(y)
+            # Split the data into training and testing sets
+            train_idx, test_idx = train_test_split(
+                np.arange(len(y)), test_size=test_size, random_state=42)
+            self.y_train = y[train_idx]
+            self.y_test = y[test_idx]
+
+            # Standardize the numerical features, with global statistics when available
+            self.scaler = StandardScaler()
+            if self.fit_scaler(self.scaler, X.shape[1]):
+                self.X_train_scaled = self.scaler.transform(X[train_idx])
+            else:
+                self.X_train_scaled = self.scaler.fit_transform(X[train_idx])
+            self.X_test_scaled = self.scaler.transform(X[test_idx])
+            self.save_prepared_data({
+                'train_idx': train_idx,
+                'test_idx': test_idx,
+                'X_train_scaled': self.X_train_scaled,
+                'X_test_scaled': self.X_test_scaled,
+                'y_train': self.y_train,
+                'y_test': self.y_test
+            })
+            return True
+        return False
+
+    def prepare_streaming_data(self) -> bool:
+        if not self.load_prepared_data():
+            self.logger.debug('Scanning dataset for run {} in chunks of {} rows ...'.format(
+                self.run_id, self.chunk_size()))
+            self.scaler, self.classes, self.sample_size = scan_dataset(
+                self.run_id, self.chunk_size(), test_size)
+            if not self.sample_size:
+                self.logger.warning("Data set is not ready")
+                return False
+            self.fit_scaler(self.scaler, len(self.scaler.mean_))
+            self.save_prepared_data({
+                'classes': self.classes,
+                'sample_size': np.asarray(self.sample_size)
+            })
+        self.logger.debug(f'Data rows: {self.sample_size}, classes: {self.classes}')
+        self.logisticRegr = self.sgd_model()
+        self.load_global_model()
+        return True
+
+    @staticmethod
+    def sgd_model():
+        return sklearn.linear_model.SGDClassifier(
+            loss='log_loss',
+            penalty='l2',
+            random_state=42,
+        )
+
+    def load_global_model(self):
+        """
+        Start from the global model of the previous round, if any
+        """
+        if not self.is_first_round():
+            tensors = self.load_previous_global()
+            if tensors and 'coef_' in tensors and 'intercept_' in tensors:
+                self.restore_model(tensors)
+
+    def restore_model(self, tensors: dict):
+        """
+        Set the weights of the model to global tensors. A model not fitted by this instance, e.g. on a worker which
+        never trained the run, also gets the number of features and the classes of the training data to predict with
+        """
+        self.logisticRegr.coef_ = np.array(tensors['coef_'])
+        self.logisticRegr.intercept_ = np.array(tensors['intercept_'])
+        self.logisticRegr.n_features_in_ = self.logisticRegr.coef_.shape[1]
+        if not hasattr(self.logisticRegr, 'classes_'):
+            self.logisticRegr.classes_ = np.asarray(self.classes) if self.is_streaming() else np.unique(self.y_train)
+
     def validate(self) -> bool:
         """
         This step is used to load and validate the input data.
@@ -87,98 +246,118 @@ class LogisticRegression(AbstractTask):
         default solver is incredibly slow thats why we change it
         """
         self.logger.info('Starting training...')
-        self.logisticRegr.fit(self.X_train_scaled, self.y_train)
-        score = self.logisticRegr.score(self.X_test_scaled, self.y_test)
-        self.logger.info(f'Training complete. Model score: {score}')
-        to_upload = self.calculate_statistics()
+        schedule = self.schedule or self.local_schedule().start()
+        for epoch in schedule.iter_epochs():
+            loss = self.train_epoch(schedule, epoch)
+            if loss is not None:
+                self.logger.debug('Local epoch {} loss: {}'.format(epoch + 1, loss))
+            if schedule.record(loss):
+                self.logger.info('Loss stopped improving after {} local epochs'.format(epoch + 1))
+        y_test, proba = self.evaluate()
+        to_upload = self.calculate_statistics(y_test, proba)
+        to_upload['local_epochs'] = schedule.completed
+        self.logger.info(f'Training complete after {schedule.completed} local epochs. '
+                         f'Model score: {to_upload["metric_acc"]}')
+        to_upload.update(self.version_metadata(False))
         url = gen_mid_artifacts_url(
             self.run_id, self.cur_seq, self.get_round())
         self.logger.info("Upload: {} \n to: {}".format(to_upload, url))
-        return self.save_artifacts(url, json.dumps(to_upload))
-
-    def calculate_statistics(self):
-        y_predict = self.logisticRegr.predict(self.X_test_scaled)
-
-        # Accuracy metric
-        accuracy = accuracy_score(self.y_test, y_predict)
-        self.logger.info(f'Accuracy: {accuracy}')
-        report = classification_report(self.y_test, y_predict)
-        self.logger.info(f'Classification report : \n  {report}')
-
-        # Documentation: https://scikit-learn.org/stable/modules/model_evaluation.html
-        # ROC-AUC
-        auc = roc_auc_score(self.y_test, y_predict)
-        self.logger.info(f'AUC: {auc}')
-
-        # Use confusion matrix to calculate the metrics
-        tn, fp, fn, tp = confusion_matrix(self.y_test, y_predict).ravel()
+        return self.save_update(url, self.model_tensors(), to_upload)
 
-        accuracy = (tp + tn) / (tn + fp + fn + tp)
-        self.logger.info(f'Accuracy: {accuracy}')
-
-        sensitivity = tp / (tp + fn)
-        self.logger.info(f'Sensitivity: {sensitivity}')
+    def train_epoch(self, schedule, epoch):
+        """
+        One local epoch. With a batch size, or in streaming mode, the model takes an SGD step per mini-batch
+        :return: training loss of the epoch when early stopping is on, else None.
+        For mini-batches it is the loss of each batch before the model is updated with it
+        """
+        track = schedule.patience is not None
+        seed = (self.get_round() or 0) * schedule.epochs + epoch
+        if self.is_streaming():
+            batches = ((self.scaler.transform(X), y) for X, y in iter_split(self.run_id, self.chunk_size(), test_size))
+            classes = self.classes
+        elif schedule.batch_size:
+            batches = [(self.X_train_scaled, self.y_train)]
+            classes = np.unique(self.y_train)
+        else:
+            self.logisticRegr.fit(self.X_train_scaled, self.y_train)
+            if track:
+                return log_loss(self.y_train, self.logisticRegr.predict_proba(self.X_train_scaled),
+                                self.logisticRegr.classes_)
+            return None
+        total = 0.0
+        rows = 0
+        for i, (X, y) in enumerate(batches):
+            for idx in schedule.iter_batches(len(y), (seed, i)):
+                if track and hasattr(self.logisticRegr, 'classes_'):
+                    total += log_loss(y[idx], self.logisticRegr.predict_proba(X[idx]),
+                                      self.logisticRegr.classes_) * len(idx)
+                    rows += len(idx)
+                self.logisticRegr.partial_fit(X[idx], y[idx], classes=classes)
+            if schedule.expired():
+                self.logger.info('Time budget spent in local epoch {}'.format(epoch + 1))
+                break
+        return total / rows if rows else None
 
-        specificity = tn / (tn + fp)
-        self.logger.info(f'Specificity: {specificity}')
+    def evaluate(self):
+        """
+        Predict the probabilities of the test set in one pass
+        :return: (y_test, probabilities of shape (n, classes))
+        """
+        if not self.is_streaming():
+            return self.y_test, self.logisticRegr.predict_proba(self.X_test_scaled)
+        y_test = []
+        proba = []
+        for X, y in iter_split(self.run_id, self.chunk_size(), test_size, test=True):
+            y_test.append(y)
+            proba.append(self.logisticRegr.predict_proba(
+                self.scaler.transform(X)))
+        if not y_test:
+            return np.array([]), np.empty((0, len(self.logisticRegr.classes_)))
+        return np.concatenate(y_test), np.concatenate(proba)
 
-        npv = tn / (tn + fn)
-        self.logger.info(f'NPV: {npv}')
+    def calculate_statistics(self, y_test=None, proba=None):
+        if y_test is None or proba is None:
+            y_test, proba = self.evaluate()
 
-        ppv = tp / (tp + fp)
-        self.logger.info(f'PPV: {ppv}')
+        m = classification_metrics(y_test, proba, self.logisticRegr.classes_)
+        self.logger.info('Accuracy: {accuracy}, AUC: {auc}, Sensitivity: {sensitivity}, Specificity: {specificity}, '
+                         'NPV: {npv}, PPV: {ppv}, F1: {f1}'.format(**m))
+        self.logger.debug('Confusion matrix: {}'.format(m['confusion_matrix']))
 
         return {
             "sample_size": self.sample_size,
-            "coef_": self.logisticRegr.coef_.tolist(),
-            "intercept_": self.logisticRegr.intercept_.tolist(),
-            "metric_acc": accuracy,
-            "metric_auc": auc,
-            "metric_sensitivity": sensitivity,
-            "metric_specificity": specificity,
-            "mertic_npv": npv,
-            "metric_ppv": ppv
+            "metric_acc": m['accuracy'],
+            "metric_auc": m['auc'],
+            "metric_sensitivity": m['sensitivity'],
+            "metric_specificity": m['specificity'],
+            "mertic_npv": m['npv'],
+            "metric_ppv": m['ppv'],
+            "metric_f1": m['f1'],
+            "metric_confusion_matrix": m['confusion_matrix']
+        }
+
+    def model_tensors(self) -> dict:
+        return {
+            "coef_": self.logisticRegr.coef_,
+            "intercept_": self.logisticRegr.intercept_
         }
 
     def do_aggregate(self) -> bool:
-        download_mid_artifacts = []
-        directory = gen_all_mid_artifacts_url(self.project_id, self.batch_id)
-        for path in Path(directory).rglob("*-{}-{}-mid-artifacts".format(self.cur_seq, self.get_round())):
-            with open(str(path), 'r') as f:
-                for line in f:
-                    download_mid_artifacts.append(json.loads(line))
-
-        self.logger.debug(
-            "Download mid artifacts: {}".format(download_mid_artifacts))
-
-        self.sample_size = 0
-        coef = None
-        intercept = None
-        for mid_artifact_dict in download_mid_artifacts:
-            sample = mid_artifact_dict['sample_size']
-            self.sample_size = self.sample_size + sample
-            weighted_coef = numpy.multiply(numpy.asarray(
-                mid_artifact_dict['coef_']), sample)
-            weighted_intercept = numpy.multiply(numpy.asarray(
-                mid_artifact_dict['intercept_']), sample)
-            if coef is None:
-                coef = weighted_coef
-            else:
-                coef = numpy.add(coef, weighted_coef)
-            if intercept is None:
-                intercept = weighted_intercept
-            else:
-                intercept = numpy.add(intercept, weighted_intercept)
+        tensors, sample_size = self.aggregate_updates()
+        return self.publish_global(tensors, sample_size)
 
-        if coef is not None and intercept is not None:
-            self.logisticRegr.coef_ = numpy.divide(coef, self.sample_size)
-            self.logisticRegr.intercept_ = numpy.divide(
-                intercept, self.sample_size)
+    def publish_global(self, tensors: dict, weight) -> bool:
+        if tensors and 'coef_' in tensors and 'intercept_' in tensors:
+            if self.logisticRegr is None and not self.prepare_data():
+                return False
+            self.sample_size = weight
+            self.restore_model(tensors)
             to_upload = self.calculate_statistics()
+            to_upload.update(self.version_metadata(True))
             url = gen_artifacts_url(
                 self.run_id, self.cur_seq, self.get_round())
             self.logger.info("Upload: {} \n to: {}".format(to_upload, url))
-            if self.save_artifacts(url, json.dumps(to_upload)):
+            if self.save_model_artifacts(url, self.model_tensors(), to_upload):
                 self.upload(True)
                 return True
             else:
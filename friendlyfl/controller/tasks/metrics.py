@@ -0,0 +1,138 @@
+import numpy as np
+
+
+def _divide(a, b):
+    """
+    Element-wise a / b, 0 where b is 0
+    """
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    return np.divide(a, b, out=np.zeros(np.broadcast(a, b).shape), where=b != 0)
+
+
+def all_labels(classes, *ys) -> np.ndarray:
+    """
+    Sorted union of the classes and the labels found in ys, e.g. labels of a site the model never saw in training
+    """
+    labels = np.asarray(classes)
+    for y in ys:
+        labels = np.union1d(labels, y)
+    return labels
+
+
+def confusion(y_true, y_pred, classes) -> np.ndarray:
+    """
+    Confusion matrix from one bincount, rows are true classes and columns predicted classes
+    :param y_true: labels
+    :param y_pred: predicted labels
+    :param classes: sorted labels. Labels of y_true or y_pred missing from them get a row and a column in sorted order
+    :return: array of shape (k, k), k the number of classes and missing labels
+    """
+    labels = all_labels(classes, y_true, y_pred)
+    k = len(labels)
+    t = np.searchsorted(labels, y_true)
+    p = np.searchsorted(labels, y_pred)
+    return np.bincount(t * k + p, minlength=k * k).reshape(k, k)
+
+
+def average_ranks(x) -> np.ndarray:
+    """
+    1-based ranks of x, ties get the average of their ranks
+    """
+    _, inverse, counts = np.unique(x, return_inverse=True, return_counts=True)
+    ends = np.cumsum(counts)
+    return (ends - (counts - 1) / 2.0)[inverse]
+
+
+def rank_auc(positive, scores):
+    """
+    ROC AUC as the Mann-Whitney U statistic of the scores
+    :param positive: boolean mask of positive samples
+    :param scores: score of being positive
+    :return: AUC, None if only one class is present
+    """
+    n_pos = int(np.count_nonzero(positive))
+    n_neg = len(positive) - n_pos
+    if n_pos == 0 or n_neg == 0:
+        return None
+    rank_sum = average_ranks(scores)[positive].sum()
+    return float((rank_sum - n_pos * (n_pos + 1) / 2.0) / (n_pos * n_neg))
+
+
+def roc_auc(y_true, proba, classes):
+    """
+    ROC AUC from predicted probabilities. Multiclass is the macro average of one-vs-rest AUCs
+    :param y_true: labels
+    :param proba: probabilities of shape (n, len(classes)), columns in the order of classes
+    :param classes: sorted labels
+    :return: AUC, None if it is undefined
+    """
+    if len(classes) == 2:
+        return rank_auc(y_true == classes[1], proba[:, 1])
+    aucs = [rank_auc(y_true == c, proba[:, i]) for i, c in enumerate(classes)]
+    aucs = [a for a in aucs if a is not None]
+    return float(np.mean(aucs)) if aucs else None
+
+
+def classification_metrics(y_true, proba, classes) -> dict:
+    """
+    Metrics of a classifier from its predicted probabilities: predictions are the most probable classes,
+    counts come from a single confusion matrix and AUC from a single ranking per class.
+    Binary metrics are those of classes[1] as the positive class. Multiclass metrics are macro averages of
+    one-vs-rest metrics. Labels missing from classes are counted as always mispredicted.
+    :param y_true: labels
+    :param proba: probabilities of shape (n, len(classes))
+    :param classes: sorted labels
+    :return: dict of accuracy, auc, sensitivity, specificity, ppv, npv, f1 and the confusion matrix
+    """
+    classes = np.asarray(classes)
+    y_true = np.asarray(y_true)
+    proba = np.asarray(proba)
+    y_pred = classes[np.argmax(proba, axis=1)]
+    labels = all_labels(classes, y_true)
+    cm = confusion(y_true, y_pred, labels)
+    total = cm.sum()
+    tp = np.diag(cm)
+    fp = cm.sum(axis=0) - tp
+    fn = cm.sum(axis=1) - tp
+    tn = total - tp - fp - fn
+    sensitivity = _divide(tp, tp + fn)
+    specificity = _divide(tn, tn + fp)
+    ppv = _divide(tp, tp + fp)
+    npv = _divide(tn, tn + fn)
+    f1 = _divide(2 * ppv * sensitivity, ppv + sensitivity)
+
+    positive = int(np.searchsorted(labels, classes[1])) if len(classes) == 2 else None
+
+    def pick(a):
+        return float(a[positive]) if positive is not None else float(a.mean())
+
+    return {
+        'accuracy': float(_divide(tp.sum(), total)),
+        'auc': roc_auc(y_true, proba, classes),
+        'sensitivity': pick(sensitivity),
+        'specificity': pick(specificity),
+        'ppv': pick(ppv),
+        'npv': pick(npv),
+        'f1': pick(f1),
+        'confusion_matrix': cm.tolist()
+    }
+
+
+def log_loss(y_true, proba, classes) -> float:
+    """
+    Mean negative log likelihood of the labels
+    :param y_true: labels
+    :param proba: probabilities of shape (n, len(classes)), columns in the order of classes
+    :param classes: sorted labels. Labels missing from them have probability 0
+    :return: loss, None without samples
+    """
+    y_true = np.asarray(y_true)
+    if not len(y_true):
+        return None
+    classes = np.asarray(classes)
+    proba = np.asarray(proba, dtype=np.float64)
+    index = np.minimum(np.searchsorted(classes, y_true), len(classes) - 1)
+    seen = classes[index] == y_true
+    p = np.where(seen, proba[np.arange(len(y_true)), index], 0.0)
+    return float(-np.log(np.clip(p, 1e-15, 1.0)).mean())
@@ -0,0 +1,54 @@
+import numpy as np
+from sklearn.preprocessing import StandardScaler
+
+from friendlyfl.controller.file.file_utils import iter_dataset_by_run
+
+
+def test_mask(start, n, test_size, seed=42):
+    """
+    Deterministic train/test assignment of rows by their global index,
+    so every pass over the dataset splits it the same way regardless of chunking.
+    :param start: index of the first row
+    :param n: number of rows
+    :param test_size: fraction of rows used for testing
+    :param seed: seed of the split
+    :return: boolean mask, True for test rows
+    """
+    with np.errstate(over='ignore'):
+        h = np.arange(start, start + n, dtype=np.uint64) + np.uint64(seed)
+        # splitmix64 finalizer
+        h = (h ^ (h >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+        h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+        h = h ^ (h >> np.uint64(31))
+    return (h >> np.uint64(11)).astype(np.float64) / float(1 << 53) < test_size
+
+
+def iter_split(run_id, chunk_size, test_size, test=False, seed=42):
+    """
+    Read train or test rows of the dataset chunk by chunk
+    :return: generator of (X, y)
+    """
+    for start, X, y in iter_dataset_by_run(run_id, chunk_size):
+        mask = test_mask(start, len(y), test_size, seed)
+        if not test:
+            mask = ~mask
+        if mask.any():
+            yield X[mask], y[mask]
+
+
+def scan_dataset(run_id, chunk_size, test_size, seed=42):
+    """
+    One pass over the dataset to fit scaling statistics on train rows incrementally and collect labels
+    :return: (scaler, classes, number of rows)
+    """
+    scaler = StandardScaler()
+    classes = np.array([])
+    rows = 0
+    for start, X, y in iter_dataset_by_run(run_id, chunk_size):
+        rows += len(y)
+        classes = np.union1d(classes, np.unique(y)) if len(
+            classes) else np.unique(y)
+        train = ~test_mask(start, len(y), test_size, seed)
+        if train.any():
+            scaler.partial_fit(X[train])
+    return scaler, classes, rows
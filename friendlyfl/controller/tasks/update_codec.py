@@ -0,0 +1,128 @@
+"""
+Encoding of participant updates to cut upload size.
+
+An update is encoded tensor by tensor:
+    delta           the difference from the global model it was trained from, instead of the model itself
+    top_k           only the k entries of largest magnitude are kept, with their flat indices
+    quantize        float16, or int8 with a symmetric scale per tensor
+    error_feedback  what encoding dropped is kept locally and added to the next update
+
+Encoded tensors are stored under their name, indices under '<name>.index' and scales under '<name>.scale'.
+How to decode them is written to the 'encoding' entry of the artifact metadata.
+"""
+import numpy as np
+
+index_suffix = '.index'
+
+scale_suffix = '.scale'
+
+
+def parse_encoding(config) -> dict:
+    """
+    Read the update encoding of a task config.
+    Example: {"update_encoding": {"delta": true, "quantize": "int8", "top_k": 0.1, "error_feedback": true}}
+    top_k is a number of entries per tensor or, when below 1, a fraction of them
+    :param config: task config
+    :return: encoding spec, None when updates are sent as they are
+    """
+    spec = config.get('update_encoding')
+    if not spec:
+        return None
+    quantize = spec.get('quantize')
+    if quantize not in (None, 'float16', 'int8'):
+        raise ValueError('Unknown quantization {}'.format(quantize))
+    return {'delta': bool(spec.get('delta', True)),
+            'quantize': quantize,
+            'top_k': spec.get('top_k'),
+            'error_feedback': bool(spec.get('error_feedback', False))}
+
+
+def _top_k_count(size, top_k):
+    if top_k is None:
+        return size
+    k = int(np.ceil(top_k * size)) if top_k < 1 else int(top_k)
+    return max(1, min(k, size))
+
+
+def _quantize(values, quantize):
+    if quantize == 'float16':
+        return values.astype(np.float16), None
+    if quantize == 'int8':
+        peak = float(np.max(np.abs(values))) if values.size else 0.0
+        scale = peak / 127 if peak > 0 else 1.0
+        return np.clip(np.rint(values / scale), -127, 127).astype(np.int8), np.float64(scale)
+    return values, None
+
+
+def _dequantize(values, scale):
+    values = values.astype(np.float64)
+    return values * scale if scale is not None else values
+
+
+def encode_update(tensors: dict, spec: dict, base: dict = None, residual: dict = None):
+    """
+    :param tensors: name to array of the trained model
+    :param spec: encoding spec of parse_encoding
+    :param base: global model the update was trained from, deltas are only sent against it
+    :param residual: name to what was dropped by the previous encoding, with error feedback
+    :return: (encoded tensors, encoding metadata, new residual or None)
+    """
+    use_delta = spec['delta'] and base is not None
+    encoded = dict()
+    layout = dict()
+    new_residual = dict() if spec['error_feedback'] else None
+    for name, t in tensors.items():
+        t = np.asarray(t, dtype=np.float64)
+        d = t - base[name] if use_delta else t.copy()
+        if residual is not None and name in residual and residual[name].shape == d.shape:
+            d += residual[name]
+        flat = d.ravel()
+        k = _top_k_count(flat.size, spec['top_k'])
+        index = None
+        values = flat
+        if k < flat.size:
+            index = np.argpartition(np.abs(flat), flat.size - k)[flat.size - k:].astype(np.int32)
+            index.sort()
+            values = flat[index]
+        values, scale = _quantize(values, spec['quantize'])
+        encoded[name] = values
+        if index is not None:
+            encoded[name + index_suffix] = index
+        if scale is not None:
+            encoded[name + scale_suffix] = np.asarray(scale)
+        layout[name] = {'shape': list(t.shape), 'sparse': index is not None}
+        if new_residual is not None:
+            new_residual[name] = d - _decode_tensor(values, index, scale, t.shape)
+    return encoded, {'delta': use_delta, 'tensors': layout}, new_residual
+
+
+def _decode_tensor(values, index, scale, shape):
+    values = _dequantize(values, scale)
+    if index is None:
+        return values.reshape(shape)
+    dense = np.zeros(int(np.prod(shape, dtype=np.int64)), dtype=np.float64)
+    dense[index] = values
+    return dense.reshape(shape)
+
+
+def is_encoded(metadata: dict) -> bool:
+    return 'encoding' in metadata
+
+
+def decode_update(tensors: dict, encoding: dict, base: dict = None) -> dict:
+    """
+    :param tensors: encoded tensors
+    :param encoding: encoding metadata
+    :param base: global model the update was trained from, required for deltas
+    :return: name to array of the model
+    """
+    if encoding['delta'] and base is None:
+        raise ValueError('Base model of a delta update is not available')
+    decoded = dict()
+    for name, layout in encoding['tensors'].items():
+        index = tensors.get(name + index_suffix) if layout['sparse'] else None
+        scale = tensors.get(name + scale_suffix)
+        t = _decode_tensor(np.asarray(tensors[name]), index,
+                           float(scale) if scale is not None else None, layout['shape'])
+        decoded[name] = t + base[name] if encoding['delta'] else t
+    return decoded
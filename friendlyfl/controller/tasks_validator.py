@@ -39,6 +39,7 @@ class TaskValidator:
                 self.validate_seq(task)
                 self.validate_model(task)
                 self.validate_config(task)
+                self.validate_mode(task)
 
     def validate_keys(self, task):
         if self.is_valid():
@@ -82,3 +83,12 @@ class TaskValidator:
             if config is None or not isinstance(config, dict) or len(config) == 0:
                 self.errors.append(
                     'config must be a key-value map and could not be empty')
+
+    def validate_mode(self, task):
+        if self.is_valid() and task['config'].get('mode', 'sync') == 'async':
+            model = task['model']
+            model_class = load_class('friendlyfl.controller.tasks.{}'.format(
+                camel_to_snake(model)), model)
+            if not model_class.supports_async:
+                self.errors.append(
+                    '{} does not support mode async'.format(model))
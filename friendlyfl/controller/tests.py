@@ -1,3 +1,1191 @@
-from django.test import TestCase
+import copy
+import fnmatch
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from celery.exceptions import MaxRetriesExceededError, Retry
+from django.test import SimpleTestCase
+
+import friendlyfl.celery
+
+from friendlyfl.controller import dispatch, model_cache, router_client, run_subscriber
+from friendlyfl.controller.affinity import HashRing, WorkerRegistry
+from friendlyfl.controller.file import file_utils
+from friendlyfl.controller.file.file_utils import gen_artifacts_url, save_and_extract, save_and_extract_changed
+from friendlyfl.controller.file.multipart import compress
+from friendlyfl.controller.file.prepared_store import dataset_fingerprint, load_prepared, save_prepared
+from friendlyfl.controller.model_cache import ModelCache, instance_size
+from friendlyfl.controller.router_stub import RouterStub
+from friendlyfl.controller.run_lock import RunGuard
+from friendlyfl.controller.run_state import RunStateStore
+from friendlyfl.controller.file.artifact_format import is_binary_artifact, load_artifact, save_artifact
+from friendlyfl.controller.tasks import abstract_task, local_training
+from friendlyfl.controller.tasks.federated_statistics import chunk_histogram, chunk_statistics, \
+    finalize_statistics, merge_statistics
+from friendlyfl.controller.tasks.aggregation import RunningAggregate, ServerMomentum, parse_aggregator, reduce_updates
+from friendlyfl.controller.tasks.logistic_regression import LogisticRegression
+from friendlyfl.controller.tasks.local_training import LocalSchedule, parse_local_training
+from friendlyfl.controller.tasks.metrics import classification_metrics, confusion, log_loss
+from friendlyfl.controller.tasks.update_codec import decode_update, encode_update, is_encoded, parse_encoding
+from friendlyfl.controller.tasks_validator import TaskValidator
+
+
+class MemoryRedis:
+    """
+    In-memory stand-in of the redis commands used by the controller, shared by every client like a server
+    """
+
+    def __init__(self):
+        self.data = dict()
+        self.lock = threading.RLock()
+
+    def _alive(self, key):
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        value, expire_at = entry
+        if expire_at is not None and expire_at <= time.time():
+            del self.data[key]
+            return None
+        return value
+
+    @staticmethod
+    def _encode(value):
+        return value if isinstance(value, bytes) else str(value).encode('utf-8')
+
+    def get(self, key):
+        with self.lock:
+            return self._alive(key)
+
+    def mget(self, keys):
+        with self.lock:
+            return [self._alive(k) for k in keys]
+
+    def set(self, key, value, ex=None, px=None, nx=False):
+        with self.lock:
+            if nx and self._alive(key) is not None:
+                return None
+            ttl = ex if ex is not None else (px / 1000.0 if px is not None else None)
+            self.data[key] = (self._encode(value), time.time() + ttl if ttl else None)
+            return True
+
+    def exists(self, *keys):
+        with self.lock:
+            return sum(self._alive(k) is not None for k in keys)
+
+    def delete(self, *keys):
+        with self.lock:
+            return sum(self.data.pop(k, None) is not None for k in keys)
+
+    unlink = delete
+
+    def scan_iter(self, match='*', count=None):
+        with self.lock:
+            keys = [k for k in self.data if fnmatch.fnmatch(k, match)]
+        return iter(keys)
+
+    def pipeline(self, transaction=True):
+        return MemoryPipeline(self)
+
+    def _collection(self, key, kind):
+        with self.lock:
+            value = self._alive(key)
+            if value is None:
+                value = kind()
+                self.data[key] = (value, None)
+            return value
+
+    def zadd(self, key, mapping):
+        with self.lock:
+            self._collection(key, dict).update({self._encode(k): float(v) for k, v in mapping.items()})
+
+    def zrem(self, key, *members):
+        with self.lock:
+            zset = self._collection(key, dict)
+            return sum(zset.pop(self._encode(m), None) is not None for m in members)
+
+    def zrangebyscore(self, key, min, max, withscores=False):
+        with self.lock:
+            items = sorted((score, member) for member, score in self._collection(key, dict).items()
+                           if float(min) <= score <= float(max))
+        return [(m, score) if withscores else m for score, m in items]
+
+    def sadd(self, key, *members):
+        with self.lock:
+            self._collection(key, set).update(self._encode(m) for m in members)
+
+    def spop(self, key, count=None):
+        with self.lock:
+            members = self._collection(key, set)
+            popped = [members.pop() for _ in range(min(count or 1, len(members)))]
+        return popped if count is not None else (popped[0] if popped else None)
+
+
+class MemoryPipeline:
+
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        return [getattr(self.client, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+
+
+def stub_run(run_id, status='Standby', role='participant', site_uid='site-1', config=None):
+    c = {'current_round': 1, 'total_round': 1}
+    c.update(config or dict())
+    return {'id': run_id, 'project': 1, 'batch': 1, 'role': role, 'status': status, 'cur_seq': 1,
+            'site_uid': site_uid, 'tasks': [{'seq': 1, 'model': 'LogisticRegression', 'config': c}]}
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+class StubTestCase(SimpleTestCase):
+    """
+    Runs against an in-process router stub, with redis kept in memory
+    """
+
+    def setUp(self):
+        self.redis = MemoryRedis()
+        self.stub = RouterStub(heartbeat=1).start()
+        self.addCleanup(self.stub.stop)
+        for patcher in [mock.patch('friendlyfl.controller.redis.get_redis', return_value=self.redis),
+                        mock.patch.object(router_client, 'router_url', self.stub.url)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+def write_dataset(run_id, n, d=4, seed=0):
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(n, d))
+    y = (X @ rng.normal(size=d) > 0).astype(int)
+    url = file_utils.gen_dataset_url(run_id)
+    os.makedirs(url, exist_ok=True)
+    np.savetxt(url + file_utils.dataset_name, np.column_stack([X, y]), delimiter=',', fmt='%.6f')
+
+
+class RunSubscriberTest(StubTestCase):
+
+    def test_status_change_is_dispatched(self):
+        self.stub.add_run(stub_run(1, site_uid='site-1'))
+        self.stub.add_run(stub_run(2, site_uid='site-2'))
+        app = mock.Mock()
+        stop = threading.Event()
+        with mock.patch('friendlyfl.controller.dispatch.current_app', app), \
+                mock.patch('friendlyfl.controller.dispatch.AFFINITY_ROUTING_ENABLED', False), \
+                mock.patch.object(run_subscriber, 'RUN_SUBSCRIPTION_ENABLED', True), \
+                mock.patch.object(run_subscriber, 'site_uid', 'site-1'):
+            thread = threading.Thread(target=run_subscriber.main, args=(stop.is_set,), daemon=True)
+            thread.start()
+            self.addCleanup(stop.set)
+
+            def dispatched():
+                return [(c.args[0], c.kwargs['args'][0]['id'], c.kwargs['args'][0]['status'], c.kwargs['queue'])
+                        for c in app.send_task.call_args_list]
+
+            self.assertTrue(wait_for(lambda: len(dispatched()) == 1))
+            self.assertEqual(dispatched(), [('process_task', 1, 'Standby', 'friendlyfl.processor')])
+
+            self.stub.set_status(1, 4)
+            self.assertTrue(wait_for(lambda: len(dispatched()) == 2))
+            self.assertEqual(dispatched()[1], ('compute_task', 1, 'Running', 'friendlyfl.compute'))
+
+            # runs of other sites and unchanged runs are not dispatched again
+            self.stub.set_status(2, 4)
+            time.sleep(0.5)
+            self.assertEqual(len(dispatched()), 2)
+
+
+class CompressedDownloadTest(SimpleTestCase):
+
+    def setUp(self):
+        self.stub = RouterStub()
+        self.stub.add_run(stub_run(1))
+        self.stub.add_run(stub_run(2))
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.dir_url = os.path.join(temp_dir.name, 'download')
+
+    def upload(self, run_id, content, codec=None):
+        if codec:
+            codec, file_obj = compress(io.BytesIO(content), codec)
+            content = file_obj.read()
+        self.stub.add_upload(run_id, 1, 1, {'mid_artifacts': ('mid-artifacts', content)})
+
+    def read(self, run_id):
+        with open(os.path.join(self.dir_url, '{}-1-1-mid-artifacts'.format(run_id)), 'rb') as f:
+            return f.read()
+
+    def test_uploads_are_decompressed_by_content(self):
+        content = os.urandom(1000) + b'\x1f\x8b\x08' * 100
+        self.upload(1, content, 'gzip')
+        self.upload(2, content)
+        save_and_extract(self.dir_url, self.stub.download(1, 1, 1, True, 'mid_artifacts')[0])
+        self.assertEqual(self.read(1), content)
+        self.assertEqual(self.read(2), content)
+
+    def test_changed_uploads_are_decompressed(self):
+        self.upload(1, b'first', 'zstd')
+        body, etag = self.stub.download(1, 1, 1, True, 'mid_artifacts')
+        self.assertEqual(save_and_extract_changed(self.dir_url, body, 'round-1', etag)[1], 1)
+        self.assertEqual(self.read(1), b'first')
+        self.upload(2, b'second', 'gzip')
+        body, etag = self.stub.download(1, 1, 1, True, 'mid_artifacts')
+        self.assertEqual(save_and_extract_changed(self.dir_url, body, 'round-1', etag)[1], 1)
+        self.assertEqual(self.read(2), b'second')
+
+
+class ConditionalDownloadTest(StubTestCase):
+
+    def setUp(self):
+        super().setUp()
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        patcher = mock.patch.object(file_utils, 'base_folder', temp_dir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.stub.add_run(stub_run(1, status='Pending Aggregating', role='coordinator'))
+        self.stub.add_run(stub_run(2, status='Pending Aggregating', site_uid='site-2'))
+        self.task = LogisticRegression(copy.deepcopy(self.stub.runs[1]))
+        self.statuses = []
+
+    def upload(self, run_id, content):
+        self.stub.add_upload(run_id, 1, 1, {'mid_artifacts': ('mid-artifacts', content)})
+
+    def download(self):
+        """
+        :return: (status code of the router response, names of the extracted files)
+        """
+        get = router_client.get
+
+        def record(path, **kwargs):
+            response = get(path, **kwargs)
+            self.statuses.append(response.status_code)
+            return response
+
+        with mock.patch.object(router_client, 'get', side_effect=record), \
+                mock.patch.object(file_utils, 'extract_member', wraps=file_utils.extract_member) as extract:
+            self.assertTrue(self.task.download_mid_artifacts())
+        return self.statuses[-1], sorted(c.args[1].filename for c in extract.call_args_list)
+
+    def read(self, run_id):
+        url = os.path.join(file_utils.gen_all_mid_artifacts_url(1, 1), '{}-1-1-mid-artifacts'.format(run_id))
+        with open(url, 'rb') as f:
+            return f.read()
+
+    def test_unchanged_download_is_not_extracted_again(self):
+        self.upload(1, b'first')
+        self.upload(2, b'second')
+        self.assertEqual(self.download(), (200, ['1-1-1-mid-artifacts', '2-1-1-mid-artifacts']))
+        self.assertEqual(self.download(), (304, []))
+        self.assertEqual(self.read(2), b'second')
+
+    def test_changed_upload_is_extracted(self):
+        self.upload(1, b'first')
+        self.assertEqual(self.download(), (200, ['1-1-1-mid-artifacts']))
+        self.upload(2, b'second')
+        self.assertEqual(self.download(), (200, ['2-1-1-mid-artifacts']))
+        self.upload(2, b'second again')
+        self.assertEqual(self.download(), (200, ['2-1-1-mid-artifacts']))
+        self.assertEqual(self.read(1), b'first')
+        self.assertEqual(self.read(2), b'second again')
+        self.assertEqual(self.download(), (304, []))
+
+    def test_missing_file_is_downloaded_again(self):
+        self.upload(1, b'first')
+        self.download()
+        os.remove(os.path.join(file_utils.gen_all_mid_artifacts_url(1, 1), '1-1-1-mid-artifacts'))
+        self.assertEqual(self.download(), (200, ['1-1-1-mid-artifacts']))
+        self.assertEqual(self.read(1), b'first')
+
+
+class DatasetCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        patcher = mock.patch.object(file_utils, 'base_folder', temp_dir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.csv_url = file_utils.gen_dataset_url(1) + file_utils.dataset_name
+        os.makedirs(os.path.dirname(self.csv_url))
+        self.write('1.0,2.0,0\n3.0,4.0,1\n')
+
+    def write(self, content):
+        with open(self.csv_url, 'w') as f:
+            f.write(content)
+
+    def test_cache_is_valid_while_csv_is_unchanged(self):
+        self.assertTrue(file_utils.build_dataset_cache(1))
+        X, y = file_utils.load_dataset_cache(1)
+        self.assertEqual(X.tolist(), [[1.0, 2.0], [3.0, 4.0]])
+        self.assertEqual(y.tolist(), [0, 1])
+
+    def test_same_size_rewrite_within_mtime_resolution_is_detected(self):
+        self.assertTrue(file_utils.build_dataset_cache(1))
+        stat = os.stat(self.csv_url)
+        self.write('5.0,6.0,1\n7.0,8.0,0\n')
+        os.utime(self.csv_url, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        self.assertIsNone(file_utils.load_dataset_cache_meta(1))
+
+    def test_hash_is_not_checked_once_mtime_is_old_enough(self):
+        self.assertTrue(file_utils.build_dataset_cache(1))
+        with mock.patch.object(file_utils, 'file_sha256', wraps=file_utils.file_sha256) as sha256, \
+                mock.patch.object(file_utils.time, 'time', return_value=time.time() + 60):
+            self.assertIsNotNone(file_utils.load_dataset_cache_meta(1))
+            self.assertIsNotNone(file_utils.load_dataset_cache_meta(1))
+        self.assertEqual(sha256.call_count, 1)
+
+
+class TaskValidatorTest(SimpleTestCase):
+
+    @staticmethod
+    def validate(model, config):
+        validator = TaskValidator(json.dumps([{'seq': 1, 'model': model, 'config': config}]))
+        return validator.get_validated_tasks(), validator.get_error_msg()
+
+    def test_async_mode_needs_a_task_publishing_global_versions(self):
+        tasks, _ = self.validate('LogisticRegression', {'mode': 'async', 'total_round': 3})
+        self.assertIsNotNone(tasks)
+        tasks, error = self.validate('FederatedStatistics', {'mode': 'async'})
+        self.assertIsNone(tasks)
+        self.assertEqual(error, 'FederatedStatistics does not support mode async')
+
+
+class DispatchTest(SimpleTestCase):
+
+    def queues(self, *runs):
+        app = mock.Mock()
+        with mock.patch.object(dispatch, 'current_app', app), \
+                mock.patch.object(dispatch, 'AFFINITY_ROUTING_ENABLED', False):
+            dispatch.dispatch_runs(list(runs))
+        return [(c.args[0], c.kwargs['queue']) for c in app.send_task.call_args_list]
+
+    def test_coordinator_folding_on_arrival_runs_on_compute_queue(self):
+        compute = ('compute_task', 'friendlyfl.compute')
+        processor = ('process_task', 'friendlyfl.processor')
+        self.assertEqual(self.queues(
+            stub_run(1, 'Pending Aggregating', 'coordinator', config={'mode': 'async'}),
+            stub_run(2, 'Pending Aggregating', 'coordinator', config={'aggregation_mode': 'incremental'}),
+            stub_run(3, 'Pending Aggregating', 'coordinator'),
+            stub_run(4, 'Pending Aggregating', 'participant', config={'mode': 'async'}),
+            stub_run(5, 'Running'),
+            stub_run(6, 'Aggregating', 'coordinator')),
+            [compute, compute, processor, processor, compute, compute])
+
+
+class AffinityTest(SimpleTestCase):
+
+    def setUp(self):
+        self.redis = MemoryRedis()
+        patcher = mock.patch('friendlyfl.controller.redis.get_redis', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.registry = WorkerRegistry(ttl=30)
+        for node in ('node-1', 'node-2', 'node-3'):
+            self.registry.register('friendlyfl.compute', node)
+
+    def test_routing_looks_workers_up_once_per_dispatch(self):
+        app = mock.Mock()
+        with mock.patch.object(dispatch, 'workers', self.registry), mock.patch.object(dispatch, 'current_app', app), \
+                mock.patch.object(self.registry, 'workers', wraps=self.registry.workers) as lookups:
+            dispatch.dispatch_runs([stub_run(i, 'Running') for i in range(20)])
+        self.assertEqual(lookups.call_count, len(dispatch.affinity_queues))
+        queues = {c.kwargs['queue'] for c in app.send_task.call_args_list}
+        self.assertEqual(queues, {'friendlyfl.compute.node-1', 'friendlyfl.compute.node-2',
+                                  'friendlyfl.compute.node-3'})
+
+    def test_runs_of_departed_workers_are_dispatched_again(self):
+        runs = [stub_run(i, 'Running') for i in range(20)]
+        with mock.patch.object(dispatch, 'workers', self.registry), mock.patch.object(dispatch, 'current_app'), \
+                mock.patch.object(dispatch, 'run_state', RunStateStore()), \
+                mock.patch.object(dispatch, 'delete_queue') as delete_queue:
+            self.assertEqual(len(dispatch.check_status_change('site-1', runs)), 20)
+            self.assertEqual(dispatch.check_status_change('site-1', runs), [])
+            self.redis.zadd(self.registry.key('friendlyfl.compute'), {'node-2': time.time() - 60})
+            self.registry.deregister('friendlyfl.compute', 'node-3')
+
+            changed = dispatch.check_status_change('site-1', runs)
+            ring = HashRing(['node-1', 'node-2', 'node-3'])
+            self.assertEqual(sorted(r['id'] for r in changed),
+                             [r['id'] for r in runs if ring.node(r['id']) in ('node-2', 'node-3')])
+            self.assertEqual(sorted(c.args[0] for c in delete_queue.call_args_list),
+                             ['friendlyfl.compute.node-2', 'friendlyfl.compute.node-3'])
+            # departures are handled once
+            self.assertEqual(dispatch.check_status_change('site-1', runs), [])
+
+
+class RunningAggregateTest(SimpleTestCase):
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.url = os.path.join(temp_dir.name, 'aggregate')
+        rng = np.random.default_rng(0)
+        self.updates = [({'coef_': rng.normal(size=(1, 3)), 'intercept_': rng.normal(size=1)}, w)
+                        for w in (10, 30, 60)]
+
+    def partial(self, updates):
+        partial = RunningAggregate(None)
+        for i, (tensors, weight) in enumerate(updates):
+            partial.fold(i, tensors, weight)
+        return partial
+
+    def test_merged_partials_equal_flat_average(self):
+        flat = self.partial(self.updates)
+        merged = RunningAggregate(self.url)
+        for key, group in [('site-2', self.updates[:2]), ('site-3', self.updates[2:])]:
+            partial = self.partial(group)
+            self.assertTrue(merged.merge(key, partial.sums, partial.weight))
+        self.assertEqual(merged.weight, flat.weight)
+        for name, value in flat.result().items():
+            np.testing.assert_allclose(merged.result()[name], value)
+
+    def test_partial_is_merged_once_and_persisted(self):
+        partial = self.partial(self.updates)
+        merged = RunningAggregate(self.url)
+        self.assertTrue(merged.merge('site-2', partial.sums, partial.weight))
+        restored = RunningAggregate.load(self.url)
+        self.assertFalse(restored.merge('site-2', partial.sums, partial.weight))
+        self.assertEqual(restored.folded, {'site-2': 100})
+        np.testing.assert_allclose(restored.result()['coef_'], partial.result()['coef_'])
+
+    def test_partial_with_other_tensors_is_rejected(self):
+        merged = self.partial(self.updates[:1])
+        with self.assertRaises(ValueError):
+            merged.merge('site-2', {'coef_': np.ones((1, 3))}, 5)
+
+
+class FederationTestCase(StubTestCase):
+    """
+    A batch of runs at sites 1 to sites, the run of site-1 coordinates. Each site acts with a task instance of its own
+    """
+    sites = 3
+    config = None
+
+    def setUp(self):
+        super().setUp()
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.folder = temp_dir.name
+        self.tasks = dict()
+        for i in range(1, self.sites + 1):
+            self.stub.add_run(stub_run(i, status='Running', role='coordinator' if i == 1 else 'participant',
+                                       site_uid='site-{}'.format(i), config=self.config))
+            with self.as_site(i):
+                write_dataset(i, n=100 * i, seed=i)
+                task = self.new_task(i)
+                task.status = 'preparing'
+                self.assertTrue(task.prepare_data())
+            self.tasks[i] = task
+
+    def new_task(self, i):
+        return LogisticRegression(copy.deepcopy(self.stub.runs[i]))
+
+    @contextmanager
+    def as_site(self, i):
+        """
+        Act as site i, with its own local folder like a controller of its own
+        """
+        with mock.patch.object(abstract_task, 'site_uid', 'site-{}'.format(i)), \
+                mock.patch.object(file_utils, 'base_folder', os.path.join(self.folder, str(i))):
+            yield
+
+    def step(self, i, *handlers):
+        """
+        Handle statuses at site i like handle_run does, with the run as the router has it
+        :return: status of the run afterwards
+        """
+        with self.as_site(i):
+            for handler in handlers:
+                self.tasks[i].method_call(handler, copy.deepcopy(self.stub.runs[i]), False)
+        return self.stub.runs[i]['status']
+
+
+class HierarchicalAggregationTest(FederationTestCase):
+    """
+    Coordinator site-1 aggregates the partial aggregates of sub-aggregators site-2 and site-5,
+    which aggregate the updates of their members and their own
+    """
+    sites = 7
+    config = {'hierarchy': {'site-2': ['site-3', 'site-4'], 'site-5': ['site-6', 'site-7']}}
+
+    def test_global_model_equals_flat_average(self):
+        for i in range(1, 8):
+            self.step(i, 'running', 'pending_success')
+        # sub-aggregators wait for their members, then send their partial aggregate
+        for i in (2, 5):
+            self.step(i, 'pending_success')
+        updates = [(t.logisticRegr.coef_.copy(), t.logisticRegr.intercept_.copy(), t.sample_size)
+                   for t in self.tasks.values()]
+
+        self.assertEqual(self.step(1, 'pending_aggregating'), 'Aggregating')
+        with self.as_site(1):
+            self.assertEqual(self.tasks[1].running_aggregate().folded, {'1': 100, '2': 900, '5': 1800})
+        self.step(1, 'aggregating')
+
+        total = sum(w for _, _, w in updates)
+        coordinator = self.tasks[1]
+        self.assertEqual(coordinator.sample_size, total)
+        np.testing.assert_allclose(coordinator.logisticRegr.coef_, sum(c * w for c, _, w in updates) / total)
+        np.testing.assert_allclose(coordinator.logisticRegr.intercept_, sum(b * w for _, b, w in updates) / total)
+
+
+class IncrementalAggregationTest(FederationTestCase):
+    config = {'aggregation_mode': 'incremental'}
+
+    def folded(self):
+        with self.as_site(1):
+            aggregate = self.tasks[1].running_aggregate()
+        return aggregate.folded, aggregate.weight, {k: v.copy() for k, v in aggregate.sums.items()}
+
+    def test_update_is_folded_once_across_retries_and_reloads(self):
+        self.step(1, 'running', 'pending_success')
+        self.step(2, 'running', 'pending_success')
+        self.step(3, 'running')
+        self.assertEqual(self.step(1, 'pending_aggregating'), 'Pending Aggregating')
+        folded, weight, sums = self.folded()
+        self.assertEqual((folded, weight), ({'1': 100, '2': 200}, 300))
+
+        # monitor_run retries the waiting status, on this instance and on a worker starting afresh
+        self.assertEqual(self.step(1, 'pending_aggregating'), 'Pending Aggregating')
+        self.tasks[1] = self.new_task(1)
+        self.assertEqual(self.step(1, 'pending_aggregating'), 'Pending Aggregating')
+        retried, retried_weight, retried_sums = self.folded()
+        self.assertEqual((retried, retried_weight), (folded, weight))
+        for name, value in sums.items():
+            np.testing.assert_array_equal(retried_sums[name], value)
+
+        self.step(3, 'pending_success')
+        self.assertEqual(self.step(1, 'pending_aggregating'), 'Aggregating')
+        self.assertEqual(self.folded()[:2], ({'1': 100, '2': 200, '3': 300}, 600))
+
+
+class RoundDeadlineTest(FederationTestCase):
+    config = {'total_round': 2, 'round_deadline': 60, 'min_quorum': 2, 'late_update_discount': 0.5}
+
+    def update(self, i):
+        model = self.tasks[i].logisticRegr
+        return model.coef_.copy(), model.intercept_.copy()
+
+    def pass_deadline(self, round_seq):
+        key = abstract_task.round_clock.key(1, 1, round_seq)
+        self.redis.set(key, float(self.redis.get(key)) - 61)
+
+    def test_round_clock_keeps_first_start(self):
+        clock = abstract_task.round_clock
+        clock.mark(9, 1, 1)
+        start = float(self.redis.get(clock.key(9, 1, 1)))
+        clock.mark(9, 1, 1)
+        self.assertEqual(float(self.redis.get(clock.key(9, 1, 1))), start)
+        self.assertLess(clock.elapsed(9, 1, 1), 60)
+        self.assertLess(clock.elapsed(9, 1, 2), 1)
+
+    def test_late_update_is_folded_into_next_round_discounted(self):
+        self.step(1, 'running', 'pending_success')
+        late_run = copy.deepcopy(self.stub.runs[3])
+        # past the deadline, the coordinator waits for the quorum
+        self.pass_deadline(1)
+        self.assertEqual(self.step(1, 'pending_aggregating'), 'Pending Aggregating')
+        self.step(2, 'running', 'pending_success')
+        self.assertEqual(self.step(1, 'pending_aggregating'), 'Aggregating')
+        self.assertEqual(self.step(1, 'aggregating'), 'Standby')
+        with self.as_site(1):
+            self.assertEqual(self.tasks[1].running_aggregate(1).folded, {'1': 100, '2': 200})
+
+        # site-3 finishes training of round 1 after it moved on, its update is uploaded for round 1 only
+        with self.as_site(3):
+            self.tasks[3].method_call('running', late_run, False)
+        self.assertEqual(self.stub.runs[3]['status'], 'Standby')
+        late = self.update(3)
+
+        self.stub.set_status(1, 'Running', update_all=True)
+        updates = dict()
+        for i in range(1, 4):
+            self.step(i, 'running', 'pending_success')
+            updates[i] = self.update(i)
+        self.assertEqual(self.step(1, 'pending_aggregating'), 'Aggregating')
+        with self.as_site(1):
+            self.assertEqual(self.tasks[1].running_aggregate(2).folded,
+                             {'1': 100, '2': 200, '3': 300, '3@1': 150})
+        self.assertEqual(self.step(1, 'aggregating'), 'Success')
+
+        weighted = [(updates[i], 100 * i) for i in updates] + [(late, 150)]
+        total = sum(w for _, w in weighted)
+        coordinator = self.tasks[1]
+        self.assertEqual(coordinator.sample_size, total)
+        np.testing.assert_allclose(coordinator.logisticRegr.coef_, sum(u[0] * w for u, w in weighted) / total)
+        np.testing.assert_allclose(coordinator.logisticRegr.intercept_, sum(u[1] * w for u, w in weighted) / total)
+
+
+class ColdCoordinatorTest(FederationTestCase):
+    """
+    The coordinator aggregates on a worker whose instance of the run never prepared data nor trained
+    """
+
+    def test_instance_which_never_trained_aggregates(self):
+        updates = []
+        for i in range(1, self.sites + 1):
+            self.assertEqual(self.step(i, 'running', 'pending_success'), 'Pending Aggregating')
+            model = self.tasks[i].logisticRegr
+            updates.append((model.coef_.copy(), model.intercept_.copy(), self.tasks[i].sample_size))
+        self.assertEqual(self.step(1, 'pending_aggregating'), 'Aggregating')
+
+        self.tasks[1] = self.new_task(1)
+        self.assertEqual(self.step(1, 'aggregating'), 'Success')
+        total = sum(w for _, _, w in updates)
+        coordinator = self.tasks[1]
+        np.testing.assert_allclose(coordinator.logisticRegr.coef_, sum(c * w for c, _, w in updates) / total)
+        np.testing.assert_allclose(coordinator.logisticRegr.intercept_, sum(b * w for _, b, w in updates) / total)
+        self.assertEqual(coordinator.logisticRegr.classes_.tolist(), [0, 1])
+        with self.as_site(1):
+            tensors, metadata = load_artifact(gen_artifacts_url(1, 1, 1))
+        self.assertEqual(metadata['sample_size'], total)
+        self.assertIn('metric_acc', metadata)
+
+
+class StreamingColdCoordinatorTest(ColdCoordinatorTest):
+    config = {'streaming': True, 'chunk_size': 64}
+
+
+class ComputeRouteTest(FederationTestCase):
+    """
+    The coordinator folds and aggregates on compute workers, each starting with an empty model cache
+    """
+    config = {'aggregation_mode': 'incremental'}
+
+    def compute(self, i):
+        run = copy.deepcopy(self.stub.runs[i])
+        self.assertTrue(dispatch.is_compute(run))
+        guard = mock.Mock()
+        guard.locked.return_value = nullcontext(True)
+        guard.is_done.return_value = False
+        with self.as_site(i), mock.patch.object(friendlyfl.celery, 'run_guard', guard), \
+                mock.patch.object(friendlyfl.celery, 'ml_models', ModelCache()):
+            friendlyfl.celery.compute_task(run, False)
+        return self.stub.runs[i]['status']
+
+    def test_cold_compute_workers_aggregate(self):
+        updates = []
+        for i in range(1, self.sites + 1):
+            self.step(i, 'running', 'pending_success')
+            model = self.tasks[i].logisticRegr
+            updates.append((model.coef_.copy(), model.intercept_.copy(), self.tasks[i].sample_size))
+        self.assertEqual(self.compute(1), 'Aggregating')
+        self.assertEqual(self.compute(1), 'Success')
+
+        with self.as_site(1):
+            tensors, metadata = load_artifact(gen_artifacts_url(1, 1, 1))
+        total = sum(w for _, _, w in updates)
+        self.assertEqual(metadata['sample_size'], total)
+        np.testing.assert_allclose(tensors['coef_'], sum(c * w for c, _, w in updates) / total)
+        np.testing.assert_allclose(tensors['intercept_'], sum(b * w for _, b, w in updates) / total)
+
+
+class MetricsTest(SimpleTestCase):
+
+    def test_labels_missing_from_classes_get_their_own_row(self):
+        self.assertEqual(confusion([0, 1, 2], [0, 1, 1], [0, 1]).tolist(), [[1, 0, 0], [0, 1, 0], [0, 1, 0]])
+
+    def test_positive_class_is_kept_with_labels_missing_from_classes(self):
+        proba = np.array([[0.2, 0.8], [0.6, 0.4], [0.5, 0.5]])
+        m = classification_metrics([2, 2, 0], proba, [1, 2])
+        self.assertEqual(m['confusion_matrix'], [[0, 1, 0], [0, 0, 0], [0, 1, 1]])
+        self.assertEqual(m['sensitivity'], 0.5)
+        self.assertEqual(m['ppv'], 1.0)
+
+    def test_log_loss_of_labels_missing_from_classes(self):
+        proba = np.array([[0.8, 0.2], [0.3, 0.7], [0.4, 0.6]])
+        self.assertAlmostEqual(log_loss([0, 1], proba[:2], [0, 1]), -np.log([0.8, 0.7]).mean())
+        self.assertAlmostEqual(log_loss([0, 1, 2], proba, [0, 1]), -np.log([0.8, 0.7, 1e-15]).mean())
+
+
+class FederatedStatisticsTest(StubTestCase):
+
+    def setUp(self):
+        super().setUp()
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        patcher = mock.patch.object(file_utils, 'base_folder', temp_dir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_histogram_bins_are_bounded_and_clamped(self):
+        X = np.array([[-100.0, 0.5], [0.1, 0.5], [0.9, 2.0], [100.0, np.nan]])
+        features, bins, counts = chunk_histogram(X, np.array([[0.0, 1.0], [0.0, 1.0]]), 2)
+        self.assertEqual(list(zip(features.tolist(), bins.tolist(), counts.tolist())),
+                         [(0, 0, 2), (0, 1, 2), (1, 1, 3)])
+
+    def test_missing_values_are_left_out_of_statistics(self):
+        X = np.array([[1.0, np.nan, np.nan], [2.0, 4.0, np.nan], [np.nan, 6.0, np.nan],
+                      [4.0, np.nan, 1.0], [5.0, 10.0, 3.0]])
+        stats = finalize_statistics(merge_statistics(chunk_statistics(X[:3]), chunk_statistics(X[3:])))
+        self.assertEqual(stats['count'].tolist(), [4, 3, 2])
+        np.testing.assert_allclose(stats['mean'], np.nanmean(X, axis=0))
+        np.testing.assert_allclose(stats['var'], np.nanvar(X, axis=0))
+        self.assertEqual(stats['min'].tolist(), [1.0, 4.0, 1.0])
+        self.assertEqual(stats['max'].tolist(), [5.0, 10.0, 3.0])
+
+    def test_statistics_of_an_earlier_task_are_downloaded(self):
+        tasks = [{'seq': 1, 'model': 'FederatedStatistics', 'config': {'total_round': 1}},
+                 {'seq': 2, 'model': 'LogisticRegression', 'config': {'current_round': 1, 'total_round': 1}},
+                 {'seq': 3, 'model': 'LogisticRegression', 'config': {'current_round': 1, 'total_round': 1}}]
+        coordinator = dict(stub_run(1, role='coordinator'), tasks=tasks, cur_seq=3)
+        participant = dict(stub_run(2, site_uid='site-2'), tasks=tasks, cur_seq=3)
+        self.stub.add_run(coordinator)
+        self.stub.add_run(participant)
+        task = LogisticRegression(participant)
+        self.assertEqual(task.global_statistics(), (None, None))
+
+        url = os.path.join(file_utils.base_folder, 'statistics')
+        save_artifact(url, {'mean': np.array([1.0, 2.0]), 'std': np.array([1.0, 1.0])}, {'statistics': True})
+        with open(url, 'rb') as f:
+            self.stub.add_upload(1, 1, 1, {'artifacts': ('artifacts', f.read())})
+        seq_no, stats = task.global_statistics()
+        self.assertEqual(seq_no, 1)
+        self.assertEqual(stats['mean'].tolist(), [1.0, 2.0])
+
+
+class BatchSnapshotTest(StubTestCase):
+
+    def setUp(self):
+        super().setUp()
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        patcher = mock.patch.object(file_utils, 'base_folder', temp_dir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for i in range(1, 4):
+            self.stub.add_run(stub_run(i, status='Running', role='coordinator' if i == 1 else 'participant',
+                                       site_uid='site-{}'.format(i)))
+        self.task = LogisticRegression(copy.deepcopy(self.stub.runs[2]))
+
+    def statuses(self, runs):
+        return [r['status'] for r in runs]
+
+    def test_lookups_share_the_snapshot(self):
+        self.task.in_event = True
+        self.assertEqual(self.statuses(self.task.fetch_runs()), ['Running'] * 3)
+        self.stub.set_status(3, 'Pending Success')
+        self.assertEqual(self.statuses(self.task.fetch_runs()), ['Running'] * 3)
+        # another worker of the site
+        other = LogisticRegression(copy.deepcopy(self.stub.runs[3]))
+        self.assertEqual(self.statuses(other.fetch_runs()), ['Running'] * 3)
+        # a status update of the site invalidates it
+        other.notify(5)
+        self.assertEqual(self.statuses(other.fetch_runs()), ['Running', 'Running', 'Pending Success'])
+
+    def test_status_change_checks_read_the_router(self):
+        self.task.in_event = True
+        self.task.fetch_runs()
+        # other sites move on while the snapshot is cached
+        self.stub.set_status(1, 'Pending Aggregating', update_all=True)
+        self.assertTrue(self.task.runs_in_same_state('pending_aggregating'))
+        self.assertTrue(self.task.is_superseded())
+        self.stub.set_status(2, 'Running')
+        self.assertFalse(self.task.is_superseded())
+        self.assertFalse(self.task.runs_in_same_state('pending_aggregating'))
+        # and refresh it for the lookups of the event and of the other workers
+        self.assertEqual(self.statuses(self.task.fetch_runs()),
+                         ['Pending Aggregating', 'Running', 'Pending Aggregating'])
+        self.task.in_event = False
+        self.task.event_runs = None
+        self.stub.set_status(3, 'Running')
+        self.assertEqual(self.statuses(self.task.fetch_runs())[2], 'Pending Aggregating')
+
+
+class RunGuardTest(SimpleTestCase):
+
+    def setUp(self):
+        self.redis = mock.Mock()
+        patcher = mock.patch('friendlyfl.controller.redis.get_redis', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_lock_is_waited_for_briefly(self):
+        lock = self.redis.lock.return_value
+        lock.acquire.return_value = True
+        with RunGuard().locked(7, 2.5) as held:
+            self.assertTrue(held)
+        lock.acquire.assert_called_once_with(blocking=True, blocking_timeout=2.5)
+        lock.release.assert_called_once_with()
+
+    def test_busy_transition_is_retried_then_dropped(self):
+        guard = mock.Mock()
+        guard.locked.return_value = nullcontext(False)
+        task = mock.Mock()
+        task.retry.side_effect = Retry()
+        run = stub_run(7, 'Running')
+        with mock.patch.object(friendlyfl.celery, 'run_guard', guard), \
+                mock.patch.object(friendlyfl.celery, 'run_state') as run_state, \
+                mock.patch.object(friendlyfl.celery, 'handle_run') as handle_run:
+            with self.assertRaises(Retry):
+                friendlyfl.celery.guarded_run(task, run, False)
+            task.retry.side_effect = MaxRetriesExceededError()
+            friendlyfl.celery.guarded_run(task, run, False)
+        guard.locked.assert_called_with(7, friendlyfl.celery.RUN_LOCK_WAIT)
+        task.retry.assert_called_with(countdown=friendlyfl.celery.RUN_LOCK_RETRY_DELAY,
+                                      max_retries=friendlyfl.celery.RUN_LOCK_MAX_RETRIES)
+        run_state.remove.assert_called_once_with(7)
+        handle_run.assert_not_called()
+
+
+class RunStateStoreTest(SimpleTestCase):
+
+    def setUp(self):
+        self.redis = MemoryRedis()
+        patcher = mock.patch('friendlyfl.controller.redis.get_redis', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.store = RunStateStore()
+
+    def test_diff_returns_new_and_changed_runs_only(self):
+        runs = [stub_run(1, 'Standby'), stub_run(2, 'Running')]
+        self.assertEqual(self.store.snapshot(runs), {1: None, 2: None})
+        self.assertEqual([r['id'] for r in self.store.diff(runs)], [1, 2])
+        self.assertEqual(self.store.snapshot(runs), {1: 'standby', 2: 'running'})
+        self.assertEqual(self.store.diff(runs), [])
+        runs[1]['status'] = 'Pending Success'
+        self.assertEqual([r['id'] for r in self.store.diff(runs)], [2])
+        self.assertEqual(self.store.snapshot(runs)[2], 'pending_success')
+
+    def test_reset_deletes_keys_in_batches(self):
+        self.store.save([stub_run(i) for i in range(5)])
+        self.redis.set('other', 1)
+        with mock.patch.object(self.redis, 'unlink', wraps=self.redis.unlink) as unlink:
+            self.store.reset(batch_size=2)
+        self.assertEqual([len(c.args) for c in unlink.call_args_list], [2, 2, 1])
+        self.assertEqual(list(self.redis.data), ['other'])
+        self.assertEqual(len(self.store.diff([stub_run(1)])), 1)
+
+
+class Holder:
+
+    def __init__(self, **arrays):
+        self.__dict__.update(arrays)
+
+
+class ModelCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        self.now = 0
+        patcher = mock.patch.object(model_cache.time, 'monotonic', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_evicts_least_recently_used(self):
+        cache = ModelCache(max_entries=2, sizeof=lambda i: 0)
+        cache.put('1_1', 'a')
+        cache.put('2_1', 'b')
+        self.assertEqual(cache.get('1_1'), 'a')
+        cache.put('3_1', 'c')
+        self.assertIsNone(cache.get('2_1'))
+        self.assertEqual(cache.get('1_1'), 'a')
+        self.assertEqual(cache.get('3_1'), 'c')
+
+    def test_expires_entries_after_ttl(self):
+        cache = ModelCache(ttl=10, sizeof=lambda i: 0)
+        cache.put('1_1', 'a')
+        self.now = 8
+        self.assertEqual(cache.get('1_1'), 'a')
+        self.now = 16
+        self.assertEqual(cache.get('1_1'), 'a')
+        self.now = 27
+        self.assertIsNone(cache.get('1_1'))
+        self.assertEqual(cache.stats()['entries'], 0)
+
+    def test_keeps_within_byte_budget(self):
+        cache = ModelCache(max_bytes=1000)
+        cache.put('1_1', Holder(w=np.zeros(50)))
+        cache.put('2_1', Holder(w=np.zeros(50)))
+        self.assertEqual(cache.size(), 800)
+        cache.put('3_1', Holder(w=np.zeros(50)))
+        self.assertIsNone(cache.get('1_1'))
+        self.assertEqual(cache.size(), 800)
+        big = Holder(w=np.zeros(200))
+        cache.put('4_1', big)
+        self.assertIs(cache.get('4_1'), big)
+        self.assertEqual(cache.stats()['entries'], 1)
+
+    def test_evict_run_removes_all_tasks_of_run(self):
+        cache = ModelCache(sizeof=lambda i: 0)
+        for key in ['1_1', '1_2', '11_1', '2_1']:
+            cache.put(key, key)
+        cache.evict_run(1)
+        self.assertEqual(list(cache.entries), ['11_1', '2_1'])
+
+    def test_memory_mapped_arrays_are_not_counted(self):
+        with tempfile.TemporaryDirectory() as folder:
+            mapped = np.lib.format.open_memmap(os.path.join(folder, 'w.npy'), mode='w+',
+                                               dtype=np.float64, shape=(1000,))
+            mapped.flush()
+            save_artifact(os.path.join(folder, 'a.bin'), {'w': np.zeros(1000)})
+            viewed, _ = load_artifact(os.path.join(folder, 'a.bin'))
+            holder = Holder(w=mapped, v=viewed['w'], b=np.zeros(10), layers=[mapped, np.zeros(5)])
+            self.assertEqual(instance_size(holder), 120)
+            del mapped, viewed, holder
+
+
+class ArtifactFormatTest(SimpleTestCase):
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.url = os.path.join(temp_dir.name, 'artifact')
+
+    def test_binary_round_trip(self):
+        tensors = {'coef': np.arange(12, dtype=np.float64).reshape(3, 4),
+                   'intercept': np.array([0.5, -0.5], dtype=np.float32),
+                   'classes': np.array([0, 1], dtype=np.int64),
+                   'count': np.asarray(7, dtype=np.int32)}
+        save_artifact(self.url, tensors, {'round': 2, 'mode': 'sync'})
+        self.assertTrue(is_binary_artifact(self.url))
+        loaded, metadata = load_artifact(self.url)
+        self.assertEqual(metadata, {'round': 2, 'mode': 'sync'})
+        self.assertEqual(list(loaded), list(tensors))
+        for name, a in tensors.items():
+            self.assertEqual(loaded[name].dtype, a.dtype)
+            self.assertEqual(loaded[name].shape, a.shape)
+            np.testing.assert_array_equal(loaded[name], a)
+        self.assertFalse(loaded['coef'].flags.writeable)
+
+    def test_legacy_json_is_readable(self):
+        with open(self.url, 'w') as f:
+            f.write(json.dumps({'coef': [[0.0, 0.0]], 'intercept': [0.0], 'round': 1}) + '\n')
+            f.write(json.dumps({'coef': [[1.0, 2.0]], 'intercept': [3.0], 'round': 2}) + '\n\n')
+        self.assertFalse(is_binary_artifact(self.url))
+        tensors, metadata = load_artifact(self.url)
+        self.assertEqual(tensors['coef'].tolist(), [[1.0, 2.0]])
+        self.assertEqual(tensors['intercept'].tolist(), [3.0])
+        self.assertEqual(metadata, {'round': 2})
+
+
+class PreparedStoreTest(SimpleTestCase):
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        patcher = mock.patch.object(file_utils, 'base_folder', temp_dir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        write_dataset(1, 20)
+        self.params = {'test_size': 0.2, 'random_state': 42, 'statistics_seq': None}
+
+    def save(self):
+        fingerprint = dataset_fingerprint(1)
+        self.assertTrue(save_prepared(1, fingerprint, 'in_memory', {'y': np.arange(3)}, self.params))
+        return fingerprint
+
+    def test_prepared_data_is_reused_with_same_dataset_and_params(self):
+        self.save()
+        arrays = load_prepared(1, dataset_fingerprint(1), 'in_memory', dict(self.params))
+        self.assertEqual(arrays['y'].tolist(), [0, 1, 2])
+        self.assertIsNone(load_prepared(1, dataset_fingerprint(1), 'streaming', self.params))
+
+    def test_changed_params_invalidate_prepared_data(self):
+        fingerprint = self.save()
+        self.assertIsNone(load_prepared(1, fingerprint, 'in_memory', dict(self.params, statistics_seq=1)))
+        self.assertIsNone(load_prepared(1, fingerprint, 'in_memory', dict(self.params, test_size=0.3)))
+
+    def test_changed_dataset_invalidates_prepared_data(self):
+        fingerprint = self.save()
+        write_dataset(1, 20, seed=1)
+        self.assertNotEqual(dataset_fingerprint(1), fingerprint)
+        self.assertIsNone(load_prepared(1, dataset_fingerprint(1), 'in_memory', self.params))
+
+
+class AggregatorTest(SimpleTestCase):
+
+    def setUp(self):
+        self.updates = [({'w': np.array([v, -v])}, w) for v, w in [(1.0, 10), (2.0, 10), (3.0, 10), (100.0, 1)]]
+
+    def test_median_ignores_outliers_and_weights(self):
+        result = reduce_updates(self.updates, 'median')
+        self.assertEqual(result['w'].tolist(), [2.5, -2.5])
+        self.assertEqual(reduce_updates(self.updates[:3], 'median')['w'].tolist(), [2.0, -2.0])
+
+    def test_trimmed_mean_drops_largest_and_smallest(self):
+        self.assertEqual(reduce_updates(self.updates, 'trimmed_mean', trim_ratio=0.25)['w'].tolist(), [2.5, -2.5])
+        # too few updates to trim any, all are averaged
+        self.assertEqual(reduce_updates(self.updates[:3], 'trimmed_mean')['w'].tolist(), [2.0, -2.0])
+
+    def test_trimmed_mean_rejects_trimming_every_update(self):
+        for trim_ratio in (0.5, 0.7):
+            with self.assertRaises(ValueError):
+                reduce_updates(self.updates, 'trimmed_mean', trim_ratio=trim_ratio)
+        with self.assertRaises(ValueError):
+            reduce_updates(self.updates[:2], 'trimmed_mean', trim_ratio=0.5)
+
+    def test_parse_aggregator(self):
+        self.assertEqual(parse_aggregator({}), ('weighted_mean', {}))
+        self.assertEqual(parse_aggregator({'aggregator': 'median'}), ('median', {}))
+        self.assertEqual(parse_aggregator({'aggregator': {'name': 'trimmed_mean', 'trim_ratio': 0.2}}),
+                         ('trimmed_mean', {'trim_ratio': 0.2}))
+        self.assertEqual(parse_aggregator({'aggregator': {'momentum': 0.5}}), ('weighted_mean', {'momentum': 0.5}))
+        self.assertEqual(parse_aggregator({'aggregator': 'server_momentum'}), ('server_momentum', {}))
+        with self.assertRaises(ValueError):
+            parse_aggregator({'aggregator': 'mode'})
+
+    def test_server_momentum_carries_velocity_across_rounds(self):
+        momentum = ServerMomentum(server_lr=1.0, momentum=0.5)
+        previous = {'w': np.array([1.0, 1.0])}
+        result, velocity = momentum.apply(previous, {'w': np.array([0.0, 2.0])})
+        self.assertEqual(velocity['w'].tolist(), [1.0, -1.0])
+        self.assertEqual(result['w'].tolist(), [0.0, 2.0])
+        # same step again, the velocity of the previous round adds up
+        result, velocity = momentum.apply(result, {'w': np.array([-1.0, 3.0])}, velocity)
+        self.assertEqual(velocity['w'].tolist(), [1.5, -1.5])
+        self.assertEqual(result['w'].tolist(), [-1.5, 3.5])
+        result, velocity = ServerMomentum(server_lr=0.5, momentum=0).apply(result, {'w': np.array([0.5, 2.5])},
+                                                                            velocity)
+        self.assertEqual(velocity['w'].tolist(), [-2.0, 1.0])
+        self.assertEqual(result['w'].tolist(), [-0.5, 3.0])
+
+
+class UpdateCodecTest(SimpleTestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.base = {'coef_': rng.normal(size=(2, 50)), 'intercept_': rng.normal(size=2)}
+        self.model = {k: v + rng.normal(scale=0.1, size=v.shape) for k, v in self.base.items()}
+
+    def round_trip(self, config, base=None, residual=None):
+        """
+        Encode, save and load the update like an uploaded mid-artifact, then decode it
+        """
+        spec = parse_encoding({'update_encoding': config})
+        encoded, encoding, residual = encode_update(self.model, spec, base, residual)
+        with tempfile.TemporaryDirectory() as folder:
+            url = os.path.join(folder, 'update')
+            save_artifact(url, encoded, {'encoding': encoding})
+            tensors, metadata = load_artifact(url)
+            self.assertTrue(is_encoded(metadata))
+            decoded = decode_update(tensors, metadata['encoding'], base)
+        return encoded, decoded, residual
+
+    def test_delta_is_lossless(self):
+        encoded, decoded, _ = self.round_trip({'delta': True}, self.base)
+        np.testing.assert_allclose(encoded['coef_'], (self.model['coef_'] - self.base['coef_']).ravel())
+        for name, value in self.model.items():
+            np.testing.assert_allclose(decoded[name], value)
+        with self.assertRaises(ValueError):
+            decode_update(encoded, {'delta': True, 'tensors': {}}, None)
+
+    def test_delta_without_base_sends_the_model(self):
+        _, decoded, _ = self.round_trip({'delta': True})
+        np.testing.assert_allclose(decoded['coef_'], self.model['coef_'])
+
+    def test_top_k_keeps_largest_entries(self):
+        encoded, decoded, _ = self.round_trip({'delta': True, 'top_k': 0.1}, self.base)
+        self.assertEqual(encoded['coef_'].shape, (10,))
+        self.assertEqual(encoded['intercept_'].shape, (1,))
+        delta = (self.model['coef_'] - self.base['coef_']).ravel()
+        index = encoded['coef_.index']
+        self.assertEqual(sorted(index), sorted(np.argsort(np.abs(delta))[-10:]))
+        kept = decoded['coef_'].ravel() - self.base['coef_'].ravel()
+        np.testing.assert_allclose(kept[index], delta[index])
+        self.assertEqual(np.count_nonzero(np.delete(kept, index)), 0)
+
+    def test_quantization_error_is_bounded(self):
+        delta = self.model['coef_'] - self.base['coef_']
+        encoded, decoded, _ = self.round_trip({'delta': True, 'quantize': 'float16'}, self.base)
+        self.assertEqual(encoded['coef_'].dtype, np.float16)
+        np.testing.assert_allclose(decoded['coef_'], self.model['coef_'], atol=np.abs(delta).max() * 1e-3)
+        encoded, decoded, _ = self.round_trip({'delta': True, 'quantize': 'int8'}, self.base)
+        self.assertEqual(encoded['coef_'].dtype, np.int8)
+        self.assertEqual(encoded['coef_.scale'].shape, ())
+        np.testing.assert_allclose(decoded['coef_'], self.model['coef_'], atol=np.abs(delta).max() / 127)
+
+    def test_error_feedback_carries_what_was_dropped(self):
+        config = {'delta': True, 'top_k': 5, 'quantize': 'int8', 'error_feedback': True}
+        _, decoded, residual = self.round_trip(config, self.base)
+        delta = self.model['coef_'] - self.base['coef_']
+        np.testing.assert_allclose(decoded['coef_'] - self.base['coef_'] + residual['coef_'], delta)
+        # the next update sends the dropped part along with its own
+        spec = parse_encoding({'update_encoding': config})
+        _, _, no_feedback = encode_update(self.model, dict(spec, error_feedback=False), self.base, residual)
+        self.assertIsNone(no_feedback)
+        encoded, _, _ = encode_update(self.model, spec, self.base, residual)
+        largest = np.argsort(np.abs(delta + residual['coef_']).ravel())[-5:]
+        self.assertEqual(sorted(encoded['coef_.index']), sorted(largest))
+
+
+class LocalScheduleTest(SimpleTestCase):
+
+    def setUp(self):
+        self.now = 0
+        patcher = mock.patch.object(local_training.time, 'monotonic', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_epochs(self, schedule, seconds=0, losses=None):
+        for epoch in schedule.iter_epochs():
+            self.now += seconds
+            schedule.record(losses[epoch] if losses else None)
+        return schedule.completed
+
+    def test_parse_local_training(self):
+        self.assertEqual(parse_local_training({}), {'epochs': 1, 'batch_size': None, 'time_budget': None,
+                                                    'patience': None, 'tol': 1e-4})
+        self.assertEqual(parse_local_training({'local_epochs': 5, 'batch_size': 64, 'time_budget': 30,
+                                               'early_stopping': True}),
+                         {'epochs': 5, 'batch_size': 64, 'time_budget': 30.0, 'patience': 2, 'tol': 1e-4})
+        self.assertEqual(parse_local_training({'local_epochs': 0, 'early_stopping': {'patience': 3, 'tol': 0.1}}),
+                         {'epochs': 1, 'batch_size': None, 'time_budget': None, 'patience': 3, 'tol': 0.1})
+
+    def test_runs_configured_epochs(self):
+        self.assertEqual(self.run_epochs(LocalSchedule.from_config({'local_epochs': 4}).start(), 100), 4)
+
+    def test_time_budget_stops_epochs_and_batches(self):
+        schedule = LocalSchedule(epochs=10, time_budget=25).start()
+        self.assertEqual(self.run_epochs(schedule, 10), 3)
+        # the round deadline applies when it is shorter than the time budget
+        self.assertEqual(self.run_epochs(LocalSchedule(epochs=10, time_budget=25).start(limit=15), 10), 2)
+
+        schedule = LocalSchedule(batch_size=10, time_budget=5).start()
+        batches = []
+        for batch in schedule.iter_batches(45, seed=1):
+            batches.append(batch)
+            self.now += 2
+        self.assertEqual([len(b) for b in batches], [10, 10, 10])
+        # the first epoch and batch always run
+        self.assertEqual(len(list(schedule.iter_batches(45))), 1)
+        self.assertEqual(self.run_epochs(schedule), 1)
+
+    def test_batches_cover_rows_once(self):
+        schedule = LocalSchedule(batch_size=4).start()
+        batches = list(schedule.iter_batches(10, seed=3))
+        self.assertEqual([len(b) for b in batches], [4, 4, 2])
+        self.assertEqual(sorted(np.concatenate(batches).tolist()), list(range(10)))
+        self.assertEqual([b.tolist() for b in schedule.iter_batches(10, seed=3)], [b.tolist() for b in batches])
+        self.assertEqual(len(list(LocalSchedule(batch_size=20).iter_batches(10))), 1)
+
+    def test_early_stopping_after_patience(self):
+        schedule = LocalSchedule(epochs=10, patience=2, tol=0.01).start()
+        # 0.495 does not improve on 0.5 by tol
+        self.assertEqual(self.run_epochs(schedule, losses=[1.0, 0.5, 0.495, 0.6, 0.3]), 4)
+        self.assertTrue(schedule.stopped)
+        self.assertEqual(schedule.best, 0.5)
+        schedule = LocalSchedule(epochs=5, patience=2).start()
+        self.assertEqual(self.run_epochs(schedule, losses=[1.0, 0.9, 1.0, 0.8, 0.9]), 5)
+        self.assertFalse(schedule.stopped)
@@ -3,7 +3,6 @@ import json
 import logging
 import os
 
-import requests
 from django.core.files.storage import FileSystemStorage
 from django.http import HttpResponse
 from django.http import HttpResponseRedirect
@@ -12,6 +11,8 @@ from django.shortcuts import redirect
 from django.template import loader
 from dotenv import load_dotenv
 
+from friendlyfl import celery_app
+from . import router_client
 from .file.file_utils import gen_logs_url, gen_dataset_url
 from .forms import SiteForm, ProjectJoinForm, ProjectNewForm, ProjectLeaveForm
 from .tasks_validator import TaskValidator
@@ -23,9 +24,9 @@ logger = logging.getLogger(__name__)
 
 # read vars from env
 site_uid = os.getenv('SITE_UID')
-router_url = os.getenv('ROUTER_URL')
-router_username = os.getenv('ROUTER_USERNAME')
-router_password = os.getenv('ROUTER_PASSWORD')
+
+# session key of the router id of current site, learnt from the last site lookup
+site_id_session_key = 'site_id'
 
 
 # Create your views here.
@@ -39,8 +40,7 @@ def index(request):
             site_name = site_form.cleaned_data['name']
             site_description = site_form.cleaned_data['description']
             # get current site info
-            response = requests.get('{0}/sites/lookup/?uid={1}'.format(router_url, site_uid),
-                                    auth=(router_username, router_password))
+            response = router_client.get('/sites/lookup/?uid={0}'.format(site_uid))
             current_site = None
             if response.ok:
                 current_site = response.json()
@@ -49,16 +49,14 @@ def index(request):
                 # site already exists
                 if 'deregister_site' in request.POST:
                     # delete site with DELETE
-                    requests.delete('{0}/sites/{1}/'.format(router_url, current_site['id']),
-                                    auth=(router_username, router_password))
+                    router_client.delete('/sites/{0}/'.format(current_site['id']))
                 else:
                     # update site with PUT
                     current_site['name'] = site_name
                     current_site['description'] = site_description
-                    requests.put('{0}/sites/{1}/'.format(router_url, current_site['id']),
-                                 headers={'Content-Type': 'application/json'},
-                                 auth=(router_username, router_password),
-                                 data=json.dumps(current_site))
+                    router_client.put('/sites/{0}/'.format(current_site['id']),
+                                      headers={'Content-Type': 'application/json'},
+                                      data=json.dumps(current_site))
             else:
                 # site does not exist, create site with POST
                 current_site = dict()
@@ -66,16 +64,21 @@ def index(request):
                 current_site['name'] = site_name
                 current_site['description'] = site_description
                 # register new site
-                requests.post('{0}/sites/'.format(router_url),
-                              headers={'Content-Type': 'application/json'},
-                              auth=(router_username, router_password),
-                              data=json.dumps(current_site))
+                router_client.post('/sites/',
+                                   headers={'Content-Type': 'application/json'},
+                                   data=json.dumps(current_site))
         # redirect to the same page
         return HttpResponseRedirect("./")
     # if a GET, load the form
     else:
-        response = requests.get('{0}/sites/lookup/?uid={1}'.format(router_url, site_uid),
-                                auth=(router_username, router_password))
+        # projects lookup needs the site id. When it is known from a previous request of the session,
+        # send both lookups at once and only fall back to a second call if the id changed
+        known_site_id = request.session.get(site_id_session_key)
+        paths = ['/sites/lookup/?uid={0}'.format(site_uid)]
+        if known_site_id is not None:
+            paths.append('/projects/lookup/?site_id={0}'.format(known_site_id))
+        responses = router_client.gather(*paths)
+        response = responses[0]
         # if current site exists, store it for use
         current_site = None
         if response.ok:
@@ -90,9 +93,12 @@ def index(request):
                 'description': current_site['description'],
             })
             # get all projects this site is involved
-            response_project_participants = requests \
-                .get('{0}/projects/lookup/?site_id={1}'.format(router_url, current_site['id']),
-                     auth=(router_username, router_password))
+            if known_site_id == current_site['id']:
+                response_project_participants = responses[1]
+            else:
+                request.session[site_id_session_key] = current_site['id']
+                response_project_participants = router_client \
+                    .get('/projects/lookup/?site_id={0}'.format(current_site['id']))
             project_participants = response_project_participants.json()
         else:
             # site does not exist, init blank form
@@ -126,8 +132,7 @@ def project_leave(request):
         if project_leave_form.is_valid():
             pp_id = project_leave_form.cleaned_data['participant_id']
             # get current site info
-            rr = requests.delete('{0}/project-participants/{1}/'.format(router_url, pp_id),
-                                 auth=(router_username, router_password))
+            rr = router_client.delete('/project-participants/{0}/'.format(pp_id))
             print(rr)
     return redirect('index')
 
@@ -149,8 +154,7 @@ def project_new(request):
                     {'success': False,
                      'msg': 'Tasks provided is not valid due to {}'.format(validator.get_error_msg())})
             # get current site info
-            response = requests.get('{0}/sites/lookup/?uid={1}'.format(router_url, site_uid),
-                                    auth=(router_username, router_password))
+            response = router_client.get('/sites/lookup/?uid={0}'.format(site_uid))
             current_site = None
             if response.ok:
                 current_site = response.json()
@@ -166,10 +170,9 @@ def project_new(request):
                 project['description'] = description
                 project['site'] = current_site['id']
                 project['tasks'] = task_list
-                requests.post('{0}/projects/'.format(router_url),
-                              headers={'Content-Type': 'application/json'},
-                              auth=(router_username, router_password),
-                              data=json.dumps(project))
+                router_client.post('/projects/',
+                                   headers={'Content-Type': 'application/json'},
+                                   data=json.dumps(project))
                 if response.ok:
                     return JsonResponse(
                         {'success': True,
@@ -204,14 +207,14 @@ def project_join(request):
         if project_join_form.is_valid():
             project_name = project_join_form.cleaned_data['name']
             notes = project_join_form.cleaned_data['notes']
-            response = requests.get('{0}/projects/lookup/?name={1}'.format(router_url, project_name),
-                                    auth=(router_username, router_password))
+            # look up project and retrieve site info concurrently
+            response, site_response = router_client.gather(
+                '/projects/lookup/?name={0}'.format(project_name),
+                '/sites/lookup/?uid={0}'.format(site_uid))
             project_to_join = None
             if response.ok:
                 project_to_join = response.json()
-            # retrieve site info
-            response = requests.get('{0}/sites/lookup/?uid={1}'.format(router_url, site_uid),
-                                    auth=(router_username, router_password))
+            response = site_response
             current_site = None
             if response.ok:
                 current_site = response.json()
@@ -222,10 +225,9 @@ def project_join(request):
                 project_participant['project'] = project_to_join['id']
                 project_participant['role'] = 'PA'
                 project_participant['notes'] = notes
-                requests.post('{0}/project-participants/'.format(router_url),
-                              headers={'Content-Type': 'application/json'},
-                              auth=(router_username, router_password),
-                              data=json.dumps(project_participant))
+                router_client.post('/project-participants/',
+                                   headers={'Content-Type': 'application/json'},
+                                   data=json.dumps(project_participant))
         # redirect to the home page
         return HttpResponseRedirect("/controller/")
     # if a GET, load the form
@@ -243,25 +245,21 @@ def project_join(request):
 
 
 def project_detail(request, project_id, site_id):
-    project_response = requests.get('{0}/projects/{1}/'.format(router_url, project_id),
-                                    auth=(router_username, router_password))
+    project_response, participants_response, runs_response = router_client.gather(
+        '/projects/{0}/'.format(project_id),
+        '/project-participants/lookup/?project={0}'.format(project_id),
+        '/runs/lookup/?project={0}&site_uid={1}'.format(project_id, site_uid))
     current_project = None
     all_participants = None
     all_runs = None
     can_start_runs = False
     if project_response.ok:
         current_project = project_response.json()
-        if site_id == current_project["site"]:
-            participants_response = requests.get(
-                '{0}/project-participants/lookup/?project={1}'.format(
-                    router_url, project_id),
-                auth=(router_username, router_password))
-            if participants_response.ok:
-                all_participants = participants_response.json()
-                can_start_runs = True
-
-    runs_response = requests.get('{0}/runs/lookup/?project={1}&site_uid={2}'.format(router_url, project_id, site_uid),
-                                 auth=(router_username, router_password))
+        # participants are fetched along with the project, but only rendered when current site owns the project
+        if site_id == current_project["site"] and participants_response.ok:
+            all_participants = participants_response.json()
+            can_start_runs = True
+
     if runs_response.ok:
         all_runs = runs_response.json()
     # render template
@@ -279,10 +277,9 @@ def project_detail(request, project_id, site_id):
 
 
 def run_detail(request, batch, project_id, site_id):
-    runs_response = requests.get(
-        '{0}/runs/detail/?batch={1}&project={2}&site={3}'.format(
-            router_url, batch, project_id, site_id),
-        auth=(router_username, router_password))
+    runs_response = router_client.get(
+        '/runs/detail/?batch={0}&project={1}&site={2}'.format(
+            batch, project_id, site_id))
     # if current site exists, store it for use
     dic = {}
     if runs_response.ok:
@@ -323,13 +320,15 @@ def upload_dataset(request):
             return JsonResponse({
                 'success': False, 'msg': 'Dataset saving error'
             })
+        # convert the csv into the binary cache in background
+        celery_app.send_task('cache_dataset', args=[run_id],
+                             queue='friendlyfl.compute')
 
     param = dict()
     param['status'] = 3
-    requests.put('{0}/runs/{1}/status/'.format(router_url, run_id),
-                 headers={'Content-type': 'application/json'},
-                 auth=(router_username, router_password),
-                 data=json.dumps(param))
+    router_client.put('/runs/{0}/status/'.format(run_id),
+                      headers={'Content-type': 'application/json'},
+                      data=json.dumps(param))
 
     return JsonResponse({
         'success': True, 'msg': 'Dataset save successfully'
@@ -340,10 +339,9 @@ def start_runs(request, project_id, site_id):
     if project_id and site_id:
         data = dict()
         data['project'] = project_id
-        response = requests.post('{0}/runs'.format(router_url),
-                                 headers={'Content-Type': 'application/json'},
-                                 auth=(router_username, router_password),
-                                 data=json.dumps(data))
+        response = router_client.post('/runs',
+                                      headers={'Content-Type': 'application/json'},
+                                      data=json.dumps(data))
         if not response.ok:
             return JsonResponse(
                 {'success': False, 'msg': 'Failed to start runs of new round due to {}'.format(response.text)})
@@ -361,12 +359,10 @@ def perform_run_action(request, run_id, project_id, batch, role, action):
         if action in download_actions:
             file_type = action.split()[1]
             logger.debug('will download {} files'.format(file_type))
-            response = requests.get(
-                '{0}/runs-action/download/?run={1}&all_runs={2}&type={3}'.format(router_url,
-                                                                                 run_id,
-                                                                                 1,
-                                                                                 file_type),
-                auth=(router_username, router_password))
+            response = router_client.get(
+                '/runs-action/download/?run={0}&all_runs={1}&type={2}'.format(run_id,
+                                                                              1,
+                                                                              file_type))
         else:
             data = dict()
             data['run'] = run_id
@@ -374,11 +370,10 @@ def perform_run_action(request, run_id, project_id, batch, role, action):
             data['batch'] = batch
             data['role'] = role
             data['action'] = action
-            response = requests.put('{0}/runs-action/update/'.format(router_url),
-                                    headers={
-                                        'Content-Type': 'application/json'},
-                                    auth=(router_username, router_password),
-                                    data=json.dumps(data))
+            response = router_client.put('/runs-action/update/',
+                                         headers={
+                                             'Content-Type': 'application/json'},
+                                         data=json.dumps(data))
         if not response.ok:
             return JsonResponse(
                 {'success': False,
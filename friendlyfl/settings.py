@@ -96,17 +96,64 @@ REDIS_HOST = os.getenv('REDIS_HOST', default="redis")
 REDIS_PORT = os.getenv('REDIS_PORT', default=6379)
 REDIS_DB = os.getenv('REDIS_DB', default=0)
 
+# Router client. Timeouts are in seconds. A call timing out in a status handler fails the run, see README
+ROUTER_CONNECT_TIMEOUT = float(os.getenv('ROUTER_CONNECT_TIMEOUT', default=5))
+ROUTER_READ_TIMEOUT = float(os.getenv('ROUTER_READ_TIMEOUT', default=60))
+ROUTER_MAX_RETRIES = int(os.getenv('ROUTER_MAX_RETRIES', default=3))
+ROUTER_RETRY_BACKOFF = float(os.getenv('ROUTER_RETRY_BACKOFF', default=0.5))
+ROUTER_POOL_SIZE = int(os.getenv('ROUTER_POOL_SIZE', default=10))
+# none, gzip or zstd. Compressed files are sent with the suffix .gz or .zst and decompressed by content on download
+ROUTER_UPLOAD_COMPRESSION = os.getenv('ROUTER_UPLOAD_COMPRESSION', default='none')
+
+# Run change subscription. When enabled, the run subscriber reacts to change events pushed by the router
+# and fetch_run only acts as a low-frequency fallback.
+RUN_SUBSCRIPTION_ENABLED = os.getenv(
+    'RUN_SUBSCRIPTION_ENABLED', default='false').lower() in ('1', 'true', 'yes')
+RUN_FETCH_INTERVAL = int(os.getenv(
+    'RUN_FETCH_INTERVAL', default=60 if RUN_SUBSCRIPTION_ENABLED else 5))
+RUN_SUBSCRIPTION_HEARTBEAT = int(
+    os.getenv('RUN_SUBSCRIPTION_HEARTBEAT', default=15))
+
+# In-memory cache of task instances on processor workers
+MODEL_CACHE_MAX_ENTRIES = int(os.getenv('MODEL_CACHE_MAX_ENTRIES', default=32))
+MODEL_CACHE_TTL = int(os.getenv('MODEL_CACHE_TTL', default=86400))
+MODEL_CACHE_MAX_BYTES = int(
+    os.getenv('MODEL_CACHE_MAX_BYTES', default=2 * 1024 ** 3))
+
+# Threads of BLAS libraries per compute task, 0 leaves them unlimited
+COMPUTE_BLAS_THREADS = int(os.getenv('COMPUTE_BLAS_THREADS', default=1))
+
+# Pin each run to one processor and one compute worker node by consistent hashing of its id,
+# so the task instance cached by the node is reused. Nodes renew their registration every third of the ttl
+AFFINITY_ROUTING_ENABLED = os.getenv(
+    'AFFINITY_ROUTING_ENABLED', default='true').lower() in ('1', 'true', 'yes')
+WORKER_REGISTRY_TTL = int(os.getenv('WORKER_REGISTRY_TTL', default=30))
+
+# Runs of a batch fetched by a coordinator are shared by the workers of the site for BATCH_SNAPSHOT_TTL seconds,
+# 0 disables the cache. Status changes of this site invalidate it
+BATCH_SNAPSHOT_TTL = float(os.getenv('BATCH_SNAPSHOT_TTL', default=2))
+
+# Transitions of a run are handled under a redis lock, renewed while held and expiring RUN_LOCK_TTL seconds after
+# a worker dies. A transition finding its run locked waits up to RUN_LOCK_WAIT seconds for it, then is retried after
+# RUN_LOCK_RETRY_DELAY seconds, at most RUN_LOCK_MAX_RETRIES times
+RUN_LOCK_TTL = int(os.getenv('RUN_LOCK_TTL', default=60))
+RUN_LOCK_WAIT = float(os.getenv('RUN_LOCK_WAIT', default=3))
+RUN_LOCK_RETRY_DELAY = int(os.getenv('RUN_LOCK_RETRY_DELAY', default=5))
+RUN_LOCK_MAX_RETRIES = int(os.getenv('RUN_LOCK_MAX_RETRIES', default=60))
+
 CELERY_TASK_ROUTES = {
     'heartbeat': {'queue': 'friendlyfl.run'},
     'fetch_run': {'queue': 'friendlyfl.run'},
     'monitor_run': {'queue': 'friendlyfl.run'},
-    'process_task': {'queue': 'friendlyfl.processor'}
+    'process_task': {'queue': 'friendlyfl.processor'},
+    'compute_task': {'queue': 'friendlyfl.compute'},
+    'cache_dataset': {'queue': 'friendlyfl.compute'}
 }
 
 CELERY_BEAT_SCHEDULE = {
     'fetch_run': {
         'task': 'fetch_run',
-        'schedule': 5,
+        'schedule': RUN_FETCH_INTERVAL,
         'options': {'queue': 'friendlyfl.run'}
     },
     'monitor_run': {